@@ -9,12 +9,8 @@
 '''
 import os
 import time
-import random
 import argparse
 import numpy as np
-import pandas as pd
-from tqdm import tqdm
-from collections import defaultdict
 
 import torch
 import torch.nn as nn
@@ -23,7 +19,9 @@ import torch.utils.data as data
 import torch.backends.cudnn as cudnn
 
 from util.data_loader import load_bprfm, BPRFMData
-from util.metrics import hr_at_k, map_at_k, precision_at_k, recall_at_k, mrr_at_k, ndcg_at_k
+from util.interactions import InteractionMatrix, broadcast_pairs
+from util.sampler import EpochSampler, eval_candidates
+from util.evaluation import evaluate, print_kpi
 
 class BPRFM(nn.Module):
     def __init__(self, num_features, num_factors, batch_norm, drop_prob):
@@ -78,6 +76,21 @@ class BPRFM(nn.Module):
 
         return FM.view(-1)
 
+    def score_batch(self, users, items, feat_idx_dict):
+        '''
+        clamped prediction of every (user, item) pair in one forward pass, see broadcast_pairs for accepted shapes
+        feat_idx_dict: start index of user and item features as load_bprfm gives
+        '''
+        users, items = broadcast_pairs(users, items)
+        device = self.bias_.device
+        features = np.stack([users.ravel() + feat_idx_dict['user'], items.ravel() + feat_idx_dict['item']], axis=1)
+        with torch.no_grad():
+            features = torch.from_numpy(features.astype(np.int64)).to(device)
+            prediction = self._out(features, torch.ones(features.shape, device=device))
+            prediction = prediction.clamp(min=-1.0, max=1.0)
+
+        return prediction.cpu().numpy().reshape(users.shape)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--prepro', 
@@ -108,6 +121,14 @@ if __name__ == '__main__':
                         type=int, 
                         default=5, 
                         help='No. of folds for cross-validation')
+    parser.add_argument('--seed', 
+                        type=int, 
+                        default=2019, 
+                        help='random seed of data split, runs with same settings and seed share one stored split')
+    parser.add_argument('--prefetch', 
+                        type=int, 
+                        default=0, 
+                        help='epochs of negative samples drawn ahead in a background thread, 0 for no prefetch')
     # model setting
     parser.add_argument('--gpu', 
                         type=str, 
@@ -147,7 +168,15 @@ if __name__ == '__main__':
                         type=float, 
                         default=0.05, 
                         help='learning rate')
+    parser.add_argument('--eval_workers', 
+                        type=int, 
+                        default=1, 
+                        help='No. of processes the evaluated users are split over, 1 when the model runs on CUDA')
     args = parser.parse_args()
+    if args.eval_workers > 1 and torch.cuda.is_available():
+        # forked workers cannot use the CUDA context of the trained model
+        print('Model runs on CUDA, evaluate in one process instead of --eval_workers processes')
+        args.eval_workers = 1
 
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
     cudnn.benchmark = True
@@ -156,9 +185,9 @@ if __name__ == '__main__':
     features_map, train_list, val_list, feat_idx_dict, user_tag_info, item_tag_info,  \
     test_user_set, test_item_set, test_ur = load_bprfm(args.dataset, data_split=args.data_split, 
                                                        by_time=args.by_time, val_method=args.val_method, 
-                                                       fold_num=args.fold_num, prepro=args.prepro)
+                                                       fold_num=args.fold_num, prepro=args.prepro, seed=args.seed)
     num_features = len(features_map)
-    num_item = len(item_tag_info)
+    num_user, num_item = len(user_tag_info), len(item_tag_info)
 
     if args.val_method in ['tloo', 'loo', 'tfo']:
         fn = 1
@@ -168,13 +197,12 @@ if __name__ == '__main__':
         raise ValueError('Invalid val_method value')
 
     max_i_num = 1000
-    item_pool = set(range(num_item))
-    fnl_precision, fnl_recall, fnl_map, fnl_ndcg, fnl_hr, fnl_mrr = [], [], [], [], [], []
+    test_mat = InteractionMatrix.from_dict(test_ur, num_user, num_item)
+    fnl_kpi = []
     for fold in range(fn):
         print(f'Start train Validation [{fold + 1}]......')
-        train_ur = defaultdict(set)
-        for _, row in train_list[fold].iterrows():
-            train_ur[row['user']].add(row['item'] - feat_idx_dict['item'])
+        # read before BPRFMData shifts the frame to feature indices
+        train_ur = InteractionMatrix.from_frame(train_list[fold], num_user, num_item)
 
         train_dataset = BPRFMData(train_list[fold], feat_idx_dict, features_map, 
                                   num_item, args.num_ng, True)
@@ -203,106 +231,42 @@ if __name__ == '__main__':
         elif args.opt == 'Momentum':
             optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=0.95)
         
-        for epoch in range(args.epochs):
-            model.train()
-            train_loader.dataset.ng_sample()
-            start_time = time.time()
-
-            for feat_i, feat_val_i, feat_j, feat_val_j in train_loader:
-                if torch.cuda.is_available():
-                    feat_i = feat_i.cuda()
-                    feat_j = feat_j.cuda()
-                    feat_val_i = feat_val_i.cuda()
-                    feat_val_j = feat_val_j.cuda()
-                else:
-                    feat_i = feat_i.cpu()
-                    feat_j = feat_j.cpu()
-                    feat_val_i = feat_val_i.cpu()
-                    feat_val_j = feat_val_j.cpu()
+        with EpochSampler(train_loader.dataset, args.epochs, [args.seed, fold], args.prefetch) as sampler:
+            for epoch in range(args.epochs):
+                model.train()
+                sampler.ng_sample(epoch)
+                start_time = time.time()
+
+                for feat_i, feat_val_i, feat_j, feat_val_j in train_loader:
+                    if torch.cuda.is_available():
+                        feat_i = feat_i.cuda()
+                        feat_j = feat_j.cuda()
+                        feat_val_i = feat_val_i.cuda()
+                        feat_val_j = feat_val_j.cuda()
+                    else:
+                        feat_i = feat_i.cpu()
+                        feat_j = feat_j.cpu()
+                        feat_val_i = feat_val_i.cpu()
+                        feat_val_j = feat_val_j.cpu()
                 
-                model.zero_grad()
-                pred_i, pred_j = model(feat_i, feat_val_i, feat_j, feat_val_j)
-                loss = -(pred_i - pred_j).sigmoid().log().sum()
-                loss.backward()
-                optimizer.step()
-
-            model.eval()
-            elapsed_time = time.time() - start_time
-            print('The time elapse of epoch {:03d}'.format(epoch + 1) + ' is: ' + 
-                  time.strftime("%H: %M: %S", time.gmtime(elapsed_time)))
-
-        test_u_is = defaultdict(set)
-        for k, v in test_ur.items():
-            test_u_is[k] = set(v)
-        preds = {}
-        # construct candidates set
-        for u in test_user_set:
-            if len(test_u_is[u]) < max_i_num:
-                actual_i_list = test_ur[u]
-                cands_num = max_i_num - len(actual_i_list)
-                sub_item_pool = item_pool - train_ur[u] - test_ur[u]
-                cands = random.sample(sub_item_pool, cands_num)
-                test_u_is[u] = test_u_is[u] | set(cands)
-            else:
-                test_u_is[u] = set(random.sample(test_u_is[u], max_i_num))
+                    model.zero_grad()
+                    pred_i, pred_j = model(feat_i, feat_val_i, feat_j, feat_val_j)
+                    loss = -(pred_i - pred_j).sigmoid().log().sum()
+                    loss.backward()
+                    optimizer.step()
+
+                model.eval()
+                elapsed_time = time.time() - start_time
+                print('The time elapse of epoch {:03d}'.format(epoch + 1) + ' is: ' + 
+                      time.strftime("%H: %M: %S", time.gmtime(elapsed_time)))
+
+        # test items plus items the user never interacted with, max_i_num in total
+        test_users, test_cands = eval_candidates(test_mat, train_ur, num=max_i_num, seed=[args.seed, fold], 
+                                                 n_jobs=args.eval_workers)
         # calculate KPI
         print('Start Calculating KPI')
-        for user in tqdm(test_u_is.keys()):
-            test_df = pd.DataFrame(columns=['user', 'item'])
-            items = list(test_u_is[user])
-            pred_rates = []
-            for item in items:
-                features_i = torch.LongTensor([[user + feat_idx_dict['user'], 
-                                                item + feat_idx_dict['item']]])
-                features_j = torch.LongTensor([[user + feat_idx_dict['user'], 
-                                                item + feat_idx_dict['item']]])
-                feature_values_i = torch.FloatTensor([[1, 1]])
-                feature_values_j = torch.FloatTensor([[1, 1]])
-
-                if torch.cuda.is_available():
-                    features_i = features_i.cuda()
-                    feature_values_i = feature_values_i.cuda()
-                    features_j = features_j.cuda()
-                    feature_values_j = feature_values_j.cuda()
-                else:
-                    features_i = features_i.cpu()
-                    feature_values_i = feature_values_i.cpu()
-                    features_j = features_j.cpu()
-                    feature_values_j = feature_values_j.cpu()
-
-                prediction_i, _ = model(features_i, feature_values_i, features_j, feature_values_j)
-                prediction_i = prediction_i.clamp(min=-1.0, max=1.0)
-                pred_rates.append(prediction_i[0].cpu().detach().item())
-
-            rec_idx = np.argsort(pred_rates)[::-1][:args.topk]
-            top_n = np.array(items)[rec_idx]
-            preds[user] = list(top_n)
-
-        for u in preds.keys():
-            preds[u] = [1 if e in test_ur[u] else 0 for e in preds[u]]
-
-        precision_k = np.mean([precision_at_k(r, args.topk) for r in preds.values()])
-        fnl_precision.append(precision_k)
-
-        recall_k = np.mean([recall_at_k(r, len(test_ur[u]), args.topk) for u, r in preds.items()])
-        fnl_recall.append(recall_k)
-
-        map_k = map_at_k(list(preds.values()))
-        fnl_map.append(map_k)
-
-        ndcg_k = np.mean([ndcg_at_k(r, args.topk) for r in preds.values()])
-        fnl_ndcg.append(ndcg_k)
-
-        hr_k = hr_at_k(list(preds.values()), list(preds.keys()), test_ur)
-        fnl_hr.append(hr_k)
-
-        mrr_k = mrr_at_k(list(preds.values()))
-        fnl_mrr.append(mrr_k)
+        kpi = evaluate(lambda users, items: model.score_batch(users, items, feat_idx_dict), test_users, 
+                       test_mat, args.topk, test_cands, n_jobs=args.eval_workers)
+        fnl_kpi.append(kpi)
 
-    print('---------------------------------')
-    print(f'Precision@{args.topk}: {np.mean(fnl_precision)}')
-    print(f'Recall@{args.topk}: {np.mean(fnl_recall)}')
-    print(f'MAP@{args.topk}: {np.mean(fnl_map)}')
-    print(f'NDCG@{args.topk}: {np.mean(fnl_ndcg)}')
-    print(f'HR@{args.topk}: {np.mean(fnl_hr)}')
-    print(f'MRR@{args.topk}: {np.mean(fnl_mrr)}')
+    print_kpi(fnl_kpi, args.topk)
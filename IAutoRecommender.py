@@ -11,16 +11,16 @@
 import os
 import time
 import math
-import random
 import argparse
-from collections import defaultdict
 
 import numpy as np
 import pandas as pd
 import tensorflow as tf
 
 from util.data_loader import AutoRecData
-from util.metrics import precision_at_k, recall_at_k, hr_at_k, map_at_k, mrr_at_k, ndcg_at_k
+from util.interactions import broadcast_pairs
+from util.sampler import eval_candidates
+from util.evaluation import evaluate, print_kpi
 
 class AutoRec(object):
     def __init__(self, sess, args, num_users, num_items, R, mask_R, C, train_R, train_mask_R, 
@@ -217,6 +217,10 @@ if __name__ == '__main__':
                         type=int, 
                         default=5, 
                         help='No. of folds for cross-validation')
+    parser.add_argument('--seed', 
+                        type=int, 
+                        default=2019, 
+                        help='random seed of data split, runs with same settings and seed share one stored split')
     # specific setting for autorec
     parser.add_argument('--hidden_neuron', type=int, default=500)
     parser.add_argument('--lambda_value', type=float, default=1)
@@ -231,6 +235,10 @@ if __name__ == '__main__':
                         help="decay the learning rate for each n epochs")
     parser.add_argument('--random_seed', type=int, default=2019)
     parser.add_argument('--display_step', type=int, default=200)
+    parser.add_argument('--eval_workers', 
+                        type=int, 
+                        default=1, 
+                        help='No. of processes the evaluated users are split over')
     args = parser.parse_args()
 
     tf.compat.v1.set_random_seed(args.random_seed)
@@ -242,22 +250,13 @@ if __name__ == '__main__':
         fn = args.fold_num
 
     data = AutoRecData(1, 0, args.dataset, args.prepro, args.data_split, 
-                       args.by_time, args.val_method, args.fold_num)
+                       args.by_time, args.val_method, args.fold_num, seed=args.seed)
 
     # calculate kpi
-    fnl_precision, fnl_recall, fnl_map, fnl_ndcg, fnl_hr, fnl_mrr = [], [], [], [], [], []
-    item_pool = list(range(data.item_num))
-    max_i_num = 1000
-    test_u_is = defaultdict(set)
-    for key, val in data.test_ur.items():
-        if len(val) < max_i_num:
-            cands_num = max_i_num - len(val)
-            sub_item_pool = set(item_pool) - set(data.train_ur[key]) - set(data.test_ur[key])
-            cands = random.sample(sub_item_pool, cands_num)
-            test_u_is[key] = set(data.test_ur[key]) | set(cands)
-        else:
-            test_u_is[key] = set(random.sample(val, max_i_num))
-        test_u_is[key] = list(test_u_is[key])
+    fnl_kpi = []
+    # test items plus items the user never interacted with, 1000 in total
+    test_users, test_cands = eval_candidates(data.test_mat, data.train_ur, num=1000, seed=args.seed, 
+                                             n_jobs=args.eval_workers)
 
     for fold in range(fn):
         print(f'Start Validation [{fold + 1}]......')
@@ -270,39 +269,11 @@ if __name__ == '__main__':
                         data.item_train_set[fold], data.user_test_set, data.item_test_set)
             algo.run()
     
-        preds = {}
-        for u in test_u_is.keys():
-            pred_rates = [algo.prediction[u, i] for i in test_u_is[u]]
-            rec_idx = np.argsort(pred_rates)[::-1][:args.topk]
-            top_n = np.array(test_u_is[u])[rec_idx]
-            preds[u] = list(top_n)
-            preds[u] = [1 if e in data.test_ur[u] else 0 for e in preds[u]]
-
-        # calculate metrics
-        precision_k = np.mean([precision_at_k(r, args.topk) for r in preds.values()])
-        fnl_precision.append(precision_k)
-
-        recall_k = np.mean([recall_at_k(r, len(data.test_ur[u]), args.topk) for u, r in preds.items()])
-        fnl_recall.append(recall_k)
-
-        map_k = map_at_k(list(preds.values()))
-        fnl_map.append(map_k)
-
-        ndcg_k = np.mean([ndcg_at_k(r, args.topk) for r in preds.values()])
-        fnl_ndcg.append(ndcg_k)
-
-        hr_k = hr_at_k(list(preds.values()), list(preds.keys()), data.test_ur)
-        fnl_hr.append(hr_k)
-        
-        mrr_k = mrr_at_k(list(preds.values()))
-        fnl_mrr.append(mrr_k) 
+        # predictions of every user-item pair are already in algo.prediction
+        kpi = evaluate(lambda users, items: algo.prediction[tuple(broadcast_pairs(users, items))], test_users, 
+                       data.test_mat, args.topk, test_cands, n_jobs=args.eval_workers)
+        fnl_kpi.append(kpi)
 
         tf.compat.v1.reset_default_graph()
 
-    print('---------------------------------')
-    print(f'Precision@{args.topk}: {np.mean(fnl_precision)}')
-    print(f'Recall@{args.topk}: {np.mean(fnl_recall)}')
-    print(f'MAP@{args.topk}: {np.mean(fnl_map)}')
-    print(f'NDCG@{args.topk}: {np.mean(fnl_ndcg)}')
-    print(f'HR@{args.topk}: {np.mean(fnl_hr)}')
-    print(f'MRR@{args.topk}: {np.mean(fnl_mrr)}')
\ No newline at end of file
+    print_kpi(fnl_kpi, args.topk)
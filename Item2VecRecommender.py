@@ -8,23 +8,22 @@
 @Description: 
 '''
 import os
-import random
 import pickle
 import argparse
 from tqdm import tqdm
-from collections import defaultdict
-from sklearn.model_selection import train_test_split, KFold
 
 import numpy as np
-import pandas as pd
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader
 
-from util.data_loader import BuildCorpus, PermutedSubsampledCorpus, load_rate
-from util.metrics import precision_at_k, recall_at_k, map_at_k, ndcg_at_k, hr_at_k, mrr_at_k
+from util.data_loader import BuildCorpus, PermutedSubsampledCorpus, load_split
+from util.splitter import take_split
+from util.interactions import InteractionMatrix, broadcast_pairs
+from util.sampler import eval_candidates
+from util.evaluation import evaluate, print_kpi
 
 class Bundler(nn.Module):
     def forward(self, data):
@@ -104,6 +103,11 @@ def cos_sim(a, b):
     else:
         return numerator / denomitor
 
+def unit_rows(mat):
+    '''rows scaled to unit norm, zero rows stay zero'''
+    norm = np.linalg.norm(mat, axis=1, keepdims=True)
+    return np.divide(mat, norm, out=np.zeros_like(mat, dtype=np.float64), where=norm != 0)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--prepro', 
@@ -134,6 +138,10 @@ if __name__ == '__main__':
                         type=int, 
                         default=5, 
                         help='No. of folds for cross-validation')
+    parser.add_argument('--seed', 
+                        type=int, 
+                        default=2019, 
+                        help='random seed of data split, runs with same settings and seed share one stored split')
     # item2vec settings
     parser.add_argument('--unk', type=str, default='<UNK>', help="UNK token")
     parser.add_argument('--window', type=int, default=5, help="window size")
@@ -149,103 +157,32 @@ if __name__ == '__main__':
     parser.add_argument('--conti', action='store_true', help="continue learning")
     parser.add_argument('--weights', action='store_true', help="use weights for negative sampling")
     parser.add_argument('--cuda', action='store_true', help="use CUDA")
+    parser.add_argument('--eval_workers', 
+                        type=int, 
+                        default=1, 
+                        help='No. of processes the evaluated users are split over')
     args = parser.parse_args()
 
-    df = load_rate(args.dataset, args.prepro)
-    # convert to int code for easy look
-    df['user'] = pd.Categorical(df.user).codes
-    df['item'] = pd.Categorical(df.item).codes
+    df, train_idx, test_idx, folds, _ = load_split(args.dataset, args.prepro, args.data_split, args.by_time, 
+                                                   args.val_method, args.fold_num, args.seed)
 
     pre = BuildCorpus(df, args.window, args.max_vocab, args.unk, args.dataset)
     pre.build()
 
-    if args.data_split == 'fo':
-        if args.by_time:
-            df = df.sample(frac=1)
-            df = df.sort_values(['timestamp']).reset_index(drop=True)
-
-            split_idx = int(np.ceil(len(df) * 0.8))
-            train, test = df.iloc[:split_idx, :].copy(), df.iloc[split_idx:, :].copy()
-        else:
-            train, test = train_test_split(df, test_size=.2)
-    elif args.data_split == 'loo':
-        if args.by_time:
-            df = df.sample(frac=1)
-            df = df.sort_values(['timestamp']).reset_index(drop=True)
-
-            df['rank_latest'] = df.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-            train, test = df[df['rank_latest'] > 1].copy(), df[df['rank_latest'] == 1].copy()
-            del train['rank_latest'], test['rank_latest']
-        else:
-            test = df.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-            test_key = test[['user', 'item']].copy()
-            train = df.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(test_key)).reset_index().copy()
-    else:
-        raise ValueError('Invalid data_split value, expect: loo, fo')
-
-    # build average vector for certain user
-    train_ur = defaultdict(set)
-    for _, row in train.iterrows():
-        train_ur[int(row['user'])].add(int(row['item']))
-    test_ur = defaultdict(set)
-    for _, row in test.iterrows():
-        test_ur[int(row['user'])].add(int(row['item']))
-
-    test_u_is = defaultdict(set)
-    max_i_num = 1000
-    item_pool = list(range(df.item.nunique()))
-    for key, val in test_ur.items():
-        # build candidates set
-        if len(val) < max_i_num:
-            cands_num = max_i_num - len(val)
-            sub_item_pool = list(set(item_pool) - train_ur[key] - test_ur[key])
-            cands = random.sample(sub_item_pool, cands_num)
-            test_u_is[key] = list(test_ur[key] | set(cands))
-        else:
-            test_u_is[key] = list(random.sample(val, max_i_num))
-
-    train_list, val_list = [], []
-    if args.val_method == 'cv':
-        kf = KFold(n_splits=args.fold_num, shuffle=False, random_state=2019)
-        for train_index, val_index in kf.split(train):
-            train_list.append(train.iloc[train_index, :])
-            val_list.append(train.iloc[val_index, :])
-    elif args.val_method == 'loo':
-        val_set = train.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-        val_key = val_set[['user', 'item']].copy()
-        train = train.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(val_key)).reset_index().copy()
-
-        train_list.append(train)
-        val_list.append(val_set)
-    elif args.val_method == 'tloo':
-        train = train.sample(frac=1)
-        train = train.sort_values(['timestamp']).reset_index(drop=True)
-
-        train['rank_latest'] = train.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-        train_set = train[train['rank_latest'] > 1].copy()
-        val_set = train[train['rank_latest'] == 1].copy()
-        del train_set['rank_latest'], val_set['rank_latest']
+    train, test, train_list, val_list = take_split(df, train_idx, test_idx, folds)
 
-        train_list.append(train_set)
-        val_list.append(val_set)
-    elif args.val_method == 'tfo':
-        train = train.sample(frac=1)
-        train = train.sort_values(['timestamp']).reset_index(drop=True)
-
-        split_idx = int(np.ceil(len(train) * 0.9))
-        train_set, val_set = train.iloc[:split_idx, :].copy(), train.iloc[split_idx:, :].copy()
-
-        train_list.append(train_set)
-        val_list.append(val_set)
-    else:
-        raise ValueError('Invalid val_method value, expect: cv, loo, tloo, tfo')
+    # test items plus items the user never interacted with, 1000 in total
+    user_num, item_num = df.user.nunique(), df.item.nunique()
+    test_ur = InteractionMatrix.from_frame(test, user_num, item_num)
+    test_users, test_cands = eval_candidates(test_ur, InteractionMatrix.from_frame(train, user_num, item_num), 
+                                             num=1000, seed=args.seed, n_jobs=args.eval_workers)
 
     if args.val_method in ['tloo', 'loo', 'tfo']:
         fn = 1
     else:
         fn = args.fold_num
 
-    fnl_precision, fnl_recall, fnl_map, fnl_ndcg, fnl_hr, fnl_mrr = [], [], [], [], [], []
+    fnl_kpi = []
     for fold in range(fn):
         print(f'Start Validation [{fold + 1}]......')
         pre.convert(train_list[fold], fold)
@@ -291,45 +228,23 @@ if __name__ == '__main__':
         torch.save(optimizer.state_dict(), os.path.join(args.save_dir, args.dataset, f'{args.name}.optimizer.pt.{fold}'))
 
         item2idx = pickle.load(open(os.path.join(args.data_dir, args.dataset, f'item2idx.dat'), 'rb'))
-        item2vec = {key: idx2vec[val, :] for key, val in item2idx.items()}
+        # unit item vectors by item code, items out of vocabulary share the vector of unk as in training
+        item_vec = idx2vec[[item2idx.get(i, item2idx[args.unk]) for i in range(item_num)]]
+        item_vec = unit_rows(item_vec)
+        # test user vector averages the vectors of its distinct test items
+        truth_keys = np.unique(test_ur.row_ids().astype(np.int64) * item_num + test_ur.indices)
+        truth_u, truth_i = truth_keys // item_num, truth_keys % item_num
+        user_vec = np.zeros((user_num, item_vec.shape[1]))
+        np.add.at(user_vec, truth_u, idx2vec[[item2idx.get(i, item2idx[args.unk]) for i in truth_i.tolist()]])
+        user_vec = unit_rows(user_vec / np.maximum(np.bincount(truth_u, minlength=user_num), 1)[:, None])
 
         # calculate KPI
         print('---------------------------------')
         print('Start Calculating KPI......')
-        test_uservec, preds = dict(), dict()
-        for u in test_ur.keys():
-            # calculate test user vector for similarity
-            test_uservec[u] = np.array([item2vec[i] for i in test_ur[u]]).mean(axis=0)
-            test_u_is[u] = list(test_u_is[u])
-            pred_rates = [cos_sim(test_uservec[u], item2vec[i]) for i in test_u_is[u]]
-            rec_idx = np.argsort(pred_rates)[::-1][:args.topk]
-            top_n = np.array(test_u_is[u])[rec_idx]
-            preds[u] = list(top_n)
-        for u in preds.keys():
-            preds[u] = [1 if e in test_ur[u] else 0 for e in preds[u]]
-
-        precision_k = np.mean([precision_at_k(r, args.topk) for r in preds.values()])
-        fnl_precision.append(precision_k)
-
-        recall_k = np.mean([recall_at_k(r, len(test_ur[u]), args.topk) for u, r in preds.items()])
-        fnl_recall.append(recall_k)
-
-        map_k = map_at_k(list(preds.values()))
-        fnl_map.append(map_k)
-
-        ndcg_k = np.mean([ndcg_at_k(r, args.topk) for r in preds.values()])
-        fnl_ndcg.append(ndcg_k)
-
-        hr_k = hr_at_k(list(preds.values()), list(preds.keys()), test_ur)
-        fnl_hr.append(hr_k)
-        
-        mrr_k = mrr_at_k(list(preds.values()))
-        fnl_mrr.append(mrr_k) 
+        # cosine similarity of user and item vectors, 0 if either is a zero vector as cos_sim gives
+        kpi = evaluate(lambda users, items: np.einsum('...f,...f->...', *[vec[x] for vec, x in 
+                                                                          zip((user_vec, item_vec), broadcast_pairs(users, items))]), 
+                       test_users, test_ur, args.topk, test_cands, n_jobs=args.eval_workers)
+        fnl_kpi.append(kpi)
             
-    print('---------------------------------')
-    print(f'Precision@{args.topk}: {np.mean(fnl_precision)}')
-    print(f'Recall@{args.topk}: {np.mean(fnl_recall)}')
-    print(f'MAP@{args.topk}: {np.mean(fnl_map)}')
-    print(f'NDCG@{args.topk}: {np.mean(fnl_ndcg)}')
-    print(f'HR@{args.topk}: {np.mean(fnl_hr)}')
-    print(f'MRR@{args.topk}: {np.mean(fnl_mrr)}')
+    print_kpi(fnl_kpi, args.topk)
@@ -8,18 +8,16 @@
 @Description: SVD recommender, also known as BiasMF
 '''
 import gc
-import random
 import argparse
 
-import numpy as np
-import pandas as pd
 from tqdm import tqdm
-from collections import defaultdict
-from sklearn.model_selection import train_test_split, KFold
 
 from util.matrix_factorization import SVD
-from util.data_loader import load_rate
-from util.metrics import ndcg_at_k, map_at_k, hr_at_k, precision_at_k, recall_at_k, mrr_at_k
+from util.data_loader import load_split
+from util.interactions import InteractionMatrix
+from util.sampler import eval_candidates
+from util.splitter import take_split
+from util.evaluation import evaluate, print_kpi
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -71,185 +69,67 @@ if __name__ == '__main__':
                         type=int, 
                         default=5, 
                         help='No. of folds for cross-validation')
+    parser.add_argument('--seed', 
+                        type=int, 
+                        default=2019, 
+                        help='random seed of data split, runs with same settings and seed share one stored split')
+    parser.add_argument('--rank_all', 
+                        type=int, 
+                        default=0, 
+                        help='whether rank all items except training ones for test users instead of 1000 candidates')
+    parser.add_argument('--eval_workers', 
+                        type=int, 
+                        default=1, 
+                        help='No. of processes the evaluated users are split over')
     args = parser.parse_args()
 
-    df = load_rate(args.dataset, args.prepro)
+    df, train_idx, test_idx, folds, _ = load_split(args.dataset, args.prepro, args.data_split, args.by_time, 
+                                                   args.val_method, args.fold_num, args.seed)
 
     user_num, item_num = df.user.nunique(), df.item.nunique()
-    df['user'] = pd.Categorical(df['user']).codes
-    df['item'] = pd.Categorical(df['item']).codes
-
-    if args.data_split == 'fo':
-        if args.by_time:
-            df = df.sample(frac=1)
-            df = df.sort_values(['timestamp']).reset_index(drop=True)
-
-            split_idx = int(np.ceil(len(df) * 0.8))
-            train_set, test_set = df.iloc[:split_idx, :].copy(), df.iloc[split_idx:, :].copy()
-        else:
-            train_set, test_set = train_test_split(df, test_size=.2)
-    elif args.data_split == 'loo':
-        if args.by_time:
-            df = df.sample(frac=1)
-            df = df.sort_values(['timestamp']).reset_index(drop=True)
-
-            df['rank_latest'] = df.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-            train_set, test_set = df[df['rank_latest'] > 1].copy(), df[df['rank_latest'] == 1].copy()
-            del train_set['rank_latest'], test_set['rank_latest']
-        else:
-            test_set = df.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-            test_key = test_set[['user', 'item']].copy()
-            train_set = df.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(test_key)).reset_index().copy()
-    else:
-        raise ValueError('Invalid data_split value, expect: loo, fo')
-
-    train_set_list, val_set_list = [], []
-    # train validation split
-    if args.val_method == 'cv': # 5-fold
-        kf = KFold(n_splits=args.fold_num, shuffle=False, random_state=2019)
-        for train_index, val_index in kf.split(train_set):
-            train_set_list.append(train_set.iloc[train_index, :])
-            val_set_list.append(train_set.iloc[val_index, :])
-    elif args.val_method == 'loo':
-        val_set = train_set.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-        val_key = val_set[['user', 'item']].copy()
-        train_set = train_set.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(val_key)).reset_index().copy()
-
-        train_set_list.append(train_set)
-        val_set_list.append(val_set)
-    elif args.val_method == 'tloo':
-        train_set = train_set.sample(frac=1)
-        train_set = train_set.sort_values(['timestamp']).reset_index(drop=True)
-
-        train_set['rank_latest'] = train_set.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-        new_train_set = train_set[train_set['rank_latest'] > 1].copy()
-        val_set = train_set[train_set['rank_latest'] == 1].copy()
-        del new_train_set['rank_latest'], val_set['rank_latest']
-
-        train_set_list.append(new_train_set)
-        val_set_list.append(val_set)
-    elif args.val_method == 'tfo':
-        train_set = train_set.sample(frac=1)
-        train_set = train_set.sort_values(['timestamp']).reset_index(drop=True)
 
-        split_idx = int(np.ceil(len(train_set) * 0.9))
-        train_set, val_set = train_set.iloc[:split_idx, :].copy(), train_set.iloc[split_idx:, :].copy()
-
-        train_set_list.append(train_set)
-        val_set_list.append(val_set)
-    else:
-        raise ValueError('Invalid val_method value, expect: cv, loo, tloo, tfo')
+    train_set, test_set, train_set_list, val_set_list = take_split(df, train_idx, test_idx, folds)
 
     algo_list = []
     for i in range(len(train_set_list)):
         print(f'Start train model with fold {i + 1}')
         algo = SVD(user_num, item_num, n_factors=args.factors, n_epochs=args.epochs, biased=args.biased, lr_all=args.lr, reg_all=args.reg)
-        algo.fit(train_set)
+        algo.fit(train_set_list[i])
         algo_list.append(algo)
 
-    # true item with some negative sampling items, compose 50 items as alternatives
-    # count all items interacted in full dataset
-    u_is = defaultdict(set)
-    for _, row in df.iterrows():
-        u_is[int(row['user'])].add(int(row['item']))
-
-    test_u_is = defaultdict(set)
-    for _, row in test_set.iterrows():
-        test_u_is[int(row['user'])].add(int(row['item']))
-    item_pool = test_set.item.unique().tolist()
-
-    max_i_num = 1000
-    for key, val in test_u_is.items():
-        if len(val) < max_i_num:
-            cands_num = max_i_num - len(val)
-            # remove item appear in train set towards certain user
-            sub_item_pool = set(item_pool) - set(u_is[key])
-            cands = random.sample(sub_item_pool, cands_num)
-            test_u_is[key] = list(test_u_is[key] | set(cands))
-        else:
-            test_u_is[key] = random.sample(val, max_i_num)
+    # ground truth plus sampled negatives, 1000 items as alternatives for every test user,
+    # negatives are test items the user never interacted with in full dataset
+    u_is = InteractionMatrix.from_frame(df, user_num, item_num)
+    item_pool = test_set.item.unique()
+    test_ur = InteractionMatrix.from_frame(test_set, user_num, item_num)
+    test_users, test_cands = eval_candidates(test_ur, u_is, item_pool, 1000, args.seed, n_jobs=args.eval_workers)
+    train_mat = InteractionMatrix.from_frame(train_set, user_num, item_num)
 
     print('---------------------------------')
     print('Start Calculating KPI......')
     # k-fold consider
     val_kpi = []
-    fnl_precision, fnl_recall, fnl_map, fnl_ndcg, fnl_hr, fnl_mrr = [], [], [], [], [], []
+    fnl_kpi = []
     for i in tqdm(range(len(algo_list))):
         algo = algo_list[i]
         # get top-N list for validation users
-        # validation ground truth setting
-        val_set = val_set_list[i]
-        val_u_is = defaultdict(set)
-        for _, row in val_set.iterrows():
-            val_u_is[int(row['user'])].add(int(row['item']))
-        # validation set candidates setting
-        max_i_num = 1000
-        for key, val in val_u_is.items():
-            if len(val) < max_i_num:
-                cands_num = max_i_num - len(val)
-                cands = random.sample(item_pool, cands_num)
-                val_u_is[key] = val_u_is[key] | set(cands)
-            else:
-                val_u_is[key] = random.sample(val, max_i_num)
-        preds = {}
-        for u in val_u_is.keys():
-            val_u_is[u] = list(val_u_is[u])
-            pred_rates = [algo.predict(u, i) for i in val_u_is[u]]
-            rec_idx = np.argsort(pred_rates)[::-1][:args.topk]
-            top_n = np.array(val_u_is[u])[rec_idx]
-            preds[u] = list(top_n)
-        # get actual interaction info. of validation users
-        ur = defaultdict(list)
-        for u in val_set.user.unique():
-            ur[u] = val_set.loc[val_set.user==u, 'item'].values.tolist()
-        for u in preds.keys():
-            preds[u] = [1 if e in ur[u] else 0 for e in preds[u]]
-        val_kpi_k = np.mean([precision_at_k(r, args.topk) for r in preds.values()])
-        val_kpi.append(val_kpi_k)
-
-        # get top-N list for test users
-        preds = {}
-        for u in test_u_is.keys():
-            test_u_is[u] = list(test_u_is[u])
-            pred_rates = [algo.predict(u, i) for i in test_u_is[u]]
-            rec_idx = np.argsort(pred_rates)[::-1][:args.topk]
-            top_n = np.array(test_u_is[u])[rec_idx]
-            preds[u] = list(top_n)
-        # get actual interaction info. of test users
-        test_ur = defaultdict(list)
-        for u in test_set.user.unique():
-            test_ur[u] = test_set.loc[test_set.user==u, 'item'].values.tolist()
-        for u in preds.keys():
-            preds[u] = [1 if e in test_ur[u] else 0 for e in preds[u]]
-
-        # calculate metrics
-        precision_k = np.mean([precision_at_k(r, args.topk) for r in preds.values()])
-        fnl_precision.append(precision_k)
-
-        recall_k = np.mean([recall_at_k(r, len(test_ur[u]), args.topk) for u, r in preds.items()])
-        fnl_recall.append(recall_k)
-
-        map_k = map_at_k(list(preds.values()))
-        fnl_map.append(map_k)
-
-        ndcg_k = np.mean([ndcg_at_k(r, args.topk) for r in preds.values()])
-        fnl_ndcg.append(ndcg_k)
-
-        hr_k = hr_at_k(list(preds.values()), list(preds.keys()), test_ur)
-        fnl_hr.append(hr_k)
-        
-        mrr_k = mrr_at_k(list(preds.values()))
-        fnl_mrr.append(mrr_k) 
+        val_ur = InteractionMatrix.from_frame(val_set_list[i], user_num, item_num)
+        val_users, val_cands = eval_candidates(val_ur, None, item_pool, 1000, [args.seed, i], n_jobs=args.eval_workers)
+        val_kpi_k = evaluate(algo.score_batch, val_users, val_ur, args.topk, val_cands, n_jobs=args.eval_workers)
+        val_kpi.append(val_kpi_k['precision'])
+
+        # get top-N list for test users and calculate metrics
+        if args.rank_all:
+            # every item the user did not interact with in train set is ranked
+            kpi = evaluate(algo.score_users, test_set.user.unique(), test_ur, args.topk, seen=train_mat, 
+                           n_jobs=args.eval_workers)
+        else:
+            kpi = evaluate(algo.score_batch, test_users, test_ur, args.topk, test_cands, n_jobs=args.eval_workers)
+        fnl_kpi.append(kpi)
 
         gc.collect()
 
     for i in range(len(val_kpi)):
         print(f'Validation [{i + 1}] Precision@{args.topk}: {val_kpi[i]}')
 
-    print('---------------------------------')
-    print(f'Precision@{args.topk}: {np.mean(fnl_precision)}')
-    print(f'Recall@{args.topk}: {np.mean(fnl_recall)}')
-    print(f'MAP@{args.topk}: {np.mean(fnl_map)}')
-    print(f'NDCG@{args.topk}: {np.mean(fnl_ndcg)}')
-    print(f'HR@{args.topk}: {np.mean(fnl_hr)}')
-    print(f'MRR@{args.topk}: {np.mean(fnl_mrr)}')
+    print_kpi(fnl_kpi, args.topk)
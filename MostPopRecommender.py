@@ -10,12 +10,12 @@
 import argparse
 
 import numpy as np
-import pandas as pd
 from collections import defaultdict
-from sklearn.model_selection import train_test_split, KFold
 
-from util.data_loader import load_rate
-from util.metrics import ndcg_at_k, map_at_k, hr_at_k, precision_at_k, recall_at_k, mrr_at_k
+from util.data_loader import load_split
+from util.splitter import take_split
+from util.interactions import InteractionMatrix
+from util.evaluation import evaluate, print_kpi
 
 class MostPopRecommender(object):
     def __init__(self, N=5):
@@ -27,18 +27,20 @@ class MostPopRecommender(object):
         # self.top_n = res[:self.N].index.tolist()
         self.rank_list = res.index.tolist()
 
-    def predict(self, df):
-        item_list = df['item'].unique().tolist()
-        exists_item = [i for i in self.rank_list if i in item_list]
-        non_exists = list(set(item_list) - set(exists_item))
+    def top_n(self, df):
+        '''N most popular items among the items of df, items never seen in fit follow in random order'''
+        item_list = df['item'].unique()
+        exists = set(item_list.tolist())
+        exists_item = [i for i in self.rank_list if i in exists]
+        seen = set(exists_item)
+        non_exists = [i for i in item_list.tolist() if i not in seen]
         np.random.shuffle(non_exists)
 
-        if len(exists_item) == 0:
-            exists_item = []
-        if len(non_exists) == 0:
-            non_exists = []
         rank_list = exists_item + non_exists
-        top_n = rank_list[:self.N]
+        return np.array(rank_list[:self.N], dtype=np.int64)
+
+    def predict(self, df):
+        top_n = self.top_n(df).tolist()
         res = defaultdict(list)
         for u in df.user.unique():
             res[u] = top_n
@@ -74,107 +76,40 @@ if __name__ == '__main__':
                         type=int, 
                         default=5, 
                         help='No. of folds for cross-validation')
+    parser.add_argument('--seed', 
+                        type=int, 
+                        default=2019, 
+                        help='random seed of data split, runs with same settings and seed share one stored split')
+    parser.add_argument('--eval_workers', 
+                        type=int, 
+                        default=1, 
+                        help='No. of processes the evaluated users are split over')
     args = parser.parse_args()
 
     k = args.topk
-    df = load_rate(args.dataset, args.prepro)
-    # split dataset
-    if args.data_split == 'fo':
-        if args.by_time:
-            df = df.sample(frac=1)
-            df = df.sort_values(['timestamp']).reset_index(drop=True)
-            split_idx = int(np.ceil(len(df) * 0.8))
-            train_set, test_set = df.iloc[:split_idx, :].copy(), df.iloc[split_idx:, :].copy()
-        else:
-            train_set, test_set = train_test_split(df, test_size=0.2, random_state=2019)
-    elif args.data_split == 'loo':
-        if args.by_time:
-            df = df.sample(frac=1)
-            df = df.sort_values(['timestamp']).reset_index(drop=True)
-            df['rank_latest'] = df.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-            train_set, test_set = df[df['rank_latest'] > 1].copy(), df[df['rank_latest'] == 1].copy()
-            del train_set['rank_latest'], test_set['rank_latest']
-        else:
-            test_set = df.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-            test_key = test_set[['user', 'item']].copy()
-            train_set = df.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(test_key)).reset_index().copy()
-    else:
-        raise ValueError('Invalid data_split value, expect: loo, fo')
-
-    train_set_list, val_set_list = [], []
-    # train validation split
-    if args.val_method == 'cv': # k-fold
-        kf = KFold(n_splits=args.fold_num, shuffle=False, random_state=2019)
-        for train_index, val_index in kf.split(train_set):
-            train_set_list.append(train_set.iloc[train_index, :])
-            val_set_list.append(train_set.iloc[val_index, :])
-    elif args.val_method == 'loo':
-        val_set = train_set.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-        val_key = val_set[['user', 'item']].copy()
-        train_set = train_set.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(val_key)).reset_index().copy()
-
-        train_set_list.append(train_set)
-        val_set_list.append(val_set)
-    elif args.val_method == 'tloo':
-        train_set = train_set.sample(frac=1)
-        train_set = train_set.sort_values(['timestamp']).reset_index(drop=True)
-
-        train_set['rank_latest'] = train_set.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-        new_train_set = train_set[train_set['rank_latest'] > 1].copy()
-        val_set = train_set[train_set['rank_latest'] == 1].copy()
-        del new_train_set['rank_latest'], val_set['rank_latest']
+    df, train_idx, test_idx, folds, _ = load_split(args.dataset, args.prepro, args.data_split, args.by_time, 
+                                                   args.val_method, args.fold_num, args.seed)
+    # train/validation/test split
+    train_set, test_set, train_set_list, val_set_list = take_split(df, train_idx, test_idx, folds)
 
-        train_set_list.append(new_train_set)
-        val_set_list.append(val_set)
-    elif args.val_method == 'tfo':
-        train_set = train_set.sample(frac=1)
-        train_set = train_set.sort_values(['timestamp']).reset_index(drop=True)
+    # ground truth index of test users, built once for all folds
+    user_num, item_num = df.user.nunique(), df.item.nunique()
+    test_ur = InteractionMatrix.from_frame(test_set, user_num, item_num)
+    test_users = np.flatnonzero(test_ur.user_degree())
 
-        split_idx = int(np.ceil(len(train_set) * 0.9))
-        train_set, val_set = train_set.iloc[:split_idx, :].copy(), train_set.iloc[split_idx:, :].copy()
-
-        train_set_list.append(train_set)
-        val_set_list.append(val_set)
-    else:
-        raise ValueError('Invalid val_method value, expect: cv, loo, tloo, tfo')
-
-    fnl_precision, fnl_recall, fnl_map, fnl_ndcg, fnl_hr, fnl_mrr = [], [], [], [], [], []
+    fnl_kpi = []
     for fold in range(len(train_set_list)):
         print(f'Start train validation [{fold + 1}]')
         reco = MostPopRecommender(k)
         reco.fit(train_set_list[fold])
-        # get top-N list for test users
-        preds = reco.predict(test_set)
-        # get actual interaction info. of test users
-        test_ur = defaultdict(list)
-        for u in test_set.user.unique():
-            test_ur[u] = test_set.loc[test_set.user==u, 'item'].values.tolist()
-        for u in preds.keys():
-            preds[u] = [1 if e in test_ur[u] else 0 for e in preds[u]]
-
+        # every test user gets the same top-N list, scored in rank order; other items are never ranked,
+        # so -1 pads the list if test set has less than k items
+        top_n = reco.top_n(test_set)
+        scores = np.full(item_num, -np.inf)
+        scores[top_n] = np.arange(len(top_n), 0, -1)
         # calculate metrics
-        precision_k = np.mean([precision_at_k(r, k) for r in preds.values()])
-        fnl_precision.append(precision_k)
-
-        recall_k = np.mean([recall_at_k(r, len(test_ur[u]), k) for u, r in preds.items()])
-        fnl_recall.append(recall_k)
-
-        map_k = map_at_k(list(preds.values()))
-        fnl_map.append(map_k)
-
-        ndcg_k = np.mean([ndcg_at_k(r, k) for r in preds.values()])
-        fnl_ndcg.append(ndcg_k)
-
-        hr_k = hr_at_k(list(preds.values()), list(preds.keys()), test_ur)
-        fnl_hr.append(hr_k)
-
-        mrr_k = mrr_at_k(list(preds.values()))
-        fnl_mrr.append(mrr_k)
+        kpi = evaluate(lambda users: np.broadcast_to(scores, (len(users), item_num)), test_users, test_ur, k, 
+                       n_jobs=args.eval_workers)
+        fnl_kpi.append(kpi)
 
-    print('---------------------------------')
-    print(f'Precision@{args.topk}: {np.mean(fnl_precision)}')
-    print(f'Recall@{args.topk}: {np.mean(fnl_recall)}')
-    print(f'MAP@{args.topk}: {np.mean(fnl_map)}')
-    print(f'NDCG@{args.topk}: {np.mean(fnl_ndcg)}')
-    print(f'HR@{args.topk}: {np.mean(fnl_hr)}')
-    print(f'MRR@{args.topk}: {np.mean(fnl_mrr)}')
+    print_kpi(fnl_kpi, args.topk)
@@ -11,8 +11,6 @@ import os
 import time
 import argparse
 import numpy as np
-from tqdm import tqdm
-from collections import defaultdict
 
 import torch
 import torch.nn as nn
@@ -22,7 +20,10 @@ import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
 
 from util.data_loader import NCFData, load_mat
-from util.metrics import metric_eval, recall_at_k, precision_at_k, map_at_k, ndcg_at_k, hr_at_k, mrr_at_k
+from util.sampler import EpochSampler, candidate_matrix
+from util.interactions import InteractionMatrix, broadcast_pairs
+from util.evaluation import evaluate, print_kpi
+from util.metrics import metric_eval
 
 class NCF(nn.Module):
     def __init__(self, user_num, item_num, factor_num, num_layers, dropout, 
@@ -123,6 +124,33 @@ class NCF(nn.Module):
         prediction = self.predict_layer(concat)
         return prediction.view(-1)
 
+    def score_batch(self, users, items):
+        '''scores of every (user, item) pair in one forward pass, see broadcast_pairs for accepted shapes'''
+        users, items = broadcast_pairs(users, items)
+        device = self.predict_layer.weight.device
+        with torch.no_grad():
+            user = torch.from_numpy(users.ravel()).to(device)
+            item = torch.from_numpy(items.ravel()).to(device)
+            prediction = self.forward(user, item)
+
+        return prediction.cpu().numpy().reshape(users.shape)
+
+    def score_users(self, users):
+        '''(len(users), item_num) scores of users against every item, GMF by one matrix product'''
+        users = np.asarray(users, dtype=np.int64)
+        items = np.arange(self.embed_item_GMF.num_embeddings)
+        if self.model != 'GMF':
+            # MLP layers see every pair, keep a forward pass around 2^20 pairs
+            step = max(1, (1 << 20) // len(items))
+            return np.concatenate([self.score_batch(users[s:s + step, None], items[None, :]) 
+                                   for s in range(0, len(users), step)])
+        with torch.no_grad():
+            # predict_layer(p_u * q_i) = (p_u * w) . q_i + b
+            user = self.embed_user_GMF.weight[torch.as_tensor(users)] * self.predict_layer.weight[0]
+            prediction = user @ self.embed_item_GMF.weight.t() + self.predict_layer.bias
+
+        return prediction.cpu().numpy()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--prepro', 
@@ -196,7 +224,27 @@ if __name__ == '__main__':
                         type=int, 
                         default=5, 
                         help='No. of folds for cross-validation')
+    parser.add_argument('--seed', 
+                        type=int, 
+                        default=2019, 
+                        help='random seed of data split, runs with same settings and seed share one stored split')
+    parser.add_argument('--prefetch', 
+                        type=int, 
+                        default=0, 
+                        help='epochs of negative samples drawn ahead in a background thread, 0 for no prefetch')
+    parser.add_argument('--rank_all', 
+                        type=int, 
+                        default=0, 
+                        help='whether rank all items except training ones for test users instead of 1000 candidates')
+    parser.add_argument('--eval_workers', 
+                        type=int, 
+                        default=1, 
+                        help='No. of processes the evaluated users are split over, 1 when the model runs on CUDA')
     args = parser.parse_args()
+    if args.eval_workers > 1 and torch.cuda.is_available():
+        # forked workers cannot use the CUDA context of the trained model
+        print('Model runs on CUDA, evaluate in one process instead of --eval_workers processes')
+        args.eval_workers = 1
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
     cudnn.benchmark = True
 
@@ -204,7 +252,12 @@ if __name__ == '__main__':
     train_data_list, test_data, user_num, item_num, \
     train_mat_list, test_ur, val_data_list = load_mat(args.dataset, data_split=args.data_split, 
                                                       by_time=args.by_time, val_method=args.val_method, 
-                                                      fold_num=args.fold_num, prepro=args.prepro)
+                                                      fold_num=args.fold_num, prepro=args.prepro, seed=args.seed, 
+                                                      n_jobs=args.eval_workers)
+
+    # candidate rows and ground truth of test users
+    test_users, test_cands = candidate_matrix(InteractionMatrix.from_pairs(test_data, user_num, item_num))
+    test_truth = InteractionMatrix.from_dict(test_ur, user_num, item_num)
 
     if args.val_method in ['tloo', 'loo', 'tfo']:
         fn = 1
@@ -213,7 +266,7 @@ if __name__ == '__main__':
     else:
         raise ValueError('Invalid val_method value')
 
-    fnl_precision, fnl_recall, fnl_map, fnl_ndcg, fnl_hr, fnl_mrr = [], [], [], [], [], []
+    fnl_kpi = []
     for fold in range(fn):
         print(f'Start train Validation [{fold + 1}]......')
         train_dataset = NCFData(train_data_list[fold], item_num, train_mat_list[fold], args.num_ng, True)
@@ -260,85 +313,54 @@ if __name__ == '__main__':
             optimizer = optim.Adam(model.parameters(), lr=args.lr)
 
         count, best_hr = 0, 0
-        for epoch in range(args.epochs):
-            model.train()
-            start_time = time.time()
-            train_loader.dataset.ng_sample()
-
-            for user, item, label in train_loader:
-                if torch.cuda.is_available():
-                    user = user.cuda()
-                    item = item.cuda()
-                    label = label.float().cuda()
-                else:
-                    user = user.cpu()
-                    item = item.cpu()
-                    label = label.float().cpu()
-
-                model.zero_grad()
-                prediction = model(user, item)
-                loss = loss_function(prediction, label)
-                loss.backward()
-                optimizer.step()
-                count += 1
-
-            model.eval()
-            HR, NDCG = metric_eval(model, test_loader, args.topk, algo='ncf')
-            elapsed_time = time.time() - start_time
-            print("The time elapse of epoch {:03d}".format(epoch + 1) + ' is: ' + 
-                    time.strftime('%H: %M: %S', time.gmtime(elapsed_time)))
-            # print('HR: {:.3f}\tNDCG: {:.3f}'.format(np.mean(HR), np.mean(NDCG)))
-
-            if HR > best_hr:
-                best_hr, best_ndcg, best_epoch = HR, NDCG, epoch
-                if args.out:
-                    if not os.path.exists(f'./models/{args.dataset}'):
-                        os.makedirs(f'./models/{args.dataset}')
-                    torch.save(model, f'./models/{args.dataset}/{model_name.split("-")[0]}.pt.{fold}')
+        with EpochSampler(train_loader.dataset, args.epochs, [args.seed, fold], args.prefetch) as sampler:
+            for epoch in range(args.epochs):
+                model.train()
+                start_time = time.time()
+                sampler.ng_sample(epoch)
+
+                for user, item, label in train_loader:
+                    if torch.cuda.is_available():
+                        user = user.cuda()
+                        item = item.cuda()
+                        label = label.float().cuda()
+                    else:
+                        user = user.cpu()
+                        item = item.cpu()
+                        label = label.float().cpu()
+
+                    model.zero_grad()
+                    prediction = model(user, item)
+                    loss = loss_function(prediction, label)
+                    loss.backward()
+                    optimizer.step()
+                    count += 1
+
+                model.eval()
+                HR, NDCG = metric_eval(model, test_loader, args.topk, algo='ncf', truth=test_truth)
+                elapsed_time = time.time() - start_time
+                print("The time elapse of epoch {:03d}".format(epoch + 1) + ' is: ' + 
+                        time.strftime('%H: %M: %S', time.gmtime(elapsed_time)))
+                # print('HR: {:.3f}\tNDCG: {:.3f}'.format(np.mean(HR), np.mean(NDCG)))
+
+                if HR > best_hr:
+                    best_hr, best_ndcg, best_epoch = HR, NDCG, epoch
+                    if args.out:
+                        if not os.path.exists(f'./models/{args.dataset}'):
+                            os.makedirs(f'./models/{args.dataset}')
+                        torch.save(model, f'./models/{args.dataset}/{model_name.split("-")[0]}.pt.{fold}')
 
         print('End. Best epoch {:03d}: HR = {:.3f}'.format(best_epoch, best_hr))
 
         # Calculate KPI
-        preds = {}
-        test_u_is = defaultdict(set)
-        for ele in test_data:
-            test_u_is[int(ele[0])].add(int(ele[1]))
-
         print('Start generate top-K rank list......')
-        for u in tqdm(test_u_is.keys()):
-            test_u_is[u] = list(test_u_is[u])
-            pred_rates = [model(torch.tensor(u), torch.tensor(i)).cpu().detach().numpy()[0] for i in test_u_is[u]]
-            rec_idx = np.argsort(pred_rates)[::-1][:args.topk]
-            top_n = np.array(test_u_is[u])[rec_idx]
-            preds[u] = list(top_n)
-
-        for u in preds.keys():
-            preds[u] = [1 if e in test_ur[u] else 0 for e in preds[u]]
-
-        # calculate metrics
-        precision_k = np.mean([precision_at_k(r, args.topk) for r in preds.values()])
-        fnl_precision.append(precision_k)
-
-        recall_k = np.mean([recall_at_k(r, len(test_ur[u]), args.topk) for u, r in preds.items()])
-        fnl_recall.append(recall_k)
-
-        map_k = map_at_k(list(preds.values()))
-        fnl_map.append(map_k)
-
-        ndcg_k = np.mean([ndcg_at_k(r, args.topk) for r in preds.values()])
-        fnl_ndcg.append(ndcg_k)
-
-        hr_k = hr_at_k(list(preds.values()), list(preds.keys()), test_ur)
-        fnl_hr.append(hr_k)
-
-        mrr_k = mrr_at_k(list(preds.values()))
-        fnl_mrr.append(mrr_k)
-
-    print('---------------------------------')
-    print(f'Precision@{args.topk}: {np.mean(fnl_precision)}')
-    print(f'Recall@{args.topk}: {np.mean(fnl_recall)}')
-    print(f'MAP@{args.topk}: {np.mean(fnl_map)}')
-    print(f'NDCG@{args.topk}: {np.mean(fnl_ndcg)}')
-    print(f'HR@{args.topk}: {np.mean(fnl_hr)}')
-    print(f'MRR@{args.topk}: {np.mean(fnl_mrr)}')
+        if args.rank_all:
+            # every item not interacted in train set is ranked
+            seen = InteractionMatrix.from_pairs(train_data_list[fold] + val_data_list[fold], user_num, item_num)
+            kpi = evaluate(model.score_users, test_users, test_truth, args.topk, seen=seen, n_jobs=args.eval_workers)
+        else:
+            kpi = evaluate(model.score_batch, test_users, test_truth, args.topk, test_cands, n_jobs=args.eval_workers)
+        fnl_kpi.append(kpi)
+
+    print_kpi(fnl_kpi, args.topk)
     
\ No newline at end of file
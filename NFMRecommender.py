@@ -9,12 +9,9 @@
 '''
 import os
 import time
-import random
 import argparse
 
 import numpy as np
-import pandas as pd
-from collections import defaultdict
 
 import torch
 import torch.nn as nn
@@ -23,8 +20,11 @@ import torch.utils.data as data
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
 
-from util.metrics import metrics_nfm, map_at_k, ndcg_at_k, hr_at_k, precision_at_k, recall_at_k, mrr_at_k
+from util.metrics import metrics_nfm
 from util.data_loader import load_libfm, map_features, FMData
+from util.interactions import InteractionMatrix, broadcast_pairs
+from util.sampler import eval_candidates
+from util.evaluation import evaluate, print_kpi
 
 class NFM(nn.Module):
     def __init__(self, num_features, num_factors, act_function, layers, batch_norm, drop_prob, pretrain_FM):
@@ -170,6 +170,22 @@ class FM(nn.Module):
 
         return FM.view(-1)
 
+def score_pairs(model, user_feat, item_feat, users, items):
+    '''
+    clamped prediction of FM/NFM for every (user, item) pair in one forward pass
+    user_feat, item_feat: model feature index of every user and item code;
+    users, items: see broadcast_pairs for accepted shapes.
+    '''
+    users, items = broadcast_pairs(users, items)
+    device = model.bias_.device
+    features = np.stack([user_feat[users.ravel()], item_feat[items.ravel()]], axis=1)
+    with torch.no_grad():
+        features = torch.from_numpy(features).to(device)
+        prediction = model(features, torch.ones(features.shape, device=device))
+        prediction = prediction.clamp(min=-1.0, max=1.0)
+
+    return prediction.cpu().numpy().reshape(users.shape)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -257,7 +273,19 @@ if __name__ == '__main__':
                         type=int, 
                         default=5, 
                         help='No. of folds for cross-validation')
+    parser.add_argument('--seed', 
+                        type=int, 
+                        default=2019, 
+                        help='random seed of data split, runs with same settings and seed share one stored split')
+    parser.add_argument('--eval_workers', 
+                        type=int, 
+                        default=1, 
+                        help='No. of processes the evaluated users are split over, 1 when the model runs on CUDA')
     args = parser.parse_args()
+    if args.eval_workers > 1 and torch.cuda.is_available():
+        # forked workers cannot use the CUDA context of the trained model
+        print('Model runs on CUDA, evaluate in one process instead of --eval_workers processes')
+        args.eval_workers = 1
 
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
     cudnn.benchmark = True
@@ -268,17 +296,20 @@ if __name__ == '__main__':
     feat_idx_dict, user_tag_info, item_tag_info,  \
     test_user_set, test_item_set, test_ur, train_ur = load_libfm(args.dataset, data_split=args.data_split, 
                                                                  by_time=args.by_time, val_method=args.val_method, 
-                                                                 fold_num=args.fold_num, prepro=args.prepro)
+                                                                 fold_num=args.fold_num, prepro=args.prepro, seed=args.seed)
     num_item = len(item_tag_info)
-    item_pool = list(range(num_item))
+    test_mat = InteractionMatrix.from_dict(test_ur, train_ur.user_num, train_ur.item_num)
     features_map, num_features = map_features(args.dataset)
+    # model feature index of every user and item code, as the libfm files of candidates were read
+    user_feat = np.array([features_map[str(feat_idx_dict['user'] + u)] for u in range(train_ur.user_num)], dtype=np.int64)
+    item_feat = np.array([features_map[str(feat_idx_dict['item'] + i)] for i in range(train_ur.item_num)], dtype=np.int64)
 
     if args.val_method in ['tloo', 'loo', 'tfo']:
         fn = 1
     else:
         fn = args.fold_num
 
-    fnl_precision, fnl_recall, fnl_map, fnl_ndcg, fnl_hr, fnl_mrr = [], [], [], [], [], []
+    fnl_kpi = []
     test_dataset = FMData(f'./data/{args.dataset}/{args.dataset}.test.libfm', features_map)
     test_loader = data.DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=0)
 
@@ -382,83 +413,11 @@ if __name__ == '__main__':
                     torch.save(model, f'{model_path}{args.dataset}/{args.model}.pt.{fold}')
         print('End. Best epoch {:03d}: Test_RMSE is {:.3f}'.format(best_epoch, best_rmse))
 
-        test_u_is = defaultdict(set)
-        for key, val in test_ur.items():
-            test_u_is[key] = set(val)
-
-        preds = {}
-        tmp_file_name = f'./tmp.test.libfm'
-        for u in test_user_set:
-            if len(test_u_is[u]) < max_i_num:
-            # construct candidates set
-                cands_num = max_i_num - len(test_ur[u])
-                sub_item_pool = set(item_pool) - set(test_ur[u]) - set(train_ur[u])
-                cands = random.sample(sub_item_pool, cands_num)
-                test_u_is[u] = test_u_is[u] | set(cands)
-            else:
-                test_u_is[u] = set(random.sample(test_u_is[u], max_i_num))
-            candidates = list(test_u_is[u])
-            df = pd.DataFrame({'user': [u for _ in test_u_is[u]], 'item': list(test_u_is[u])})
-            df = df.merge(user_tag_info, on='user', how='left').merge(item_tag_info, on='item', how='left')
-
-            file_obj = open(tmp_file_name, 'w')
-            for idx, row in df.iterrows():
-                l = ''
-                for col in feat_idx_dict.keys():
-                    if col != 'rating':
-                        l += ' '
-                        l = l + str(int(feat_idx_dict[col] + row[col])) + ':1'
-                l = str(0) + l + '\n'
-                file_obj.write(l)
-            file_obj.close()
-
-            test_dataset = FMData(tmp_file_name, features_map)
-            test_loader = data.DataLoader(test_dataset, batch_size=max_i_num, shuffle=False, num_workers=0)
-
-            for features, feature_values, _ in test_loader:
-                if torch.cuda.is_available():
-                    features = features.cuda()
-                    feature_values = feature_values.cuda()
-                else:
-                    features = features.cpu()
-                    feature_values = feature_values.cpu()
-
-                prediction = model(features, feature_values)
-                prediction = prediction.clamp(min=-1.0, max=1.0)
-
-                _, indices = torch.topk(prediction, args.topk)
-                recommends = torch.take(torch.tensor(candidates), indices).cpu().numpy().tolist()
-
-            preds[u] = recommends
-            preds[u] = [1 if e in test_ur[u] else 0 for e in preds[u]]
-        
-        
-        # calculate metrics
-        precision_k = np.mean([precision_at_k(r, args.topk) for r in preds.values()])
-        fnl_precision.append(precision_k)
-
-        recall_k = np.mean([recall_at_k(r, len(test_ur[u]), args.topk) for u, r in preds.items()])
-        fnl_recall.append(recall_k)
-
-        map_k = map_at_k(list(preds.values()))
-        fnl_map.append(map_k)
-
-        ndcg_k = np.mean([ndcg_at_k(r, args.topk) for r in preds.values()])
-        fnl_ndcg.append(ndcg_k)
-
-        hr_k = hr_at_k(list(preds.values()), list(preds.keys()), test_ur)
-        fnl_hr.append(hr_k)
-
-        mrr_k = mrr_at_k(list(preds.values()))
-        fnl_mrr.append(mrr_k)
-
-        if os.path.exists(tmp_file_name):
-            os.remove(tmp_file_name)
+        # test items plus items the user never interacted with, max_i_num in total
+        test_users, test_cands = eval_candidates(test_mat, train_ur, num=max_i_num, seed=[args.seed, fold], 
+                                                 n_jobs=args.eval_workers)
+        kpi = evaluate(lambda users, items: score_pairs(model, user_feat, item_feat, users, items), test_users, 
+                       test_mat, args.topk, test_cands, n_jobs=args.eval_workers)
+        fnl_kpi.append(kpi)
 
-    print('---------------------------------')
-    print(f'Precision@{args.topk}: {np.mean(fnl_precision)}')
-    print(f'Recall@{args.topk}: {np.mean(fnl_recall)}')
-    print(f'MAP@{args.topk}: {np.mean(fnl_map)}')
-    print(f'NDCG@{args.topk}: {np.mean(fnl_ndcg)}')
-    print(f'HR@{args.topk}: {np.mean(fnl_hr)}')
-    print(f'MRR@{args.topk}: {np.mean(fnl_mrr)}')
+    print_kpi(fnl_kpi, args.topk)
@@ -10,19 +10,18 @@
 import os
 import gc
 import time
-import random
 import argparse
-import operator
 
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
-from collections import defaultdict
 from concurrent.futures import ProcessPoolExecutor
 
 from util import slim
 from util.data_loader import SlimData
-from util.metrics import map_at_k, ndcg_at_k, hr_at_k, precision_at_k, recall_at_k, mrr_at_k
+from util.interactions import InteractionMatrix, broadcast_pairs
+from util.sampler import eval_candidates
+from util.evaluation import evaluate, print_kpi
 
 class SLIM(object):
     def __init__(self, data, i):
@@ -34,16 +33,12 @@ class SLIM(object):
         self.lam_bda = None
         self.max_iter = None
         self.tol = None # learning threshold
-        self.N = None # top-N num
         self.lambda_is_ratio = None        
         self.W = None
-        self.recommendation = None
+        self.AW = None
     
     def __user_item_matrix(self):
-        A = np.zeros((self.data.num_user, self.data.num_item))
-        for user, item in self.data.train[self.i]:
-            A[user, item] = 1
-        return A
+        return self.data.train_mat[self.i].to_dense(binary=True)
 
     def __aggregation_coefficients(self):
         group_size = 100  # 并行计算每组计算的行/列数
@@ -90,63 +85,24 @@ class SLIM(object):
                                                    [covariance_array] * n, 
                                                    starts, ends)))
     
-    def __recommend(self, u, user_AW, user_item_set, method='test'):
-        '''
-        generate N recommend items for user
-        :param user_AW: the user row of the result of matrix dot product of A and W
-        :param user_item_set: item interacted in train set for user 
-        :return: recommend list for user
-        '''
-        if method == 'test':
-            truth = self.ur[u]
-        elif method == 'val':
-            truth = self.val_ur[u]
-        max_i_num = 1000
-        if len(truth) < max_i_num:
-            cands_num = max_i_num - len(truth)
-            sub_item_pool = set(range(self.data.num_item)) - user_item_set - set(truth)
-            cands = random.sample(sub_item_pool, cands_num)
-            candidates = list(set(truth) | set(cands))
-        else:
-            candidates = random.sample(truth, max_i_num)
-
-        rank = dict()
-        for i in set(candidates):
-            rank[i] = user_AW[i]
-        return [items[0] for items in sorted(rank.items(), key=operator.itemgetter(1), reverse=True)[:self.N]]
-
-    def __get_recommendation(self, method='test'):
-        train_user_items = [set() for u in range(self.data.num_user)]
-        for user, item in self.data.train[self.i]:
-            train_user_items[user].add(item)
-
-        AW = self.A.dot(self.W) # get user prediction for all item
-        # recommend N items for each user
-        recommendation = []
-        for u, user_AW, user_item_set in zip(range(self.data.num_user), AW, train_user_items):
-            recommendation.append(self.__recommend(u, user_AW, user_item_set, method))
-        return recommendation
-
-    def compute_recommendation(self, alpha=0.5, lam_bda=0.02, max_iter=1000, tol=0.0001, N=10, 
-                               ground_truth=None, val_ur=None, lambda_is_ratio=True):
+    def fit(self, alpha=0.5, lam_bda=0.02, max_iter=1000, tol=0.0001, lambda_is_ratio=True):
         self.alpha = alpha
         self.lam_bda = lam_bda
         self.max_iter = max_iter
         self.tol = tol
-        self.N = N
         self.lambda_is_ratio = lambda_is_ratio
-        self.ur = ground_truth
-
-        self.val_ur = val_ur
 
         print(f'Start calculating W matrix(alpha={self.alpha}, lambda={self.lam_bda}, max_iter={self.max_iter}, tol={self.tol})')
         self.W = self.__aggregation_coefficients()
+        self.AW = self.A.dot(self.W) # get user prediction for all item
 
-        print(f'Start calculating validation recommendation list(N={self.N})')
-        self.val_recommendation = self.__get_recommendation('val')
+    def score_batch(self, users, items):
+        '''prediction of every (user, item) pair at once, see broadcast_pairs for accepted shapes'''
+        return self.AW[tuple(broadcast_pairs(users, items))]
 
-        print(f'Start calculating recommendation list(N={self.N})')
-        self.recommendation = self.__get_recommendation('test')
+    def score_users(self, users):
+        '''(len(users), item_num) prediction of users against every item'''
+        return self.AW[np.asarray(users, dtype=np.int64)]
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -194,78 +150,48 @@ if __name__ == '__main__':
                         type=int, 
                         default=5, 
                         help='No. of folds for cross-validation')
+    parser.add_argument('--seed', 
+                        type=int, 
+                        default=2019, 
+                        help='random seed of data split, runs with same settings and seed share one stored split')
+    parser.add_argument('--eval_workers', 
+                        type=int, 
+                        default=1, 
+                        help='No. of processes the evaluated users are split over')
     args = parser.parse_args()
 
-    slim_data= SlimData(args.dataset, args.data_split, args.by_time, args.val_method, args.fold_num, args.prepro)
+    slim_data= SlimData(args.dataset, args.data_split, args.by_time, args.val_method, args.fold_num, args.prepro, 
+                         args.seed)
 
-    # genereate top-N list for test user set
-    test_user_set = list({ele[0] for ele in slim_data.test})
     # this ur is test set ground truth
-    test_ur = defaultdict(list)
-    for ele in slim_data.test:
-        test_ur[ele[0]].append(ele[1])
-    # this val_ur_list is validation set ground_truth
-    val_ur_list = []
-    for validation in slim_data.val:
-        tmp_ur = defaultdict(list)
-        for ele in validation:
-            tmp_ur[ele[0]].append(ele[1])
-        val_ur_list.append(tmp_ur)
+    test_ur = InteractionMatrix.from_pairs(slim_data.test, slim_data.num_user, slim_data.num_item)
 
     recommender_list = []
     val_kpi = []
-    fnl_precision, fnl_recall, fnl_map, fnl_ndcg, fnl_hr, fnl_mrr = [], [], [], [], [], []
+    fnl_kpi = []
     start_time = time.time()
     for i in range(len(slim_data.train)):
-        val_ur = val_ur_list[i]
+        # this val_ur is validation set ground truth
+        val_ur = InteractionMatrix.from_pairs(slim_data.val[i], slim_data.num_user, slim_data.num_item)
         recommend = SLIM(slim_data, i)
-        recommend.compute_recommendation(alpha=args.alpha, lam_bda=args.elastic, max_iter=args.epochs, 
-                                         tol=args.tol, N=args.topk, ground_truth=ur, val_ur=val_ur)
-        print('Finish train model and generate topN list')
+        recommend.fit(alpha=args.alpha, lam_bda=args.elastic, max_iter=args.epochs, tol=args.tol)
+        print('Finish train model')
         recommender_list.append(recommend)
 
-        # validation predictions
-        preds = {}
-        for u in val_ur.keys():
-            preds[u] = recommend.val_recommendation[u]
-        for u in preds.keys():
-            preds[u] = [1 if e in val_ur[u] else 0 for e in preds[u]]
-        
-        val_kpi_k = np.mean([precision_at_k(r, args.topk) for r in preds.values()])
-        val_kpi.append(val_kpi_k)
+        # ground truth plus items never interacted in train set, 1000 in total, for users having ground truth
+        print(f'Start calculating validation recommendation list(N={args.topk})')
+        users, cands = eval_candidates(val_ur, slim_data.train_mat[i], num=1000, seed=[args.seed, i], 
+                                       n_jobs=args.eval_workers)
+        val_kpi_k = evaluate(recommend.score_batch, users, val_ur, args.topk, cands, n_jobs=args.eval_workers)
+        val_kpi.append(val_kpi_k['precision'])
         
-        # test predictions
-        preds = {}
-        for u in test_ur.keys():
-            preds[u] = recommend.recommendation[u] # recommendation didn't contain item in train set
-        for u in preds.keys():
-            preds[u] = [1 if e in test_ur[u] else 0 for e in preds[u]]
-        # calculate metrics
-        precision_k = np.mean([precision_at_k(r, args.topk) for r in preds.values()])
-        fnl_precision.append(precision_k)
-
-        recall_k = np.mean([recall_at_k(r, len(test_ur[u]), args.topk) for u, r in preds.items()])
-        fnl_recall.append(recall_k)
-
-        map_k = map_at_k(list(preds.values()))
-        fnl_map.append(map_k)
-
-        ndcg_k = np.mean([ndcg_at_k(r, args.topk) for r in preds.values()])
-        fnl_ndcg.append(ndcg_k)
-
-        hr_k = hr_at_k(list(preds.values()), list(preds.keys()), test_ur)
-        fnl_hr.append(hr_k)
-
-        mrr_k = mrr_at_k(list(preds.values()))
-        fnl_mrr.append(mrr_k)
+        print(f'Start calculating recommendation list(N={args.topk})')
+        users, cands = eval_candidates(test_ur, slim_data.train_mat[i], num=1000, seed=[args.seed, i], 
+                                       n_jobs=args.eval_workers)
+        kpi = evaluate(recommend.score_batch, users, test_ur, args.topk, cands, n_jobs=args.eval_workers)
+        fnl_kpi.append(kpi)
         
     for i in range(len(val_kpi)):
         print(f'Validation [{i + 1}] Precision@{args.topk}: {val_kpi[i]}')
 
-    print('---------------------------------')
-    print(f'Precision@{args.topk}: {np.mean(fnl_precision)}')
-    print(f'Recall@{args.topk}: {np.mean(fnl_recall)}')
-    print(f'MAP@{args.topk}: {np.mean(fnl_map)}')
-    print(f'NDCG@{args.topk}: {np.mean(fnl_ndcg)}')
-    print(f'HR@{args.topk}: {np.mean(fnl_hr)}')
-    print(f'MRR@{args.topk}: {np.mean(fnl_mrr)}')
+    print_kpi(fnl_kpi, args.topk)
@@ -8,10 +8,8 @@
 @Description: WRMF
 '''
 import os
-import random
 import argparse
 from tqdm import tqdm
-from collections import defaultdict
 
 import numpy as np
 import pandas as pd
@@ -19,7 +17,9 @@ import scipy.sparse as sp
 from scipy.sparse.linalg import spsolve
 
 from util.data_loader import load_rate, WRMFData
-from util.metrics import hr_at_k, ndcg_at_k, map_at_k, precision_at_k, recall_at_k, mrr_at_k
+from util.interactions import InteractionMatrix, broadcast_pairs
+from util.sampler import eval_candidates
+from util.evaluation import evaluate, print_kpi
 
 class WRMF(object):
     def __init__(self, train_set, lambda_val=0.1, alpha=40, iterations=10, factor_num=20, seed=2019):
@@ -56,11 +56,22 @@ class WRMF(object):
                 self.Y[i] = spsolve(xTx + xTCiIX + self.lambda_eye, xTCiPi)
 
         self.user_vec, self.item_vec = self.X, self.Y.T
+        # dense copies for batch scoring
+        self.user_factors, self.item_factors = self.X.toarray(), self.Y.toarray()
     
     def predict(self, u, i):
         prediction = self.user_vec[u, :].dot(self.item_vec[:, i])
         return prediction.A[0, 0]
 
+    def score_batch(self, users, items):
+        '''predict of every (user, item) pair at once, see broadcast_pairs for accepted shapes'''
+        users, items = broadcast_pairs(users, items)
+        return np.einsum('...f,...f->...', self.user_factors[users], self.item_factors[items])
+
+    def score_users(self, users):
+        '''(len(users), item_num) predict of users against every item'''
+        return self.user_factors[np.asarray(users, dtype=np.int64)] @ self.item_factors.T
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--prepro', 
@@ -107,14 +118,26 @@ if __name__ == '__main__':
                         type=int, 
                         default=5, 
                         help='No. of folds for cross-validation')
+    parser.add_argument('--seed', 
+                        type=int, 
+                        default=2019, 
+                        help='random seed of data split, runs with same settings and seed share one stored split')
+    parser.add_argument('--rank_all', 
+                        type=int, 
+                        default=0, 
+                        help='whether rank all items except training ones for test users instead of 1000 candidates')
+    parser.add_argument('--eval_workers', 
+                        type=int, 
+                        default=1, 
+                        help='No. of processes the evaluated users are split over')
     args = parser.parse_args()
 
     dataset = WRMFData(args.dataset, data_split=args.data_split, by_time=args.by_time, 
-                       val_method=args.val_method, fold_num=args.fold_num, prepro=args.prepro)
+                       val_method=args.val_method, fold_num=args.fold_num, prepro=args.prepro, seed=args.seed)
 
     print(f'Start Calculating KPI metrics, validation method: {args.val_method}......')
     val_kpi = []
-    fnl_precision, fnl_recall, fnl_map, fnl_ndcg, fnl_hr, fnl_mrr = [], [], [], [], [], []
+    fnl_kpi = []
     for fold in range(len(dataset.train_list)):
         print(f'Start train validation [{fold + 1}]......')
 
@@ -123,90 +146,34 @@ if __name__ == '__main__':
         algo.fit()
 
         print(f'Start validation [{fold + 1}] kpi calculation......')
-        # generate top-N list for validation user set
-        val_user_set = dataset.val_users_list[fold]
-        ur = defaultdict(list)
-        index = dataset.val.nonzero()
-        for u, i in zip(index[0], index[1]):
-            ur[u].append(i)
-        candidates = defaultdict(list)
-        for u in val_user_set:
-            unint = np.where(dataset.train_list[fold][u, :].toarray().reshape(-1) == 0)[0]
-            candidates[u] = list(set(unint) & set(ur[u]))
-        max_i_num = 1000
-        preds = {}
-        item_pool = list(range(dataset.item_num))
-        for u in tqdm(val_user_set):
-            if len(candidates[u]) < max_i_num:
-                actual_cands = set(candidates[u])
-                neg_item_pool = set(range(dataset.train_list[fold].shape[1])) - set(ur[u])
-                neg_cands = random.sample(neg_item_pool, max_i_num - len(candidates[u])) 
-                cands = actual_cands | set(neg_cands)
-            else:
-                cands = random.sample(candidates[u], max_i_num)
-            pred_rates = algo.user_vec[u, :].dot(algo.item_vec).toarray()[0, list(cands)]
-            rec_idx = np.argsort(pred_rates)[::-1][:args.topk]
-            preds[u] = list(np.array(list(cands))[rec_idx])
-        for u in preds.keys():
-            preds[u] = [1 if i in ur[u] else 0 for i in preds[u]]
-
-        val_kpi_k = np.mean([precision_at_k(r, args.topk) for r in preds.values()])
-        val_kpi.append(val_kpi_k)
+        # validation items not interacted in train set are the ground truth, negatives avoid all validation items
+        train_mat = InteractionMatrix(*dataset.train_list[fold].nonzero(), dataset.user_num, dataset.item_num)
+        val_u, val_i = dataset.val.nonzero()
+        fresh = ~train_mat.contains(val_u, val_i)
+        val_ur = InteractionMatrix(val_u[fresh], val_i[fresh], dataset.user_num, dataset.item_num)
+        val_mat = InteractionMatrix(val_u, val_i, dataset.user_num, dataset.item_num)
+        users, cand_mat = eval_candidates(val_ur, val_mat, num=1000, seed=[args.seed, fold, 0], 
+                                          n_jobs=args.eval_workers)
+        val_kpi_k = evaluate(algo.score_batch, users, val_ur, args.topk, cand_mat, n_jobs=args.eval_workers)
+        val_kpi.append(val_kpi_k['precision'])
 
         print('Start test kpi calculation......')
-        # genereate top-N list for test user set
-        test_user_set = dataset.test_users
-        test_ur = defaultdict(list) # u的实际交互item
-        index = dataset.test.nonzero()
-        for u, i in zip(index[0], index[1]):
-            test_ur[u].append(i)
-        candidates = defaultdict(list)
-        for u in test_user_set:
-            unint = np.where(dataset.train_list[fold][u, :].toarray().reshape(-1) == 0)[0] # 未交互的物品
-            candidates[u] = list(set(unint) & set(test_ur[u])) # 未交互的物品中属于后续已交互的物品
-
-        max_i_num = 1000
-        preds = {}
-        item_pool = list(range(dataset.item_num))
-        for u in tqdm(test_user_set):
-            if len(candidates[u]) < max_i_num:
-                actual_cands = set(candidates[u])
-                neg_item_pool = set(item_pool) - set(test_ur[u]) - set(ur[u])
-                neg_cands = random.sample(neg_item_pool, max_i_num - len(candidates[u])) 
-                cands = actual_cands | set(neg_cands)
-            else:
-                cands = random.sample(candidates[u], max_i_num)
-            pred_rates = algo.user_vec[u, :].dot(algo.item_vec).toarray()[0, list(cands)]
-            rec_idx = np.argsort(pred_rates)[::-1][:args.topk]
-            preds[u] = list(np.array(list(cands))[rec_idx])
-        for u in preds.keys():
-            preds[u] = [1 if i in test_ur[u] else 0 for i in preds[u]]
-    
-        precision_k = np.mean([precision_at_k(r, args.topk) for r in preds.values()])
-        fnl_precision.append(precision_k)
-
-        recall_k = np.mean([recall_at_k(r, len(test_ur[u]), args.topk) for u, r in preds.items()])
-        fnl_recall.append(recall_k)
-
-        map_k = map_at_k(list(preds.values()))
-        fnl_map.append(map_k)
-
-        ndcg_k = np.mean([ndcg_at_k(r, args.topk) for r in preds.values()])
-        fnl_ndcg.append(ndcg_k)
-
-        hr_k = hr_at_k(list(preds.values()), list(preds.keys()), test_ur)
-        fnl_hr.append(hr_k)
-
-        mrr_k = mrr_at_k(list(preds.values()))
-        fnl_mrr.append(mrr_k)
+        # every item of test users counts as ground truth, those interacted in train set are never ranked
+        test_u, test_i = dataset.test.nonzero()
+        test_ur = InteractionMatrix(test_u, test_i, dataset.user_num, dataset.item_num)
+        if args.rank_all:
+            # every item not interacted in train and validation sets is ranked
+            kpi = evaluate(algo.score_users, dataset.test_users, test_ur, args.topk, seen=val_mat, 
+                           n_jobs=args.eval_workers)
+        else:
+            # candidates are items of test users not interacted in train set plus negatives avoiding all interactions
+            fresh = ~train_mat.contains(test_u, test_i) & np.isin(test_u, dataset.test_users)
+            users, cand_mat = eval_candidates(InteractionMatrix(test_u[fresh], test_i[fresh], dataset.user_num, dataset.item_num), 
+                                              test_ur, num=1000, seed=[args.seed, fold, 1], n_jobs=args.eval_workers)
+            kpi = evaluate(algo.score_batch, users, test_ur, args.topk, cand_mat, n_jobs=args.eval_workers)
+        fnl_kpi.append(kpi)
 
     for i in range(len(val_kpi)):
         print(f'Validation [{i + 1}] Precision@{args.topk}: {val_kpi[i]}')
 
-    print('---------------------------------')
-    print(f'Precision@{args.topk}: {np.mean(fnl_precision)}')
-    print(f'Recall@{args.topk}: {np.mean(fnl_recall)}')
-    print(f'MAP@{args.topk}: {np.mean(fnl_map)}')
-    print(f'NDCG@{args.topk}: {np.mean(fnl_ndcg)}')
-    print(f'HR@{args.topk}: {np.mean(fnl_hr)}')
-    print(f'MRR@{args.topk}: {np.mean(fnl_mrr)}')
+    print_kpi(fnl_kpi, args.topk)
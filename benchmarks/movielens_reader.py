@@ -0,0 +1,58 @@
+'''
+@Author: Yu Di
+@Date: 2019-12-02 10:21:37
+@LastEditors: Yudi
+@LastEditTime: 2019-12-02 11:05:12
+@Company: Cardinal Operation
+@Email: yudi@shanshu.ai
+@Description: compare `::` separated movielens parsing, pandas python engine vs. util.data_loader reader
+'''
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util.data_loader import _read_movielens
+
+def python_engine(path):
+    return pd.read_csv(path, sep='::', header=None, 
+                       names=['user', 'item', 'rating', 'timestamp'], engine='python')
+
+def timeit(func, path, repeat):
+    costs = []
+    for _ in range(repeat):
+        start_time = time.time()
+        df = func(path)
+        costs.append(time.time() - start_time)
+
+    return df, min(costs)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets', 
+                        type=str, 
+                        default='ml-1m,ml-10m', 
+                        help='comma separated movielens datasets with ratings.dat')
+    parser.add_argument('--repeat', 
+                        type=int, 
+                        default=3, 
+                        help='No. of runs for each reader, best one is reported')
+    args = parser.parse_args()
+
+    for src in args.datasets.split(','):
+        path = f'./data/{src}/ratings.dat'
+        if not os.path.exists(path):
+            print(f'{path} not found, skip {src}')
+            continue
+        old, old_cost = timeit(python_engine, path, args.repeat)
+        new, new_cost = timeit(_read_movielens, path, args.repeat)
+
+        same = len(old) == len(new) and all(np.allclose(old[col].values, new[col].values) for col in old.columns)
+        print(f'{src}: {len(new)} records, consistent: {same}')
+        print(f'    python engine: {old_cost:.3f}s, {old.memory_usage(deep=True).sum() / 2 ** 20:.1f} MB')
+        print(f'    C reader:      {new_cost:.3f}s, {new.memory_usage(deep=True).sum() / 2 ** 20:.1f} MB')
+        print(f'    speed up:      {old_cost / new_cost:.1f}x')
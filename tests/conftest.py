@@ -0,0 +1,23 @@
+'''
+@Author: Yu Di
+@Date: 2019-12-16 10:05:12
+@LastEditors: Yudi
+@LastEditTime: 2019-12-16 10:05:12
+@Company: Cardinal Operation
+@Email: yudi@shanshu.ai
+@Description: make util importable when pytest runs from any folder
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+try:
+    import pyximport
+except ImportError:
+    pass
+else:
+    # compiles util/*.pyx on import when the extensions were not built with setup.py build_ext --inplace
+    pyximport.install(setup_args={'include_dirs': np.get_include()}, language_level=3)
@@ -0,0 +1,75 @@
+'''
+@Author: Yu Di
+@Date: 2019-12-16 14:02:19
+@LastEditors: Yudi
+@LastEditTime: 2019-12-16 15:37:50
+@Company: Cardinal Operation
+@Email: yudi@shanshu.ai
+@Description: batch KNNWithMeans predictions against predict of single pairs
+'''
+import numpy as np
+import pandas as pd
+import pytest
+
+from util.knns import KNNWithMeans
+
+USER_NUM, ITEM_NUM = 30, 25
+
+def train_frame(seed):
+    '''integer ratings so similarities tie often; the last user and the last 5 items have no ratings'''
+    rng = np.random.default_rng(seed)
+    pairs = np.unique(np.column_stack([rng.integers(0, USER_NUM - 1, 250), rng.integers(0, ITEM_NUM - 5, 250)]), 
+                      axis=0)
+    rng.shuffle(pairs)
+
+    return pd.DataFrame({'user': pairs[:, 0], 'item': pairs[:, 1], 
+                         'rating': rng.integers(1, 6, len(pairs)).astype(np.float32)})
+
+def fit(seed, user_based, name, k, min_k, max_neighbors):
+    sim_options = {'name': name, 'user_based': user_based}
+    algo = KNNWithMeans(USER_NUM, ITEM_NUM, k, min_k, sim_options=sim_options, max_neighbors=max_neighbors)
+
+    return algo.fit(train_frame(seed))
+
+CASES = [(seed, user_based, name, k, min_k, max_neighbors) 
+         for seed in [0, 1]
+         for user_based in [True, False]
+         for name in ['cosine', 'pearson', 'jaccard']
+         for k, min_k, max_neighbors in [(3, 1, None), (3, 3, None), (40, 2, None), (3, 2, 5)]]
+
+@pytest.mark.parametrize('seed, user_based, name, k, min_k, max_neighbors', CASES)
+def test_predict_many_matches_predict(seed, user_based, name, k, min_k, max_neighbors):
+    algo = fit(seed, user_based, name, k, min_k, max_neighbors)
+    items = np.arange(ITEM_NUM)
+    for u in range(USER_NUM):
+        est, details = algo.predict_many(u, items)
+        expect = [algo.predict(u, i) for i in items]
+
+        np.testing.assert_allclose(est, [e for e, _ in expect], rtol=1e-12, atol=1e-12)
+        np.testing.assert_array_equal(details['actual_k'], [d['actual_k'] for _, d in expect])
+
+@pytest.mark.parametrize('seed, user_based, name, k, min_k, max_neighbors', CASES)
+def test_score_batch_matches_predict(seed, user_based, name, k, min_k, max_neighbors):
+    algo = fit(seed, user_based, name, k, min_k, max_neighbors)
+    users, items = np.meshgrid(np.arange(USER_NUM), np.arange(ITEM_NUM), indexing='ij')
+    expect = np.array([[algo.predict(u, i)[0] for i in range(ITEM_NUM)] for u in range(USER_NUM)])
+
+    np.testing.assert_allclose(algo.score_batch(users, items), expect, rtol=1e-12, atol=1e-12)
+    # candidate matrix layout of evaluation: one user per row
+    np.testing.assert_allclose(algo.score_batch(np.arange(USER_NUM), items[:, ::-1]), expect[:, ::-1], 
+                               rtol=1e-12, atol=1e-12)
+
+def test_cases_cover_ties_and_cutoffs():
+    '''the fixtures above exercise ties on the k-th neighbor, min_k cut-offs and items nobody rated'''
+    algo = fit(0, True, 'jaccard', 3, 3, None)
+    assert algo.train_mat.item_degree()[-5:].sum() == 0
+    short = fit(0, True, 'pearson', 40, 2, None)
+    details = [short.predict(u, i)[1]['actual_k'] for u in range(USER_NUM) for i in range(ITEM_NUM - 5)]
+    assert sum(a == 1 for a in details) > 0
+
+    ties = 0
+    for i in range(ITEM_NUM - 5):
+        for u in range(USER_NUM):
+            sims = np.sort(algo.sims([u], algo.train_mat.item_users(i))[0])[::-1]
+            ties += len(sims) > 3 and sims[2] == sims[3]
+    assert ties > 0
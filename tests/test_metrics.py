@@ -0,0 +1,71 @@
+'''
+@Author: Yu Di
+@Date: 2019-12-16 10:11:43
+@LastEditors: Yudi
+@LastEditTime: 2019-12-16 11:20:37
+@Company: Cardinal Operation
+@Email: yudi@shanshu.ai
+@Description: rank_metrics against the per-user metric functions it replaces
+'''
+import numpy as np
+import pytest
+
+from util.metrics import precision_at_k, recall_at_k, map_at_k, ndcg_at_k, hr_at_k, mrr_at_k, \
+    metric_sums, merge_metric_sums, rank_metrics
+
+def per_user_metrics(rel, truth_len):
+    '''the six KPIs as the scripts computed them from {user: relevance list} before rank_metrics'''
+    k = rel.shape[1]
+    preds = {u: row.tolist() for u, row in enumerate(rel)}
+    test_ur = {u: list(range(n)) for u, n in enumerate(truth_len)}
+
+    return {'precision': np.mean([precision_at_k(r, k) for r in preds.values()]), 
+            'recall': np.mean([recall_at_k(r, len(test_ur[u]), k) for u, r in preds.items()]), 
+            'map': map_at_k(list(preds.values())), 
+            'ndcg': np.mean([ndcg_at_k(r, k) for r in preds.values()]), 
+            'hr': hr_at_k(list(preds.values()), list(preds.keys()), test_ur), 
+            'mrr': mrr_at_k(list(preds.values()))}
+
+def random_case(seed, n_users=60, k=10, dtype=np.uint8):
+    rng = np.random.default_rng(seed)
+    rel = (rng.random((n_users, k)) < rng.uniform(0, .6)).astype(dtype)
+    # rows without any hit, and users without ground truth whose rows carry no hit either
+    rel[rng.random(n_users) < .2] = 0
+    truth_len = (rel != 0).sum(axis=1) + rng.integers(0, 5, n_users)
+    empty = ~rel.any(axis=1) & (rng.random(n_users) < .5)
+    truth_len[empty] = 0
+    truth_len[0] = max(truth_len[0], 1)
+
+    return rel, truth_len
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('dtype', [np.uint8, bool, np.int64])
+def test_rank_metrics_match_per_user_functions(seed, dtype):
+    rel, truth_len = random_case(seed, k=int(np.random.default_rng(seed).integers(1, 21)), dtype=dtype)
+    expect = per_user_metrics(rel, truth_len)
+    got = rank_metrics(rel, truth_len)
+
+    assert set(got) == set(expect)
+    for key in expect:
+        assert got[key] == pytest.approx(expect[key], rel=1e-12, abs=1e-12), key
+
+def test_all_zero_relevance():
+    rel, truth_len = np.zeros((5, 10), dtype=np.uint8), np.array([0, 1, 2, 0, 3])
+    got = rank_metrics(rel, truth_len)
+
+    assert got == pytest.approx(per_user_metrics(rel, truth_len))
+    assert all(v == 0 for v in got.values())
+
+def test_zero_truth_length_gives_zero_recall():
+    rel, truth_len = np.array([[1, 0, 1], [0, 0, 0]], dtype=np.uint8), np.array([2, 0])
+    got = rank_metrics(rel, truth_len)
+
+    assert got['recall'] == pytest.approx((2 / 2 + 0) / 2)
+    assert got['hr'] == pytest.approx(2 / 2)
+
+def test_shard_sums_add_up():
+    rel, truth_len = random_case(7, n_users=100)
+    cuts = [0, 13, 14, 60, 100]
+    sums = [metric_sums(rel[a:b], truth_len[a:b]) for a, b in zip(cuts[:-1], cuts[1:])]
+
+    assert merge_metric_sums(sums) == pytest.approx(rank_metrics(rel, truth_len))
@@ -0,0 +1,98 @@
+'''
+@Author: Yu Di
+@Date: 2019-12-17 09:48:05
+@LastEditors: Yudi
+@LastEditTime: 2019-12-17 11:12:36
+@Company: Cardinal Operation
+@Email: yudi@shanshu.ai
+@Description: sparse similarity measures against the dense triple loop they replace
+'''
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+from util.interactions import InteractionMatrix
+from util.similarities import cosine, pearson, jaccard, blocked_similarity
+
+N_X, N_Y = 23, 17
+
+def ratings(seed):
+    '''
+    (x, y, r) entries with repeated (x, y) pairs, an x whose ratings are all equal (zero variance for pearson) 
+    and an x without ratings
+    '''
+    rng = np.random.default_rng(seed)
+    x, y = rng.integers(0, N_X - 1, 150), rng.integers(0, N_Y, 150)
+    r = rng.integers(1, 6, 150).astype(np.float64)
+    x, y, r = np.r_[x, x[:10]], np.r_[y, y[:10]], np.r_[r, rng.integers(1, 6, 10)]
+    r[x == 0] = 3.
+
+    return x, y, r
+
+def reference(name, x, y, r, min_support):
+    '''the dense loops over the raters of every y, as similarities.pyx computed them before the sparse rewrite'''
+    yr, xs = defaultdict(list), defaultdict(set)
+    for xi, yi, ri in zip(x.tolist(), y.tolist(), r.tolist()):
+        yr[yi].append((xi, ri))
+        xs[xi].add(yi)
+
+    freq = np.zeros((N_X, N_X))
+    prods, sqi, sqj = np.zeros((N_X, N_X)), np.zeros((N_X, N_X)), np.zeros((N_X, N_X))
+    si, sj = np.zeros((N_X, N_X)), np.zeros((N_X, N_X))
+    for y_ratings in yr.values():
+        for xi, ri in y_ratings:
+            for xj, rj in y_ratings:
+                freq[xi, xj] += 1
+                prods[xi, xj] += ri * rj
+                sqi[xi, xj] += ri ** 2
+                sqj[xi, xj] += rj ** 2
+                si[xi, xj] += ri
+                sj[xi, xj] += rj
+
+    sim = np.eye(N_X)
+    for xi in range(N_X):
+        for xj in range(xi + 1, N_X):
+            if freq[xi, xj] < min_support:
+                continue
+            if name == 'jaccard':
+                sim[xi, xj] = len(xs[xi] & xs[xj]) / len(xs[xi] | xs[xj])
+            elif name == 'cosine':
+                sim[xi, xj] = prods[xi, xj] / np.sqrt(sqi[xi, xj] * sqj[xi, xj])
+            else:
+                n = freq[xi, xj]
+                num = n * prods[xi, xj] - si[xi, xj] * sj[xi, xj]
+                denum = np.sqrt((n * sqi[xi, xj] - si[xi, xj] ** 2) * (n * sqj[xi, xj] - sj[xi, xj] ** 2))
+                sim[xi, xj] = 0 if denum == 0 else num / denum
+            sim[xj, xi] = sim[xi, xj]
+
+    return sim
+
+MEASURES = {'cosine': cosine, 'pearson': pearson, 'jaccard': jaccard}
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('name', ['cosine', 'pearson', 'jaccard'])
+@pytest.mark.parametrize('min_support', [1, 2, 3])
+def test_measures_match_dense_loops(seed, name, min_support):
+    x, y, r = ratings(seed)
+    # rows of the CSR keep repeated (x, y) entries, as knns passes the training interactions
+    mat = InteractionMatrix(x, y, N_X, N_Y, r).to_csr()
+    assert mat.nnz == len(x)
+    expect = reference(name, x, y, r, min_support)
+
+    for n_jobs in [1, 2]:
+        sim = MEASURES[name](mat, min_support, n_jobs)
+        np.testing.assert_allclose(sim.toarray(), expect, rtol=1e-10, atol=1e-12)
+        # pairs below min_support are left out of the structure, the diagonal is always stored
+        assert (sim.diagonal() == 1).all()
+
+    for block_size, spill, n_jobs in [(5, True, 1), (7, False, 2), (1024, False, 1)]:
+        sim = blocked_similarity(name, mat, min_support, block_size, None, None, n_jobs, spill)
+        np.testing.assert_allclose(sim.toarray(), expect, rtol=1e-10, atol=1e-12)
+
+def test_zero_variance_rows_have_no_pearson_neighbors():
+    x, y, r = ratings(0)
+    sim = pearson(InteractionMatrix(x, y, N_X, N_Y, r).to_csr(), 1)
+
+    assert sim[0].nnz == 1 and sim[0, 0] == 1
+    assert sim[N_X - 1].nnz == 1
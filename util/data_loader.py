@@ -7,58 +7,409 @@
 @Email: yudi@shanshu.ai
 @Description: data utils
 '''
+import io
 import os
+import re
 import gc
 import json
+import shutil
 import pickle
 import random
+import hashlib
 from collections import defaultdict
 from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
-import scipy.sparse as sp
 import scipy.io as sio
-from sklearn.model_selection import train_test_split, KFold
 
 import torch
 import torch.utils.data as data
+
+from util.interactions import InteractionMatrix
+from util.sampler import eval_candidates, user_negatives
+from util.splitter import test_split_index, validation_split_index, take_split
 ########################################################################################################
-def load_rate(src='ml-100k', prepro='origin'):
+# raw files every dataset is parsed from, their size/mtime decide whether a cached table is stale
+_RAW_FILES = {
+    'ml-100k': ['u.data'],
+    'ml-1m': ['ratings.dat'],
+    'ml-10m': ['ratings.dat'],
+    'ml-20m': ['ratings.csv'],
+    'netflix': ['training_set'],
+    'lastfm': ['user_artists.dat'],
+    'bx': ['BX-Book-Ratings.csv'],
+    'amazon-cloth': ['ratings_Clothing_Shoes_and_Jewelry.csv'],
+    'amazon-electronic': ['ratings_Electronics.csv'],
+    'amazon-book': ['ratings_Books.csv'],
+    'amazon-music': ['ratings_Digital_Music.csv'],
+    'epinions': ['rating_with_timestamp.mat'],
+    'yelp': ['yelp_academic_dataset_review.json'],
+    'citeulike': ['users.dat'],
+}
+# bump it whenever parsing or preprocessing changes, so that old caches are rebuilt
+_CACHE_VERSION = 2
+_CACHE_DTYPES = {'user': np.int32, 'item': np.int32, 'rating': np.float32, 'timestamp': np.int64}
+
+def _cache_dir(src, prepro):
+    '''
+    cache folder of certain dataset, named by prepro and a key of raw files' size and mtime
+    '''
+    key = hashlib.md5(f'{src}|{prepro}|{_CACHE_VERSION}'.encode())
+    for f in _RAW_FILES.get(src, []):
+        stat = os.stat(f'./data/{src}/{f}')
+        key.update(f'|{f}|{stat.st_size}|{stat.st_mtime_ns}'.encode())
+
+    return f'./data/{src}/cache/{prepro}_{key.hexdigest()[:16]}'
+
+def _read_cache(cache_dir):
+    with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    df = pd.DataFrame({col: np.load(os.path.join(cache_dir, f'{col}.npy'), mmap_mode='r') 
+                       for col in meta['columns']})
+
+    return df
+
+def _encode(df):
+    '''
+    typed columns of the parsed table: int32 0-based user/item codes, float32 rating, int64 timestamp
+    '''
+    df = df.reset_index(drop=True)
+    columns = [col for col in _CACHE_DTYPES.keys() if col in df.columns]
+    for col in ['user', 'item']:
+        df[col] = pd.Categorical(df[col]).codes
+    if 'timestamp' in columns and np.issubdtype(df['timestamp'].dtype, np.datetime64):
+        # datetime timestamps are kept as unix seconds
+        df['timestamp'] = df['timestamp'].values.astype('datetime64[s]')
+
+    return pd.DataFrame({col: df[col].values.astype(_CACHE_DTYPES[col]) for col in columns})
+
+def _write_cache(df, cache_dir):
+    '''store the encoded table as one .npy file per column'''
+    # write into a temporary folder first, so that an interrupted run never leaves a broken cache
+    tmp_dir = f'{cache_dir}.tmp{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    for col in df.columns:
+        np.save(os.path.join(tmp_dir, f'{col}.npy'), df[col].values)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'columns': list(df.columns), 'rows': len(df)}, f)
+
+    # remove published caches of same prepro type under other keys, together with the splits made from them;
+    # temporary folders of concurrent runs and splits of other caches are left alone
+    root, name = os.path.split(cache_dir)
+    stale = re.compile(re.escape(name.split('_')[0]) + r'_[0-9a-f]{16}')
+    for old in os.listdir(root):
+        if stale.fullmatch(old) and old != name:
+            shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+            shutil.rmtree(os.path.join(root, 'split', old), ignore_errors=True)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # another run stored the same cache meanwhile
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def load_rate(src='ml-100k', prepro='origin', cache=True, n_jobs=None):
+    '''
+    load interaction records of certain dataset with 0-based int32 user/item codes, parsed and filtered table 
+    is cached under ./data/{src}/cache/ and later runs memory-map the cached columns instead of parsing raw files 
+    again, set cache=False to disable
+    n_jobs: number of worker processes for datasets parsed in parallel (netflix, yelp), None for all cores
+    '''
+    _kcore_thresholds(prepro)
+    if cache:
+        cache_dir = _cache_dir(src, prepro)
+        if os.path.exists(os.path.join(cache_dir, 'meta.json')):
+            return _read_cache(cache_dir)
+
+    df = _parse_rate(src, n_jobs)
+    df = _encode(_filter_rate(df, prepro))
+    if cache:
+        _write_cache(df, cache_dir)
+
+    return df
+
+def _split_dir(src, prepro, data_split, by_time, test_size, val_method, fold_num, seed):
+    '''split folder lives beside the rate cache it indexes into, so it is dropped with a stale rate cache'''
+    root, name = os.path.split(_cache_dir(src, prepro))
+
+    return os.path.join(root, 'split', name, f'{data_split}-{by_time}-{test_size}-{val_method}-{fold_num}-{seed}')
+
+def _read_split(split_dir):
+    with open(os.path.join(split_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    load = lambda name: np.load(os.path.join(split_dir, f'{name}.npy'), mmap_mode='r')
+    folds = [(load(f'fold{k}_train'), load(f'fold{k}_val')) for k in range(meta['folds'])]
+
+    return load('train'), load('test'), folds
+
+def _write_split(split_dir, train_idx, test_idx, folds):
+    tmp_dir = f'{split_dir}.tmp{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    arrays = {'train': train_idx, 'test': test_idx}
+    for k, (fold_train, fold_val) in enumerate(folds):
+        arrays[f'fold{k}_train'], arrays[f'fold{k}_val'] = fold_train, fold_val
+    for name, idx in arrays.items():
+        np.save(os.path.join(tmp_dir, f'{name}.npy'), idx.astype(np.int32))
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'folds': len(folds), 'train': len(train_idx), 'test': len(test_idx)}, f)
+    try:
+        os.rename(tmp_dir, split_dir)
+    except OSError:
+        # another run stored the same split meanwhile
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def load_split(src='ml-100k', prepro='origin', data_split='fo', by_time=0, val_method='cv', fold_num=5, 
+               seed=2019, test_size=.2, cache=True):
+    '''
+    load interaction records with their train/validation/test split. Split index arrays are stored under 
+    ./data/{src}/cache/split/ keyed by dataset, prepro, split settings and seed, so every recommender run 
+    with the same settings memory-maps one shared split instead of drawing its own; seed=None disables it
+    
+    returns df, train_idx, test_idx, folds, split_dir
+    df: load_rate table, user and item are already int32 0-based codes
+    train_idx, test_idx: row positions of df
+    folds: list of (train_idx, val_idx), row positions of df.iloc[train_idx]
+    split_dir: folder for further artifacts of this split (see split_artifact), None if not persisted
+    '''
+    df = load_rate(src, prepro, cache)
+
+    split_dir = _split_dir(src, prepro, data_split, by_time, test_size, val_method, fold_num, seed) \
+        if cache and seed is not None else None
+    if split_dir is not None and os.path.exists(os.path.join(split_dir, 'meta.json')):
+        train_idx, test_idx, folds = _read_split(split_dir)
+        return df, train_idx, test_idx, folds, split_dir
+
+    rng = np.random.default_rng(seed)
+    train_idx, test_idx = test_split_index(df, data_split, by_time, test_size, rng)
+    folds = validation_split_index(df.iloc[train_idx], val_method, fold_num, seed=rng)
+    if split_dir is not None:
+        _write_split(split_dir, train_idx, test_idx, folds)
+        train_idx, test_idx, folds = _read_split(split_dir)
+
+    return df, train_idx, test_idx, folds, split_dir
+
+def split_artifact(split_dir, name, build):
+    '''
+    array derived from a split (e.g. sampled evaluation candidates), build() runs only when it is not stored 
+    under split_dir yet; later calls memory-map the stored array. split_dir=None always calls build()
+    '''
+    if split_dir is None:
+        return build()
+    path = os.path.join(split_dir, f'{name}.npy')
+    if not os.path.exists(path):
+        tmp_path = f'{path}.tmp{os.getpid()}.npy'
+        np.save(tmp_path, build())
+        os.replace(tmp_path, path)
+
+    return np.load(path, mmap_mode='r')
+
+_MOVIELENS_DTYPES = {'user': np.int32, 'item': np.int32, 'rating': np.float32, 'timestamp': np.int64}
+
+def _read_movielens(path, sep='::', block_size=1 << 26):
+    '''
+    read movielens `user sep item sep rating sep timestamp` file with pandas C parser,
+    the two-character `::` is not supported by C engine, so every block of bytes is 
+    rewritten to a single tab before parsing
+    '''
+    names = list(_MOVIELENS_DTYPES.keys())
+    blocks, rest = [], b''
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(block_size)
+            if not buf:
+                break
+            buf = rest + buf
+            # keep the unfinished last line for next block
+            cut = buf.rfind(b'\n') + 1
+            buf, rest = buf[:cut], buf[cut:]
+            if buf:
+                blocks.append(_parse_movielens_block(buf, sep, names))
+    if rest.strip():
+        blocks.append(_parse_movielens_block(rest, sep, names))
+    if not blocks:
+        return pd.DataFrame({col: np.array([], dtype=dtype) for col, dtype in _MOVIELENS_DTYPES.items()})
+
+    return pd.concat(blocks, ignore_index=True)
+
+def _parse_movielens_block(buf, sep, names):
+    if len(sep) > 1:
+        buf = buf.replace(sep.encode(), b'\t')
+        sep = '\t'
+
+    return pd.read_csv(io.BytesIO(buf), sep=sep, header=None, names=names, usecols=range(len(names)), 
+                       dtype=_MOVIELENS_DTYPES, engine='c')
+
+def _count_netflix_rows(path):
+    '''number of rating rows in one netflix movie file, the first line is movie id'''
+    with open(path, 'rb') as f:
+        buf = f.read()
+    cnt = buf.count(b'\n')
+    if buf and not buf.endswith(b'\n'):
+        cnt += 1
+
+    return cnt - 1
+
+def _read_netflix_file(path):
+    with open(path, 'rb') as f:
+        item = int(f.readline().split(b':')[0])
+        block = pd.read_csv(f, header=None, names=['user', 'rating', 'timestamp'], engine='c', 
+                            dtype={'user': np.int32, 'rating': np.float32, 'timestamp': str})
+    timestamp = pd.to_datetime(block['timestamp'], format='%Y-%m-%d').values
+    timestamp = timestamp.astype('datetime64[s]').astype(np.int64)
+
+    return item, block['user'].values, block['rating'].values, timestamp
+
+def _load_netflix(src, n_jobs=None):
+    '''
+    parse netflix prize training_set/ file by file into preallocated column buffers, 
+    a first pass counts rows of each file so the 100M ratings never live in python objects
+    '''
+    folder = f'./data/{src}/training_set/'
+    paths = [os.path.join(folder, f) for f in sorted(os.listdir(folder))]
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+
+    executor = ProcessPoolExecutor(n_jobs) if n_jobs > 1 else None
+    mapper = (lambda func, it: executor.map(func, it, chunksize=64)) if executor else map
+    try:
+        counts = np.fromiter(mapper(_count_netflix_rows, paths), dtype=np.int64, count=len(paths))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        print(f'{offsets[-1]} ratings found in {len(paths)} files')
+
+        user = np.empty(offsets[-1], dtype=np.int32)
+        item = np.empty(offsets[-1], dtype=np.int32)
+        rating = np.empty(offsets[-1], dtype=np.float32)
+        timestamp = np.empty(offsets[-1], dtype=np.int64)
+        for cnt, (i, u, r, t) in enumerate(mapper(_read_netflix_file, paths)):
+            start, end = offsets[cnt], offsets[cnt + 1]
+            item[start:end] = i
+            user[start:end] = u
+            rating[start:end] = r
+            timestamp[start:end] = t
+            if not (cnt + 1) % 5000:
+                print(f'Finish Process {cnt + 1} file......')
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return pd.DataFrame({'user': user, 'item': item, 'rating': rating, 'timestamp': timestamp})
+
+# only these four fields of a yelp review are needed, JSON strings escape inner quotes, 
+# so a key pattern never matches the review text
+_YELP_FIELDS = [
+    ('user_id', re.compile(rb'"user_id"\s*:\s*"([^"]*)"')),
+    ('business_id', re.compile(rb'"business_id"\s*:\s*"([^"]*)"')),
+    ('stars', re.compile(rb'"stars"\s*:\s*([-+.0-9eE]+)')),
+    ('date', re.compile(rb'"date"\s*:\s*"([^"]*)"')),
+]
+
+def _parse_yelp_line(line):
+    vals = []
+    for _, pattern in _YELP_FIELDS:
+        res = pattern.search(line)
+        if res is None:
+            # unexpected layout, fall back to a full decode of this line
+            val = json.loads(line)
+            return [str(val[key]).encode('utf-8') for key, _ in _YELP_FIELDS]
+        vals.append(res.group(1))
+
+    return vals
+
+def _read_yelp_shard(path, start, end, chunk_size=500000):
+    '''
+    parse reviews starting in byte range [start, end) of yelp review file,
+    string ids are encoded to shard-local int32 codes on the fly
+    '''
+    user_vocab, item_vocab = {}, {}
+    users, items, stars, dates = [], [], [], []
+    user_codes, item_codes, ratings, timestamps = [], [], [], []
+
+    def flush():
+        user_codes.append(np.array(users, dtype=np.int32))
+        item_codes.append(np.array(items, dtype=np.int32))
+        ratings.append(np.array(stars, dtype=np.float32))
+        timestamps.append(pd.to_datetime(pd.Series(dates, dtype=str)).values.astype('datetime64[s]').astype(np.int64))
+        del users[:], items[:], stars[:], dates[:]
+
+    with open(path, 'rb') as f:
+        # a line belongs to the shard where it starts
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            if not line.strip():
+                continue
+            user, item, star, date = _parse_yelp_line(line)
+            users.append(user_vocab.setdefault(user, len(user_vocab)))
+            items.append(item_vocab.setdefault(item, len(item_vocab)))
+            stars.append(float(star))
+            dates.append(date.decode('utf-8'))
+            if len(users) >= chunk_size:
+                flush()
+    flush()
+
+    return (list(user_vocab.keys()), list(item_vocab.keys()), np.concatenate(user_codes), 
+            np.concatenate(item_codes), np.concatenate(ratings), np.concatenate(timestamps))
+
+def _merge_vocab(shard_vocabs):
+    '''map each shard-local code to the global code, global codes follow the first appearance order'''
+    sizes = [len(v) for v in shard_vocabs]
+    codes, _ = pd.factorize(np.array([x for v in shard_vocabs for x in v], dtype=object))
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+
+    return [codes[offsets[i]:offsets[i + 1]].astype(np.int32) for i in range(len(shard_vocabs))]
+
+def _load_yelp(src, n_jobs=None):
+    '''
+    parse yelp reviews in byte-range shards across worker processes, 
+    only user_id, business_id, stars and date are extracted
+    '''
+    path = f'./data/{src}/yelp_academic_dataset_review.json'
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+    file_size = os.path.getsize(path)
+    shard_num = max(1, n_jobs * 4)
+    bounds = [file_size * i // shard_num for i in range(shard_num + 1)]
+    starts, ends = bounds[:-1], bounds[1:]
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(n_jobs) as executor:
+            shards = list(executor.map(_read_yelp_shard, [path] * shard_num, starts, ends))
+    else:
+        shards = list(map(_read_yelp_shard, [path] * shard_num, starts, ends))
+
+    user_maps = _merge_vocab([shard[0] for shard in shards])
+    item_maps = _merge_vocab([shard[1] for shard in shards])
+    df = pd.DataFrame({
+        'user': np.concatenate([user_maps[i][shard[2]] for i, shard in enumerate(shards)]),
+        'item': np.concatenate([item_maps[i][shard[3]] for i, shard in enumerate(shards)]),
+        'rating': np.concatenate([shard[4] for shard in shards]),
+        'timestamp': np.concatenate([shard[5] for shard in shards])
+    })
+    print(f'Finish Process {len(df)} reviews from {shard_num} shards......')
+
+    return df
+
+def _parse_rate(src, n_jobs=None):
     if src == 'ml-100k':
-        df = pd.read_csv(f'./data/{src}/u.data', sep='\t', header=None, 
-                        names=['user', 'item', 'rating', 'timestamp'], engine='python')
+        df = _read_movielens(f'./data/{src}/u.data', sep='\t')
     elif src == 'ml-1m':
-        df = pd.read_csv(f'./data/{src}/ratings.dat', sep='::', header=None, 
-                        names=['user', 'item', 'rating', 'timestamp'], engine='python')
+        df = _read_movielens(f'./data/{src}/ratings.dat', sep='::')
         # only consider rating >=4 for data density
         df = df.query('rating >= 4').reset_index(drop=True).copy()
     elif src == 'ml-10m':
-        df = pd.read_csv(f'./data/{src}/ratings.dat', sep='::', header=None, 
-                         names=['user', 'item', 'rating', 'timestamp'], engine='python')
+        df = _read_movielens(f'./data/{src}/ratings.dat', sep='::')
         df = df.query('rating >= 4').reset_index(drop=True).copy()
     elif src == 'ml-20m':
         df = pd.read_csv(f'./data/{src}/ratings.csv')
         df.rename(columns={'userId':'user', 'movieId':'item'}, inplace=True)
         df = df.query('rating >= 4').reset_index(drop=True)
     elif src == 'netflix':
-        df = pd.DataFrame()
-        cnt = 0
-        for f in os.listdir(f'./data/{src}/training_set/'):
-            cnt += 1
-            if not cnt % 5000:
-                print(f'Finish Process {cnt} file......')
-            txt_file = open(f'./data/{src}/training_set/{f}', 'r')
-            contents = txt_file.readlines()
-            item = contents[0].strip().split(':')[0]
-            for val in contents[1:]:
-                user, rating, timestamp = val.strip().split(',')
-                tmp = pd.DataFrame([[user, item, rating, timestamp]], 
-                                   columns=['user', 'item', 'rating', 'timestamp'])
-                df.append(tmp, ignore_index=True)
-            txt_file.close()
-        df['rating'] = df.rating.astype(float)
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
+        df = _load_netflix(src, n_jobs)
     elif src == 'lastfm':
         # user_artists.dat
         df = pd.read_csv(f'./data/{src}/user_artists.dat', sep='\t')
@@ -93,15 +444,7 @@ def load_rate(src='ml-100k', prepro='origin'):
         del prime
         gc.collect()
     elif src == 'yelp':
-        json_file_path = f'./data/{src}/yelp_academic_dataset_review.json'
-        prime = []
-        for line in open(json_file_path, 'r', encoding='UTF-8'):
-            val = json.loads(line)
-            prime.append([val['user_id'], val['business_id'], val['stars'], val['date']])
-        df = pd.DataFrame(prime, columns=['user', 'item', 'rating', 'timestamp'])
-        df['timestamp'] = pd.to_datetime(df.timestamp)
-        del prime
-        gc.collect()
+        df = _load_yelp(src, n_jobs)
     elif src == 'citeulike':
         user = 0
         dt = []
@@ -116,41 +459,54 @@ def load_rate(src='ml-100k', prepro='origin'):
 
     df.sort_values(['user', 'item', 'timestamp'], inplace=True)
 
+    return df
+
+def _kcore_thresholds(prepro):
+    '''
+    prepro: origin, {k}core (e.g. 5core, 10core) or {user_k}-{item_k}core for separate thresholds
+    '''
     if prepro == 'origin':
+        return None
+    res = re.match(r'^(\d+)(?:-(\d+))?core$', prepro)
+    if res is None:
+        raise ValueError('Invalid dataset preprocess type, origin/5core/10core/{k}core/{user_k}-{item_k}core expected')
+    user_k = int(res.group(1))
+    item_k = int(res.group(2)) if res.group(2) else user_k
+
+    return user_k, item_k
+
+def filter_kcore(df, user_k=5, item_k=5):
+    '''
+    keep the k-core of interactions: every remaining user has at least user_k records and every 
+    remaining item has at least item_k records, removal repeats until nothing changes
+    '''
+    users = pd.factorize(df['user'])[0]
+    items = pd.factorize(df['item'])[0]
+    user_num, item_num = users.max() + 1 if len(df) else 0, items.max() + 1 if len(df) else 0
+
+    idx = np.arange(len(df))
+    while len(idx):
+        u, i = users[idx], items[idx]
+        mask = (np.bincount(u, minlength=user_num)[u] >= user_k) & (np.bincount(i, minlength=item_num)[i] >= item_k)
+        if mask.all():
+            break
+        idx = idx[mask]
+
+    return df.iloc[idx].reset_index(drop=True)
+
+def _filter_rate(df, prepro):
+    thresholds = _kcore_thresholds(prepro)
+    if thresholds is None:
         return df
-    elif prepro == '5core':
-        tmp1 = df.groupby(['user'], as_index=False)['item'].count()
-        tmp1.rename(columns={'item': 'cnt_item'}, inplace=True)
-        tmp2 = df.groupby(['item'], as_index=False)['user'].count()
-        tmp2.rename(columns={'user': 'cnt_user'}, inplace=True)
-        df = df.merge(tmp1, on=['user']).merge(tmp2, on=['item'])
-        df = df.query('cnt_item >= 5 and cnt_user >= 5').reset_index(drop=True).copy()
-        df.drop(['cnt_item', 'cnt_user'], axis=1, inplace=True)
-        del tmp1, tmp2
-        gc.collect()
+    df = filter_kcore(df, *thresholds)
+    gc.collect()
 
-        return df
-    elif prepro == '10core':
-        tmp1 = df.groupby(['user'], as_index=False)['item'].count()
-        tmp1.rename(columns={'item': 'cnt_item'}, inplace=True)
-        tmp2 = df.groupby(['item'], as_index=False)['user'].count()
-        tmp2.rename(columns={'user': 'cnt_user'}, inplace=True)
-        df = df.merge(tmp1, on=['user']).merge(tmp2, on=['item'])
-        df = df.query('cnt_item >= 10 and cnt_user >= 10').reset_index(drop=True).copy()
-        df.drop(['cnt_item', 'cnt_user'], axis=1, inplace=True)
-        del tmp1, tmp2
-        gc.collect()
-        
-        return df
-    else:
-        raise ValueError('Invalid dataset preprocess type, origin/5core/10core expected')
+    return df
 
 # BPR-FM prepare
-def load_bprfm(src='ml-100k', data_split='fo', by_time=0, val_method='cv', fold_num=5, prepro='origin'):
-    df = load_rate(src, prepro)
+def load_bprfm(src='ml-100k', data_split='fo', by_time=0, val_method='cv', fold_num=5, prepro='origin', seed=2019):
+    df, train_idx, test_idx, folds, _ = load_split(src, prepro, data_split, by_time, val_method, fold_num, seed)
 
-    df['user'] = pd.Categorical(df.user).codes
-    df['item'] = pd.Categorical(df.item).codes
     user_tag_info = df[['user']].copy()
     item_tag_info = df[['item']].copy()
     user_tag_info = user_tag_info.drop_duplicates()
@@ -173,110 +529,37 @@ def load_bprfm(src='ml-100k', data_split='fo', by_time=0, val_method='cv', fold_
         cnt += 1
     print(f'number of features: {cnt}')
 
-    if data_split == 'fo':
-        if by_time:
-            df = df.sample(frac=1)
-            df = df.sort_values(['timestamp']).reset_index(drop=True)
-            
-            split_idx = int(np.ceil(len(df) * 0.8)) # for train test
-            train, test = df.iloc[:split_idx, :].copy(), df.iloc[split_idx:, :].copy()
-        else:
-            train, test = train_test_split(df, test_size=0.2)
-    elif data_split == 'loo':
-        if by_time:
-            df = df.sample(frac=1)
-            df = df.sort_values(['timestamp']).reset_index(drop=True)
-            df['rank_latest'] = df.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-            train, test = df[df['rank_latest'] > 1].copy(), df[df['rank_latest'] == 1].copy()
-            train.drop(['rank_latest'], axis=1, inplace=True)
-            test.drop(['rank_latest'], axis=1, inplace=True)
-        else:
-            test = df.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-            test_key = test[['user', 'item']].copy()
-            train = df.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(test_key)).reset_index().copy()
-    else:
-        raise ValueError('Invalid data_split value, expect: loo, fo')
-
-    test = test.reset_index(drop=True)
+    train, test, train_list, val_list = take_split(df, train_idx, test_idx, folds)
     test.drop(['timestamp'], axis=1, inplace=True)
-
-    train_list, val_list = [], []
-    if val_method == 'cv':
-        kf = KFold(n_splits=fold_num, shuffle=False, random_state=2019)
-        for train_index, val_index in kf.split(train):
-            train_set, val_set = train.iloc[train_index, :].copy(), train.iloc[val_index, :].copy()
-            del train_set['timestamp'], val_set['timestamp']
-
-            train_list.append(train_set)
-            val_list.append(val_set)
-    elif val_method == 'loo':
-        val_set = train.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-        val_key = val_set[['user', 'item']].copy()
-        train_set = train.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(val_key)).reset_index().copy()
-        del train_set['timestamp'], val_set['timestamp']
-
-        train_list.append(train_set)
-        val_list.append(val_set)
-    elif val_method == 'tloo':
-        train = train.sample(frac=1)
-        train = train.sort_values(['timestamp']).reset_index(drop=True)
-
-        train['rank_latest'] = train.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-        train_set = train[train['rank_latest'] > 1].copy()
-        val_set = train[train['rank_latest'] == 1].copy()
-        del train_set['rank_latest'], val_set['rank_latest']
+    for train_set, val_set in zip(train_list, val_list):
         del train_set['timestamp'], val_set['timestamp']
-
-        train_list.append(train_set)
-        val_list.append(val_set)
-    elif val_method == 'tfo':
-        train = train.sample(frac=1)
-        train = train.sort_values(['timestamp']).reset_index(drop=True)
-
-        split_idx = int(np.ceil(len(train) * 0.9))
-        train_set, val_set = train.iloc[:split_idx, :].copy(), train.iloc[split_idx:, :].copy()
-        del train_set['timestamp'], val_set['timestamp']
-
-        train_list.append(train_set)
-        val_list.append(val_set)
-    else:
-        raise ValueError('Invalid val_method value, expect: cv, loo, tloo, tfo')
     
     test_user_set, test_item_set = test['user'].unique().tolist(), test['item'].unique().tolist()
-    ui = test[['user', 'item']].copy()
-    u_is = defaultdict(list)
-    for u in test_user_set:
-        u_is[u] = ui.loc[ui.user==u, 'item'].values.tolist()
+    u_is = defaultdict(list, test.groupby('user', sort=False)['item'].agg(list).to_dict())
 
     gc.collect()
     
     return features_map, train_list, val_list, feat_idx_dict, user_tag_info, item_tag_info, test_user_set, test_item_set, u_is
 
 # NeuFM/FM prepare
-def load_libfm(src='ml-100k', data_split='fo', by_time=0, val_method='cv', fold_num=5, prepro='origin'):
-    df = load_rate(src, prepro)
+def load_libfm(src='ml-100k', data_split='fo', by_time=0, val_method='cv', fold_num=5, prepro='origin', seed=2019):
+    df, train_idx, test_idx, folds, _ = load_split(src, prepro, data_split, by_time, val_method, fold_num, seed)
 
     if src == 'ml-100k':
         # rating >=4 interaction =1
         df['rating'] = df.rating.agg(lambda x: 1 if x >= 4 else -1).astype(float)
 
-        df['user'] = pd.Categorical(df.user).codes
-        df['item'] = pd.Categorical(df.item).codes
         user_tag_info = df[['user']].copy()
         item_tag_info = df[['item']].copy()
         user_tag_info = user_tag_info.drop_duplicates()
         item_tag_info = item_tag_info.drop_duplicates()
     elif src == 'bx':
         df['rating'] = df.rating.agg(lambda x: 1 if x >= 5 else -1).astype(float)
-        df['user'] = pd.Categorical(df.user).codes
-        df['item'] = pd.Categorical(df.item).codes
         user_tag_info = df[['user']].copy()
         item_tag_info = df[['item']].copy()
         user_tag_info = user_tag_info.drop_duplicates()
         item_tag_info = item_tag_info.drop_duplicates()
     else:
-        df['user'] = pd.Categorical(df.user).codes
-        df['item'] = pd.Categorical(df.item).codes
         user_tag_info = df[['user']].copy()
         item_tag_info = df[['item']].copy()
         user_tag_info = user_tag_info.drop_duplicates()
@@ -290,84 +573,17 @@ def load_libfm(src='ml-100k', data_split='fo', by_time=0, val_method='cv', fold_
             idx = idx + df[col].max() + 1
     print('Finish build category index dictionary......')
 
-    if data_split == 'fo':
-        if by_time:
-            df = df.sample(frac=1)
-            df = df.sort_values(['timestamp']).reset_index(drop=True)
-            
-            split_idx = int(np.ceil(len(df) * 0.8)) # for train test
-            train, test = df.iloc[:split_idx, :].copy(), df.iloc[split_idx:, :].copy()
-        else:
-            train, test = train_test_split(df, test_size=0.2)
-    elif data_split == 'loo':
-        if by_time:
-            df = df.sample(frac=1)
-            df = df.sort_values(['timestamp']).reset_index(drop=True)
-            df['rank_latest'] = df.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-            train, test = df[df['rank_latest'] > 1].copy(), df[df['rank_latest'] == 1].copy()
-            train.drop(['rank_latest'], axis=1, inplace=True)
-            test.drop(['rank_latest'], axis=1, inplace=True)
-        else:
-            test = df.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-            test_key = test[['user', 'item']].copy()
-            train = df.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(test_key)).reset_index().copy()
-    else:
-        raise ValueError('Invalid data_split value, expect: loo, fo')
-
-    test = test.reset_index(drop=True)
+    train, test, train_list, val_list = take_split(df, train_idx, test_idx, folds)
     test.drop(['timestamp'], axis=1, inplace=True)
 
-    train_ur = defaultdict(set)
-    for _, row in train.iterrows():
-        train_ur[int(row['user'])].add(int(row['item']))
-
-    train_list, val_list = [], []
-    if val_method == 'cv':
-        kf = KFold(n_splits=fold_num, shuffle=False, random_state=2019)
-        for train_index, val_index in kf.split(train):
-            train_set, val_set = train.iloc[train_index, :].copy(), train.iloc[val_index, :].copy()
-            del train_set['timestamp'], val_set['timestamp']
-
-            train_list.append(train_set)
-            val_list.append(val_set)
-    elif val_method == 'loo':
-        val_set = train.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-        val_key = val_set[['user', 'item']].copy()
-        train_set = train.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(val_key)).reset_index().copy()
-        del train_set['timestamp'], val_set['timestamp']
-
-        train_list.append(train_set)
-        val_list.append(val_set)
-    elif val_method == 'tloo':
-        train = train.sample(frac=1)
-        train = train.sort_values(['timestamp']).reset_index(drop=True)
+    # train_ur[u] gives a view on the sorted train items of user u
+    train_ur = InteractionMatrix.from_frame(train, df['user'].max() + 1, df['item'].max() + 1)
 
-        train['rank_latest'] = train.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-        train_set = train[train['rank_latest'] > 1].copy()
-        val_set = train[train['rank_latest'] == 1].copy()
-        del train_set['rank_latest'], val_set['rank_latest']
+    for train_set, val_set in zip(train_list, val_list):
         del train_set['timestamp'], val_set['timestamp']
 
-        train_list.append(train_set)
-        val_list.append(val_set)
-    elif val_method == 'tfo':
-        train = train.sample(frac=1)
-        train = train.sort_values(['timestamp']).reset_index(drop=True)
-
-        split_idx = int(np.ceil(len(train) * 0.9))
-        train_set, val_set = train.iloc[:split_idx, :].copy(), train.iloc[split_idx:, :].copy()
-        del train_set['timestamp'], val_set['timestamp']
-
-        train_list.append(train_set)
-        val_list.append(val_set)
-    else:
-        raise ValueError('Invalid val_method value, expect: cv, loo, tloo, tfo')
-
     test_user_set, test_item_set = test['user'].unique().tolist(), test['item'].unique().tolist()
-    ui = test[['user', 'item']].copy()
-    u_is = defaultdict(list)
-    for u in test_user_set:
-        u_is[u] = ui.loc[ui.user==u, 'item'].values.tolist()
+    u_is = defaultdict(list, test.groupby('user', sort=False)['item'].agg(list).to_dict())
 
     gc.collect()
     for fold in range(len(train_list)):
@@ -407,142 +623,64 @@ def load_libfm(src='ml-100k', data_split='fo', by_time=0, val_method='cv', fold_
     return feat_idx_dict, user_tag_info, item_tag_info, test_user_set, test_item_set, u_is, train_ur
 
 ###############
-def _split_loo(ratings, by_time=1):
-    if by_time:
-        ratings['rank_latest'] = ratings.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-        train = ratings[ratings['rank_latest'] > 1].copy()
-        test = ratings[ratings['rank_latest'] == 1].copy()
-    else:
-        ratings = ratings.sample(frac=1)
-        test = ratings.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-        test_key = test[['user', 'item']].copy()
-        train = ratings.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(test_key)).reset_index().copy()
-    assert train['user'].nunique() == test['user'].nunique()
-    return train[['user', 'item', 'rating', 'timestamp']], test[['user', 'item', 'rating', 'timestamp']]
-
-def _split_fo(ratings, by_time=0):
-    if by_time:
-        ratings = ratings.sample(frac=1)
-        ratings = ratings.sort_values(['timestamp']).reset_index(drop=True)
-        split_idx = int(np.ceil(len(ratings) * 0.8))
-        train, test = ratings.iloc[:split_idx, :].copy(), ratings.iloc[split_idx:, :].copy()
-    else:
-        train, test = train_test_split(ratings, test_size=.2)
-    return train[['user', 'item', 'rating', 'timestamp']], test[['user', 'item', 'rating', 'timestamp']]
-
-def _negative_sampling(ratings):
-    item_pool = set(ratings.item.unique())
+def _negative_sampling(ratings, num=999, seed=None, n_jobs=1):
+    '''num negative items of every user code, row u of the returned (user_num, num) array belongs to user u'''
+    user_num, item_num = ratings['user'].max() + 1, ratings['item'].max() + 1
+    mat = InteractionMatrix.from_frame(ratings, user_num, item_num)
 
-    interact_status = ratings.groupby('user')['item'].apply(set).reset_index()
-    interact_status.rename(columns={'item': 'interacted_items'}, inplace=True)
-    interact_status['negative_items'] = interact_status['interacted_items'].apply(lambda x: item_pool - x)
-    interact_status['negative_samples'] = interact_status['negative_items'].apply(lambda x: random.sample(x, 999))
-    
-    return interact_status[['user', 'negative_samples']]
+    return user_negatives(mat, num, item_pool=ratings['item'].unique(), seed=seed, n_jobs=n_jobs)
     
 
-def load_mat(src='ml-100k', test_num=1000, data_split='loo', by_time=1, val_method='cv', fold_num=5, prepro='origin'):
-    df = load_rate(src, prepro)
-    # df.sort_values(by=['user', 'item', 'timestamp'], inplace=True)
-    df['user'] = pd.Categorical(df.user).codes
-    df['item'] = pd.Categorical(df.item).codes
+def load_mat(src='ml-100k', test_num=1000, data_split='loo', by_time=1, val_method='cv', fold_num=5, prepro='origin', 
+             seed=2019, n_jobs=1):
+    '''n_jobs: worker processes sampling the test candidates, see eval_candidates'''
+    df, train_idx, test_idx, folds, split_dir = load_split(src, prepro, data_split, by_time, val_method, fold_num, 
+                                                           seed)
 
     user_num = df['user'].max() + 1
     item_num = df['item'].max() + 1
 
-    if data_split == 'loo':
-        negatives = _negative_sampling(df)
-        train, test = _split_loo(df, by_time)
+    train = df.iloc[train_idx].reset_index(drop=True)
+    test = df.iloc[test_idx].reset_index(drop=True)
+
+    ur = defaultdict(set) # ground_truth
+    for u, i in test[['user', 'item']].values.tolist():
+        ur[u].add(i)
+
+    def sample_candidates():
+        '''[u, i] rows to rank for every test user: its test items plus sampled negative items'''
+        if data_split == 'loo':
+            # every test row is its item followed by the sampled negatives of its user, -1 padding dropped
+            negatives = _negative_sampling(df, test_num - 1, seed, n_jobs)
+            t_users, t_items = test['user'].values, test['item'].values
+            block = np.column_stack([t_items, negatives[t_users]])
+            valid = block >= 0
+            test_data = np.column_stack([np.repeat(t_users, valid.sum(axis=1)), block[valid]])
+        elif data_split == 'fo':
+            # test items plus items the user never interacted with, test_num rows for every test user
+            users, cands = eval_candidates(InteractionMatrix.from_frame(test, user_num, item_num), 
+                                           InteractionMatrix.from_frame(train, user_num, item_num), 
+                                           num=test_num, seed=seed, n_jobs=n_jobs)
+            valid = cands >= 0
+            test_data = np.column_stack([np.repeat(users, valid.sum(axis=1)), cands[valid]])
+        else:
+            raise ValueError('Invalid data_split value, expect: loo, fo')
 
-        negs = test.merge(negatives, on=['user'], how='left')
-        negs['user'] = negs.apply(lambda x: f'({x["user"]},{x["item"]})', axis=1)
-        negs.drop(['item', 'rating', 'timestamp'], axis=1, inplace=True)
-        
-        test_data = []
-        ur = defaultdict(set)
-
-        for _, row in negs.iterrows():
-            u = eval(row['user'])[0]
-            test_data.append([u, eval(row['user'])[1]])
-            ur[u].add(int(row['user'][1]))
-            for i in row['negative_samples']:
-                test_data.append([u, int(i)])
-
-    elif data_split == 'fo':
-        train, test = _split_fo(df, by_time)
-        train_ur = defaultdict(set)
-        for _, row in train.iterrows():
-            train_ur[int(row['user'])].add(int(row['item']))
-
-        test_data = []
-        ur = defaultdict(set) # ground_truth
-        max_i_num = 1000
-        item_pool = list(range(item_num))
-        for u in test.user.unique():
-            test_u_is = test.query(f'user=={u}')['item'].values.tolist()
-            ur[u] = set(test_u_is)
-            if len(test_u_is) < max_i_num:
-                cands_num = max_i_num - len(test_u_is)
-                sub_item_pool = set(item_pool) - ur[u] - train_ur[u]
-                candidates = random.sample(sub_item_pool, cands_num)
-                test_u_is = list(set(candidates) | set(test_u_is))
-            else:
-                test_u_is = random.sample(test_u_is, max_i_num)
-            for i in test_u_is:
-                test_data.append([u, i])
-    else:
-        raise ValueError('Invalid data_split value, expect: loo, fo')
+        return test_data.astype(np.int32)
 
+    # candidates are stored with the split, so every recommender on this split ranks the same items
+    test_data = split_artifact(split_dir, f'mat_candidates_{test_num}', sample_candidates).tolist()
+
+    train_data = train[['user', 'item']].values
     train_data_list, val_data_list = [], []
-    if val_method == 'cv':
-        train_data = train[['user', 'item']].reset_index(drop=True)
-        train_data = train_data.values
-        kf = KFold(n_splits=fold_num, shuffle=False, random_state=2019)
-        for train_index, val_index in kf.split(train_data):
-            train_data_list.append(train_data[train_index].tolist())
-            val_data_list.append(train_data[val_index].tolist())
-    elif val_method == 'tloo':
-        train_data = train[['user', 'item', 'timestamp']].reset_index(drop=True)
-        train_data = train_data.sample(frac=1)
-        train_data = train_data.sort_values(['timestamp']).reset_index(drop=True)
-
-        train_data['rank_latest'] = train_data.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-        sub_train = train_data[train_data['rank_latest'] > 1].copy()
-        sub_val = train_data[train_data['rank_latest'] == 1].copy()
-        sub_val.drop(['rank_latest', 'timestamp'], axis=1, inplace=True)
-        sub_train.drop(['rank_latest', 'timestamp'], axis=1, inplace=True)
-
-        train_data_list.append(sub_train)
-        val_data_list.append(sub_val)
-    elif val_method == 'loo':
-        sub_val = train.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-        sub_val = sub_val[['user', 'item']].copy()
-        sub_train = train.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(sub_val)).reset_index().copy()
-        sub_train = sub_train[['user', 'item']].copy()
-
-        train_data_list.append(sub_train)
-        val_data_list.append(sub_val)
-    elif val_method == 'tfo':
-        train_data = train[['user', 'item', 'timestamp']].reset_index(drop=True)
-        train_data = train_data.sample(frac=1)
-        train_data = train_data.sort_values(['timestamp']).reset_index(drop=True)
-
-        split_idx = int(np.ceil(len(train_data) * 0.9))
-        train_data.drop(['timestamp'], axis=1, inplace=True)
-        sub_train, sub_val = train_data.iloc[:split_idx, :].copy(), train_data.iloc[split_idx:, :].copy()
-
-        train_data_list.append(sub_train.values.tolist())
-        val_data_list.append(sub_val.values.tolist())
-    else:
-        raise ValueError('Invalid val_method value, expect: cv, loo, tloo, tfo')
+    for train_index, val_index in folds:
+        train_data_list.append(train_data[train_index].tolist())
+        val_data_list.append(train_data[val_index].tolist())
+
     train_mat_list = []
     for fold in range(len(train_data_list)):
-        # load ratings as a dok matrix
-        train_mat = sp.dok_matrix((user_num, item_num), dtype=np.float32)
-        for x in train_data_list[fold]:
-            train_mat[x[0], x[1]] = 1.0
-
-        train_mat_list.append(train_mat)
+        # (u, i) in train_mat works as with the former dok matrix
+        train_mat_list.append(InteractionMatrix.from_pairs(np.asarray(train_data_list[fold]), user_num, item_num))
     print('Finish build train and test set......')
     
     return train_data_list, test_data, user_num, item_num, train_mat_list, ur, val_data_list
@@ -582,13 +720,10 @@ class BPRFMData(data.Dataset):
         self.num_item = num_item
         self.is_training = is_training
 
-        train_mat = set()
-        for _, row in df.iterrows():
-            train_mat.add((row['user'], row['item']))
+        train_pairs = df[['user', 'item']].values.astype(np.int64)
         for col in feat_idx_dict.keys():
             df[col] = df[col].agg(lambda x: x + feat_idx_dict[col])
 
-        self.train_mat = train_mat
         cols = [col for col in df.columns if col not in ['rating', 'timestamp']]
         self.cols = cols
 
@@ -597,21 +732,27 @@ class BPRFMData(data.Dataset):
             self.features.append([np.array([feature_map[item] for item in raw], dtype=np.int64)])
             self.feature_values.append([np.array([1 for _ in raw], dtype=np.float32)])
 
-    def ng_sample(self):
+        # negatives are checked against the (user, item) codes of df, as a set of pairs did before
+        self.features_ps = np.array([x[0] for x in self.features], dtype=np.int64).reshape(-1, len(cols))
+        user_num = int(max(train_pairs[:, 0].max(initial=-1), self.features_ps[:, 0].max(initial=-1))) + 1
+        self.train_mat = InteractionMatrix(train_pairs[:, 0], train_pairs[:, 1], user_num, num_item)
+        # feature index of every item code
+        self.item_features = np.array([feature_map[j + feat_idx_dict['item']] for j in range(num_item)], 
+                                      dtype=np.int64)
+
+    def draw_ng(self, rng=None):
+        '''(features_fill, feature_values_fill) of one epoch, leaves the dataset untouched'''
+        # num_ng consecutive (positive, negative) rows per positive, negatives drawn by train_mat in one batch
+        pos = np.repeat(self.features_ps, self.num_ng, axis=0)
+        neg = np.column_stack([pos[:, 0], self.item_features[self.train_mat.sample_negatives(pos[:, 0], rng)]])
+        features_fill = np.stack([pos, neg], axis=1)
+
+        return features_fill, np.ones(features_fill.shape, dtype=np.float32)
+
+    def ng_sample(self, rng=None, sample=None):
+        '''sample: output of draw_ng, e.g. prefetched by EpochSampler, drawn here if None'''
         assert self.is_training, 'no need to sampling when testing'
-        self.features_fill = []
-        self.feature_values_fill = []
-        for x in self.features:
-            u, _ = x[0]
-            for _ in range(self.num_ng):
-                j = np.random.randint(self.num_item)
-                while (u, j) in self.train_mat:
-                    j = np.random.randint(self.num_item)
-                j += self.feat_idx_dict['item']
-                y = np.array([u, self.feature_map[j]], dtype=np.int64)
-                self.features_fill.append([x[0], y])
-                self.feature_values_fill.append([np.array([1 for _ in self.cols], dtype=np.float32), 
-                                                 np.array([1 for _ in self.cols], dtype=np.float32)])
+        self.features_fill, self.feature_values_fill = self.draw_ng(rng) if sample is None else sample
 
     def __len__(self):
         return self.num_ng * len(self.features) if self.is_training else len(self.features)
@@ -671,23 +812,24 @@ class BPRData(data.Dataset):
         Note that the labels are only useful when training, we thus 
         add them in the ng_sample() function.
 		'''
-        self.features = features
+        self.features = np.asarray(features, dtype=np.int64).reshape(-1, 2)
         self.num_item = num_item
         self.train_mat = train_mat
         self.num_ng = num_ng
         self.is_training = is_training
 
-    def ng_sample(self):
-        assert self.is_training, 'no need to sampling when testing'
+    def draw_ng(self, rng=None):
+        '''features_fill of one epoch, leaves the dataset untouched so it can run in a background thread'''
+        # num_ng consecutive (u, i, j) rows per positive (u, i), negatives j are drawn by train_mat in one batch
+        users = np.repeat(self.features[:, 0], self.num_ng)
+        items = np.repeat(self.features[:, 1], self.num_ng)
+
+        return np.column_stack([users, items, self.train_mat.sample_negatives(users, rng)])
 
-        self.features_fill = []
-        for x in self.features:
-            u, i = x[0], x[1]
-            for _ in range(self.num_ng):
-                j = np.random.randint(self.num_item)
-                while (u, j) in self.train_mat:
-                    j = np.random.randint(self.num_item)
-                self.features_fill.append([u, i, j])
+    def ng_sample(self, rng=None, sample=None):
+        '''sample: output of draw_ng, e.g. prefetched by EpochSampler, drawn here if None'''
+        assert self.is_training, 'no need to sampling when testing'
+        self.features_fill = self.draw_ng(rng) if sample is None else sample
 
     def __len__(self):
         return self.num_ng * len(self.features) if self.is_training else len(self.features)
@@ -701,30 +843,22 @@ class BPRData(data.Dataset):
 
 # SLIM data loader 
 class SlimData(object):
-    def __init__(self, src='ml-100k', data_split='fo', by_time=0, val_method='cv', fold_num=5, prepro='origin'):
+    def __init__(self, src='ml-100k', data_split='fo', by_time=0, val_method='cv', fold_num=5, prepro='origin', 
+                 seed=2019):
         print('Start read raw data')        
-        self.df = load_rate(src, prepro)
-        self.df['user'] = pd.Categorical(self.df['user']).codes
-        self.df['item'] = pd.Categorical(self.df['item']).codes
+        self.df, train_idx, test_idx, folds, _ = load_split(src, prepro, data_split, by_time, val_method, fold_num, seed)
         self.num_user = self.df.user.nunique()
         self.num_item = self.df.item.nunique()
-        train_df, test_df = self.__split_data(data_split, by_time)
-        
-        train_list, val_list = self.__get_validation(train_df, val_method, fold_num)
+        _, test_df, train_list, val_list = take_split(self.df, train_idx, test_idx, folds)
 
-        self.train, self.val = [], []
+        self.train, self.val, self.train_mat = [], [], []
         for i in range(len(train_list)):
-            sub_train, sub_val = [], []
-            for _, row in train_list[i].iterrows():
-                sub_train.append([row['user'], row['item']])
-            for _, row in val_list[i].iterrows():
-                sub_val.append([row['user'], row['item']])
-            self.train.append(sub_train)
-            self.val.append(sub_val)
-
-        self.test = []
-        for _, row in test_df.iterrows():
-            self.test.append([row['user'], row['item']])
+            self.train.append(train_list[i][['user', 'item']].values.tolist())
+            self.val.append(val_list[i][['user', 'item']].values.tolist())
+            self.train_mat.append(InteractionMatrix.from_frame(train_list[i][['user', 'item']], 
+                                                              self.num_user, self.num_item))
+
+        self.test = test_df[['user', 'item']].values.tolist()
         print(f'{len(self.df)} data records, user num: {self.num_user}, item num: {self.num_item}')
         print(f'Use {val_method} validation method......')
         for i in range(len(self.train)):
@@ -732,201 +866,57 @@ class SlimData(object):
         print(f'test set: {len(self.test)}')
         del self.df    
 
-    def __get_validation(self, train_df, val_method, fold_num):
-        train_list, val_list = [], []
-        if val_method == 'loo':
-            val_set = train_df.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-            val_key = val_set[['user', 'item']].copy()
-            train_set = train_df.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(val_key)).reset_index().copy()
-
-            train_list.append(train_set)
-            val_list.append(val_set)
-        elif val_method == 'tfo':
-            train_df = train_df.sample(frac=1)
-            train_df = train_df.sort_values(['timestamp']).reset_index(drop=True)
-
-            split_idx = int(np.ceil(len(train_df) * 0.9))
-            train_set, val_set = train_df.iloc[:split_idx, :].copy(), train_df.iloc[split_idx:, :].copy()
-
-            train_list.append(train_set)
-            val_list.append(val_set)
-        elif val_method == 'tloo':
-            train_df = train_df.sample(frac=1)
-            train_df = train_df.sort_values(['timestamp']).reset_index(drop=True)
-
-            train_df['rank_latest'] = train_df.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-            new_train_set = train_df[train_df['rank_latest'] > 1].copy()
-            val_set = train_df[train_df['rank_latest'] == 1].copy()
-            del new_train_set['rank_latest'], val_set['rank_latest']
-
-            train_list.append(new_train_set)
-            val_list.append(val_set)
-        elif val_method == 'cv':
-            kf = KFold(n_splits=fold_num, shuffle=False, random_state=2019)
-            for train_index, val_index in kf.split(train_df):
-                train_list.append(train_df.iloc[train_index, :])
-                val_list.append(train_df.iloc[val_index, :])
-        else:
-            raise ValueError('Invalid val_method value, expect: cv, loo, tloo, tfo')
-        
-        return train_list, val_list
-
-    def __split_data(self, data_split, by_time):
-        '''without time stemp'''
-        if data_split == 'fo':
-            if by_time:
-                self.df = self.df.sample(frac=1)
-                self.df = self.df.sort_values(['timestamp']).reset_index(drop=True)
-                split_idx = int(np.ceil(len(self.df) * 0.8))
-                train, test = self.df.iloc[:split_idx, :].copy(), self.df.iloc[split_idx:, :].copy()
-                return train, test
-            else:
-                train, test = train_test_split(self.df, test_size=.2)
-                return train, test
-        elif data_split == 'loo':
-            if by_time:
-                self.df = self.df.sample(frac=1)
-                self.df = self.df.sort_values(['timestamp']).reset_index(drop=True)
-                self.df['rank_latest'] = self.df.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-                train, test = self.df[self.df['rank_latest'] > 1].copy(), self.df[self.df['rank_latest'] == 1].copy()
-                del train['rank_latest'], test['rank_latest']
-                return train, test
-            else:
-                test = self.df.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-                test_key = test[['user', 'item']].copy()
-                train = self.df.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(test_key)).reset_index().copy()
-                return train, test
-        else:
-            raise ValueError('Invalid data_split value, expect: loo, fo')
-            
+
 ########################################################################################################
 class WRMFData(object):
-    def __init__(self, src='ml-100k', data_split='fo', by_time=0, val_method='cv', fold_num=5, prepro='origin'):
-        self.df = load_rate(src, prepro)
+    def __init__(self, src='ml-100k', data_split='fo', by_time=0, val_method='cv', fold_num=5, prepro='origin', 
+                 seed=2019):
+        self.df, train_idx, test_idx, folds, _ = load_split(src, prepro, data_split, by_time, val_method, fold_num, seed)
         self.data_split = data_split
         self.by_time = by_time
 
-        ratings = list(self.df.rating)
-        rows = pd.Categorical(self.df.user).codes
-        cols = pd.Categorical(self.df.item).codes
-        self.df['user'] = rows
-        self.df['item'] = cols
+        ratings = self.df.rating.values
+        rows, cols = self.df.user.values, self.df.item.values
         self.user_num, self.item_num = self.df.user.nunique(), self.df.item.nunique()
         
-        self.mat = sp.csr_matrix((ratings, (rows, cols)), shape=(self.user_num, self.item_num))
-        self.train, self.test, self.test_users = self._split_data()
+        self.mat = InteractionMatrix(rows, cols, self.user_num, self.item_num, ratings).to_csr()
+        # duplicated (user, item) records are summed up as the former coo construction did
+        self.mat.sum_duplicates()
+        self.train, self.test, self.test_users = self._split_data(train_idx, test_idx)
 
-        self._split_train(val_method, fold_num)
+        self._split_train(folds)
     
-    def _split_train(self, val_method, fold_num):
+    def _split_train(self, folds):
         self.train_list, self.val_users_list = [], []
         val_set = self.train.copy()
         val_set[val_set != 0] = 1
         self.val = val_set
 
-        if val_method == 'cv':
-            kf = KFold(n_splits=fold_num, shuffle=False, random_state=2019)
-            for _, val_index in kf.split(self.val_df):
-                sub_training_set = self.train.copy()
-                tmp = self.val_df.iloc[val_index, :]
-                user_index = [u for u in tmp.user]
-                item_index = [i for i in tmp.item]
-                sub_training_set[user_index, item_index] = 0
-                sub_training_set.eliminate_zeros()
-
-                self.train_list.append(sub_training_set)
-                self.val_users_list.append(list(set(user_index)))
-        elif val_method == 'tloo':
-            self.val_df = self.val_df.sample(frac=1)
-            self.val_df = self.val_df.sort_values(['timestamp']).reset_index(drop=True)
-
-            self.val_df['rank_latest'] = self.val_df.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-            tmp = self.val_df[self.val_df['rank_latest'] == 1].copy()
-            del self.val_df['rank_latest']
-
-            user_index = [u for u in tmp.user]
-            item_index = [i for i in tmp.item]
+        for _, val_index in folds:
+            tmp = self.val_df.iloc[val_index]
+            user_index, item_index = tmp.user.values, tmp.item.values
             sub_training_set = self.train.copy()
             sub_training_set[user_index, item_index] = 0
             sub_training_set.eliminate_zeros()
 
             self.train_list.append(sub_training_set)
-            self.val_users_list.append(list(set(user_index)))
-        elif val_method == 'loo':
-            tmp = self.val_df.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-            user_index = [u for u in tmp.user]
-            item_index = [i for i in tmp.item]
-
-            sub_training_set = self.train.copy()
-            sub_training_set[user_index, item_index] = 0
-            sub_training_set.eliminate_zeros()
-
-            self.train_list.append(sub_training_set)
-            self.val_users_list.append(list(set(user_index)))
-        elif val_method == 'tfo':
-            self.val_df = self.val_df.sample(frac=1)
-            self.val_df = self.val_df.sort_values(['timestamp']).reset_index(drop=True)
-
-            split_idx = int(np.ceil(len(self.val_df) * 0.9))
-            tmp = self.val_df.iloc[split_idx:, :].copy()
-            user_index = [u for u in tmp.user]
-            item_index = [i for i in tmp.item]
-            sub_training_set = self.train.copy()
-            sub_training_set[user_index, item_index] = 0
-            sub_training_set.eliminate_zeros()
-
-            self.train_list.append(sub_training_set)
-            self.val_users_list.append(list(set(user_index)))
-        else:
-            raise ValueError('Invalid val_method value, expect: cv, loo, tloo, tfo')
+            self.val_users_list.append(np.unique(user_index).tolist())
 
         del self.train
 
-    def _split_data(self, pct_test=0.2):
+    def _split_data(self, train_idx, test_idx):
         test_set = self.mat.copy()
         test_set[test_set != 0] = 1
         training_set = self.mat.copy()
-        if self.data_split == 'fo':
-            if self.by_time:
-                self.df = self.df.sample(frac=1)
-                self.df = self.df.sort_values(['timestamp']).reset_index(drop=True)
-                split_idx = int(np.ceil(len(self.df) * (1 - pct_test)))
-                samples = self.df.iloc[split_idx:, :].copy()
-                user_index = [u for u in samples.user]
-                item_index = [i for i in samples.item]
-
-                self.val_df = self.df.iloc[:split_idx, :].reset_index(drop=True)
-            else:
-                val_df, samples = train_test_split(self.df, test_size=pct_test)
-                user_index = [u for u in samples.user]
-                item_index = [i for i in samples.item]
-
-                self.val_df = val_df.reset_index(drop=True)
-        elif self.data_split == 'loo':
-            if self.by_time:
-                self.df = self.df.sample(frac=1)
-                self.df = self.df.sort_values(['timestamp']).reset_index(drop=True)
-                self.df['rank_latest'] = self.df.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-                samples = self.df[self.df['rank_latest'] == 1].copy()
-                user_index = [u for u in samples.user]
-                item_index = [i for i in samples.item]
-
-                self.val_df = self.df[self.df['rank_latest'] > 1].copy()
-                del self.val_df['rank_latest']
-            else:
-                samples = self.df.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-                user_index = [u for u in samples.user]
-                item_index = [i for i in samples.item]
-
-                val_key = samples[['user', 'item']].copy()
-                self.val_df = df.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(val_key)).reset_index().copy()
-        else:
-            raise ValueError('Invalid data_split value, expect: loo, fo')
+        samples = self.df.iloc[test_idx]
+        user_index, item_index = samples.user.values, samples.item.values
+        self.val_df = self.df.iloc[train_idx].reset_index(drop=True)
+
         training_set[user_index, item_index] = 0
         # eliminate stored-zero then save space
         training_set.eliminate_zeros()
-        # Output the unique list of user rows that were altered; set() for eliminate repeated user_index
-        return training_set, test_set, list(set(user_index))
+        # Output the unique list of user rows that were altered
+        return training_set, test_set, np.unique(user_index).tolist()
 
 class NCFData(data.Dataset):
     def __init__(self, features, num_item, train_mat=None, num_ng=0, is_training=None):
@@ -935,29 +925,29 @@ class NCFData(data.Dataset):
         Note that the labels are only useful when training, we thus 
 		add them in the ng_sample() function.
         '''
-        self.features_ps = features
+        self.features_ps = np.asarray(features, dtype=np.int64).reshape(-1, 2)
         self.num_item = num_item
         self.train_mat = train_mat
         self.num_ng = num_ng
         self.is_training = is_training
-        self.labels = [0 for _ in range(len(features))]
+        self.labels = np.zeros(len(self.features_ps), dtype=np.int64)
 
-    def ng_sample(self):
-        assert self.is_training, 'no need to sampling when testing'
+    def draw_ng(self, rng=None):
+        '''(features_fill, labels_fill) of one epoch, leaves the dataset untouched'''
+        # positives first, then num_ng consecutive (u, j) rows per positive, j drawn by train_mat in one batch
+        users = np.repeat(self.features_ps[:, 0], self.num_ng)
+        features_ng = np.column_stack([users, self.train_mat.sample_negatives(users, rng)])
+
+        features_fill = np.concatenate([self.features_ps, features_ng])
+        labels_fill = np.concatenate([np.ones(len(self.features_ps), dtype=np.int64), 
+                                      np.zeros(len(features_ng), dtype=np.int64)])
 
-        self.features_ng = []
-        for x in self.features_ps:
-            u = x[0]
-            for _ in range(self.num_ng):
-                j = np.random.randint(self.num_item)
-                while (u, j) in self.train_mat:
-                    j = np.random.randint(self.num_item)
-                self.features_ng.append([u, j])
-        labels_ps = [1 for _ in range(len(self.features_ps))]
-        labels_ng = [0 for _ in range(len(self.features_ng))]
+        return features_fill, labels_fill
 
-        self.features_fill = self.features_ps + self.features_ng
-        self.labels_fill = labels_ps + labels_ng
+    def ng_sample(self, rng=None, sample=None):
+        '''sample: output of draw_ng, e.g. prefetched by EpochSampler, drawn here if None'''
+        assert self.is_training, 'no need to sampling when testing'
+        self.features_fill, self.labels_fill = self.draw_ng(rng) if sample is None else sample
 
     def __len__(self):
         return (self.num_ng + 1) * len(self.labels)
@@ -974,12 +964,11 @@ class NCFData(data.Dataset):
 # AutoRec:AutoEncoder DataProcess
 class AutoRecData(object):
     def __init__(self, a, b, src='ml-100k', prepro='origin', data_split='fo', by_time=1, val_method='cv', 
-                 fold_num=5, test_size=.2):
+                 fold_num=5, test_size=.2, seed=2019):
         self.a = a
         self.b = b
-        df = load_rate(src, prepro)
-        df['user'] = pd.Categorical(df.user).codes
-        df['item'] = pd.Categorical(df.item).codes
+        df, train_idx, test_idx, folds, _ = load_split(src, prepro, data_split, by_time, val_method, fold_num, 
+                                                       seed, test_size)
         self.user_num = df.user.nunique()
         self.item_num = df.item.nunique()
         self.rating_num = df.rating.size
@@ -990,112 +979,39 @@ class AutoRecData(object):
         self.fold_num = fold_num
         self.test_size = test_size
 
-        self._process(df)
+        self._process(df, train_idx, test_idx, folds)
 
-    def _process(self, df):
+    def _process(self, df, train_idx, test_idx, folds):
         train_R_list, train_mask_R_list, num_train_ratings_list = [], [], []
         user_train_set_list, item_train_set_list = [], []
 
-        user_train_set = set()
-        user_test_set = set()
-        item_train_set = set()
-        item_test_set = set()
-
-        R = np.zeros((self.user_num, self.item_num))
-        mask_R = np.zeros((self.user_num, self.item_num))
-        C = np.ones((self.user_num, self.item_num)) * self.b
-
-        train_R = np.zeros((self.user_num, self.item_num))
-        test_R = np.zeros((self.user_num, self.item_num))
-
-        train_mask_R = np.zeros((self.user_num, self.item_num))
-        test_mask_R = np.zeros((self.user_num, self.item_num))
-
-        if self.data_split == 'fo':
-            if self.by_time:
-                df = df.sample(frac=1)
-                df = df.sort_values(['timestamp']).reset_index(drop=True)
-
-                split_idx = int(np.ceil(len(df) * 0.8))
-                train, test = df.iloc[:split_idx, :].copy(), df.iloc[split_idx:, :].copy()
-            else:
-                train, test = train_test_split(df, test_size=self.test_size)
-        elif self.data_split == 'loo':
-            if self.by_time:
-                df = df.sample(frac=1)
-                df = df.sort_values(['timestamp']).reset_index(drop=True)
-                df['rank_latest'] = df.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-                train, test = df[df['rank_latest'] > 1].copy(), df[df['rank_latest'] == 1].copy()
-                del train['rank_latest'], test['rank_latest']
-            else:
-                test = df.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)
-                test_key = test[['user', 'item']].copy()
-                train = df.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(test_key)).reset_index().copy()
-
-        test_ur, train_ur = defaultdict(list), defaultdict(list)
-        for _, row in train.iterrows():
-            user, item = row['user'], row['item']
-            train_ur[user].append(item)
-        
-        train_list = []
-        if self.val_method == 'cv':
-            kf = KFold(n_splits=self.fold_num, shuffle=False, random_state=2019)
-            for train_index, _ in kf.split(train):
-                train_list.append(train.iloc[train_index, :].copy())
-        elif self.val_method == 'loo':
-            val_key = train.groupby(['user']).apply(pd.DataFrame.sample, n=1).reset_index(drop=True)[['user', 'item']].copy()
-            train_list.append(train.set_index(['user', 'item']).drop(pd.MultiIndex.from_frame(val_key)).reset_index().copy())
-        elif self.val_method == 'tloo':
-            train = train.sample(frac=1)
-            train = train.sort_values(['timestamp']).reset_index(drop=True)
-
-            train['rank_latest'] = train.groupby(['user'])['timestamp'].rank(method='first', ascending=False)
-            new_train_set = train[train['rank_latest'] > 1].copy()
-            del new_train_set['rank_latest']
-            train_list.append(new_train_set)
-        elif self.val_method == 'tfo':
-            train = train.sample(frac=1)
-            train = train.sort_values(['timestamp']).reset_index(drop=True)
-
-            split_idx = int(np.ceil(len(train) * 0.9))
-            train_list.append(train.iloc[:split_idx, :].copy())
-        else:
-            raise ValueError('Invalid val_method value, expect: cv, loo, tloo, tfo')
+        train, test, train_list, _ = take_split(df, train_idx, test_idx, folds)
 
-        for _, row in df.iterrows():
-            user, item, rating = row['user'], row['item'], row['rating']
-            R[user, item] = int(rating)
-            mask_R[user, item] = 1
-            C[user,item] = self.a
+        # train_ur[u] gives a view on the sorted train items of user u
+        train_ur = InteractionMatrix.from_frame(train, self.user_num, self.item_num)
+
+        full_mat = InteractionMatrix.from_frame(df, self.user_num, self.item_num)
+        R = np.trunc(full_mat.to_dense())
+        mask_R = full_mat.to_dense(binary=True)
+        C = np.where(mask_R == 1, self.a, self.b).astype(np.float64)
 
         '''train'''
         for sub_train in train_list:
-            num_train_ratings = len(sub_train)
-            num_train_ratings_list.append(num_train_ratings)
-            for _, row in sub_train.iterrows():
-                user, item, rating = row['user'], row['item'], row['rating']
-                train_R[user, item] = int(rating)
-                train_mask_R[user, item] = 1
-
-                user_train_set.add(user)
-                item_train_set.add(item)
-
-            train_R_list.append(train_R)
-            train_mask_R_list.append(train_mask_R)
-            user_train_set_list.append(user_train_set)
-            item_train_set_list.append(item_train_set)
+            num_train_ratings_list.append(len(sub_train))
+            train_mat = InteractionMatrix.from_frame(sub_train, self.user_num, self.item_num)
+            train_R_list.append(np.trunc(train_mat.to_dense()))
+            train_mask_R_list.append(train_mat.to_dense(binary=True))
+            user_train_set_list.append(set(np.flatnonzero(train_mat.user_degree()).tolist()))
+            item_train_set_list.append(set(np.flatnonzero(train_mat.item_degree()).tolist()))
 
         '''test'''
         num_test_ratings = len(test)
-        for _, row in test.iterrows():
-            user, item, rating = row['user'], row['item'], row['rating']
-            test_R[user, item] = int(rating)
-            test_mask_R[user, item] = 1
-
-            user_test_set.add(user)
-            item_test_set.add(item)
-
-            test_ur[user].append(item)
+        test_mat = InteractionMatrix.from_frame(test, self.user_num, self.item_num)
+        test_R = np.trunc(test_mat.to_dense())
+        test_mask_R = test_mat.to_dense(binary=True)
+        user_test_set = set(np.flatnonzero(test_mat.user_degree()).tolist())
+        item_test_set = set(np.flatnonzero(test_mat.item_degree()).tolist())
+        test_ur = defaultdict(list, {u: test_mat.user_items(u).tolist() for u in user_test_set})
 
         self.R = R
         self.mask_R = mask_R
@@ -1113,6 +1029,7 @@ class AutoRecData(object):
 
         self.train_ur = train_ur
         self.test_ur = test_ur
+        self.test_mat = test_mat
 
 # Item2Vec Data Process
 class BuildCorpus(object):
@@ -1192,10 +1109,9 @@ if __name__ == '__main__':
     # load negative sampling dataset for NCF BPR, take ml-100k as an example
     df = load_rate('ml-100k')
     df.sort_values(by=['user', 'item', 'timestamp'], inplace=True)
-    df['user'] = pd.Categorical(df.user).codes
-    df['item'] = pd.Categorical(df.item).codes
     negatives = _negative_sampling(df)
-    train, test = _split_loo(df)
+    train_idx, test_idx = test_split_index(df, 'loo', by_time=1, seed=2019)
+    train, test = df.iloc[train_idx], df.iloc[test_idx]
 
     file_obj = open('./data/ml-100k/ml-100k.train.rating', 'w')
     for _, row in train.iterrows():
@@ -1209,13 +1125,14 @@ if __name__ == '__main__':
         file_obj.write(ln)
     file_obj.close()
 
-    negs = test.merge(negatives, on=['user'], how='left')
+    negs = test.copy()
+    negs['negative_samples'] = list(negatives[negs['user'].values])
     negs['user'] = negs.apply(lambda x: f'({x["user"]},{x["item"]})', axis=1)
     negs.drop(['item', 'rating', 'timestamp'], axis=1, inplace=True)
 
     file_obj = open('./data/ml-100k/ml-100k.test.negative', 'w')
     for _, row in negs.iterrows():
-        ln = row['user'] + '\t' + '\t'.join(map(str, row['negative_samples'])) + '\n'
+        ln = row['user'] + '\t' + '\t'.join(map(str, row['negative_samples'][row['negative_samples'] >= 0])) + '\n'
         file_obj.write(ln)
     file_obj.close()
 
@@ -0,0 +1,151 @@
+'''
+@Author: Yu Di
+@Date: 2019-12-09 10:26:37
+@LastEditors: Yudi
+@LastEditTime: 2019-12-09 16:02:51
+@Company: Cardinal Operation
+@Email: yudi@shanshu.ai
+@Description: top-N ranking of recommenders for evaluation
+'''
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from util.metrics import metric_sums, merge_metric_sums
+
+# evaluation task of the running evaluate call, forked workers read it from inherited memory
+# so model parameters and candidate arrays are shared copy-on-write instead of pickled per shard
+_TASK = None
+
+# metric keys of evaluate results with their printed names
+KPI_NAMES = (('precision', 'Precision'), ('recall', 'Recall'), ('map', 'MAP'), 
+             ('ndcg', 'NDCG'), ('hr', 'HR'), ('mrr', 'MRR'))
+
+def _topk_rows(scores, k):
+    '''column indexes of the k largest scores of every row in descending order, -1 where scores are -inf'''
+    top = np.full((len(scores), k), -1, dtype=np.int64)
+    kk = min(k, scores.shape[1])
+    if kk == 0:
+        return top
+    # k-th largest score of every row, ties on it are taken in column order as a stable sort does
+    kth = -np.partition(-scores, kk - 1, axis=1)[:, kk - 1:kk]
+    above, tie = scores > kth, scores == kth
+    keep = above | (tie & (np.cumsum(tie, axis=1) <= kk - above.sum(axis=1, keepdims=True)))
+    part = np.nonzero(keep)[1].reshape(-1, kk)
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    top[:, :kk] = np.take_along_axis(part, order, axis=1)
+    top[:, :kk][np.take_along_axis(part_scores, order, axis=1) == -np.inf] = -1
+
+    return top
+
+def full_topk(score_users, users, item_num, seen=None, k=10, block_size=None):
+    '''
+    top-k items of every user ranked over the full catalog
+    score_users: callable mapping a user array to its (len(users), item_num) score block;
+    users: users to rank for;
+    item_num: catalog size;
+    seen: InteractionMatrix of items never recommended to a user (e.g. training items), None for no mask;
+    k: length of rank list;
+    block_size: users scored at once, None to keep a score block around 2^24 entries.
+
+    returns (len(users), k) int64 item array in rank order, -1 where a user has less than k unseen items
+    '''
+    users = np.asarray(users, dtype=np.int64)
+    block_size = block_size or max(1, (1 << 24) // int(item_num))
+
+    top = np.full((len(users), k), -1, dtype=np.int64)
+    for start in range(0, len(users), block_size):
+        block = users[start:start + block_size]
+        scores = np.array(score_users(block), dtype=np.float64)
+        if seen is not None:
+            # CSR rows of the block, seen items can never enter the top-k
+            counts = seen.indptr[block + 1] - seen.indptr[block]
+            pos = np.repeat(seen.indptr[block] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+            scores[np.repeat(np.arange(len(block)), counts), seen.indices[pos]] = -np.inf
+        top[start:start + len(block)] = _topk_rows(scores, k)
+
+    return top
+
+def candidate_topk(score_batch, users, cands, k=10):
+    '''
+    top-k of every user among its candidates
+    score_batch: model score_batch(users, items);
+    cands: (len(users), m) candidate matrix as eval_candidates gives, -1 padding is never ranked.
+
+    returns (len(users), k) int64 item array in rank order, -1 where a user has less than k candidates
+    '''
+    users = np.asarray(users, dtype=np.int64)
+    scores = np.array(score_batch(users, np.maximum(cands, 0)), dtype=np.float64)
+    scores[cands < 0] = -np.inf
+    cols = _topk_rows(scores, k)
+
+    return np.where(cols >= 0, np.take_along_axis(cands, np.maximum(cols, 0), axis=1), -1)
+
+def _rank_sums(top, users, truth):
+    k = top.shape[1]
+    rel = (top >= 0) & truth.contains(np.repeat(users, k), top.ravel()).reshape(top.shape)
+
+    return metric_sums(rel, truth.user_degree()[users])
+
+def topk_metrics(top, users, truth):
+    '''
+    top-k metrics of rank lists made elsewhere
+    top: (len(users), k) item array in rank order, -1 for empty slots;
+    users: users the rows of top belong to;
+    truth: InteractionMatrix of ground-truth items.
+
+    returns dict of precision, recall, map, ndcg, hr and mrr as rank_metrics gives
+    '''
+    return merge_metric_sums([_rank_sums(np.asarray(top, dtype=np.int64), np.asarray(users, dtype=np.int64), truth)])
+
+def _evaluate_shard(start, end):
+    score, users, truth, k, cands, seen = _TASK
+    users = users[start:end]
+    if cands is None:
+        top = full_topk(score, users, truth.item_num, seen, k)
+    else:
+        top = candidate_topk(score, users, cands[start:end], k)
+
+    return _rank_sums(top, users, truth)
+
+def evaluate(score, users, truth, k=10, cands=None, seen=None, n_jobs=1, shard_size=None):
+    '''
+    top-k metrics of users, ranked and scored shard by shard in n_jobs worker processes
+    score: model score_batch(users, items) if cands is given, else score_users(users) for full ranking;
+    users: users to evaluate;
+    truth: InteractionMatrix of ground-truth items;
+    cands: (len(users), m) candidate matrix, None to rank every item except seen ones;
+    seen: InteractionMatrix of items masked in full ranking;
+    n_jobs: worker processes, shards are run in this process if 1 or fork is unavailable;
+            score must not touch CUDA tensors if n_jobs > 1, a CUDA context cannot be used after fork;
+    shard_size: users of one shard, None to keep about 2^18 scored pairs per shard.
+
+    returns dict of precision, recall, map, ndcg, hr and mrr as rank_metrics gives
+    '''
+    global _TASK
+    users = np.asarray(users, dtype=np.int64)
+    width = truth.item_num if cands is None else max(cands.shape[1], 1)
+    shard_size = shard_size or max(1, (1 << 18) // width)
+    bounds = [(s, min(s + shard_size, len(users))) for s in range(0, len(users), shard_size)]
+    # key index of truth is built once here, not again in every worker
+    truth.contains(users[:1], users[:1])
+
+    _TASK = (score, users, truth, k, cands, seen)
+    try:
+        if n_jobs > 1 and len(bounds) > 1 and 'fork' in mp.get_all_start_methods():
+            with ProcessPoolExecutor(n_jobs, mp_context=mp.get_context('fork')) as executor:
+                sums = list(executor.map(_evaluate_shard, *zip(*bounds)))
+        else:
+            sums = [_evaluate_shard(*b) for b in bounds]
+    finally:
+        _TASK = None
+
+    return merge_metric_sums(sums)
+
+def print_kpi(kpis, k):
+    '''print the mean of every metric over the evaluate results of all folds'''
+    print('---------------------------------')
+    for key, name in KPI_NAMES:
+        print(f'{name}@{k}: {np.mean([kpi[key] for kpi in kpis])}')
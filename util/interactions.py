@@ -0,0 +1,184 @@
+'''
+@Author: Yu Di
+@Date: 2019-12-03 14:12:08
+@LastEditors: Yudi
+@LastEditTime: 2019-12-03 17:46:31
+@Company: Cardinal Operation
+@Email: yudi@shanshu.ai
+@Description: user-item interaction store shared by all data loaders and recommenders
+'''
+import numpy as np
+import scipy.sparse as sp
+
+def broadcast_pairs(users, items):
+    '''
+    int64 (users, items) index arrays of the same shape, for batch scoring
+    users, items: aligned arrays, a user with an item list, or a (n,) user array with a (n, m) candidate matrix
+    '''
+    users = np.asarray(users, dtype=np.int64)
+    items = np.asarray(items, dtype=np.int64)
+    if users.ndim == 1 and items.ndim == 2:
+        users = users[:, None]
+
+    return np.broadcast_arrays(users, items)
+
+class InteractionMatrix(object):
+    def __init__(self, user, item, user_num, item_num, rating=None, timestamp=None):
+        '''
+        user, item: aligned user/item code arrays of interactions;
+        user_num, item_num: shape of the matrix;
+        rating, timestamp: optional arrays aligned with user/item.
+
+        CSR arrays (indptr, indices) give items of each user in ascending order, CSC arrays
+        (col_indptr, col_indices) give users of each item, col_order maps every CSC entry
+        back to its CSR position so ratings/timestamps are stored only once.
+        '''
+        user = np.asarray(user, dtype=np.int64)
+        item = np.asarray(item, dtype=np.int64)
+        assert user.shape == item.shape, 'user and item arrays must be aligned'
+        self.user_num, self.item_num = int(user_num), int(item_num)
+
+        order = np.lexsort((item, user))
+        self.indices = item[order].astype(np.int32)
+        self.indptr = np.zeros(self.user_num + 1, dtype=np.int64)
+        np.cumsum(np.bincount(user, minlength=self.user_num), out=self.indptr[1:])
+        self.data = None if rating is None else np.asarray(rating, dtype=np.float32)[order]
+        self.timestamp = None if timestamp is None else np.asarray(timestamp, dtype=np.int64)[order]
+
+        # rows are sorted, so a stable sort by item keeps users ascending inside each column
+        self.col_order = np.argsort(self.indices, kind='stable')
+        self.col_indices = self.row_ids()[self.col_order].astype(np.int32)
+        self.col_indptr = np.zeros(self.item_num + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.indices, minlength=self.item_num), out=self.col_indptr[1:])
+        self._keys = None
+
+    @classmethod
+    def from_frame(cls, df, user_num, item_num):
+        '''build from a DataFrame with user/item code columns, rating and timestamp are kept if exist'''
+        rating = df['rating'].values if 'rating' in df.columns else None
+        timestamp = df['timestamp'].values if 'timestamp' in df.columns else None
+
+        return cls(df['user'].values, df['item'].values, user_num, item_num, rating, timestamp)
+
+    @classmethod
+    def from_pairs(cls, pairs, user_num, item_num):
+        '''build from [[u, i], ...] list or (n, 2) array, extra columns are ignored'''
+        pairs = np.asarray(pairs, dtype=np.int64) if len(pairs) else np.zeros((0, 2), dtype=np.int64)
+
+        return cls(pairs[:, 0], pairs[:, 1], user_num, item_num)
+
+    @classmethod
+    def from_dict(cls, ur, user_num, item_num):
+        '''build from {user: items} mapping such as the test_ur dicts of the loaders'''
+        users = [u for u, items in ur.items() for _ in items]
+        items = [i for items in ur.values() for i in items]
+
+        return cls(users, items, user_num, item_num)
+
+    @property
+    def shape(self):
+        return self.user_num, self.item_num
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def __len__(self):
+        return self.nnz
+
+    def row_ids(self):
+        '''user code of every CSR entry'''
+        return np.repeat(np.arange(self.user_num, dtype=np.int32), np.diff(self.indptr))
+
+    def user_degree(self):
+        return np.diff(self.indptr)
+
+    def item_degree(self):
+        return np.diff(self.col_indptr)
+
+    def user_items(self, u):
+        '''items interacted by user u, a view on CSR indices'''
+        return self.indices[self.indptr[u]:self.indptr[u + 1]]
+
+    __getitem__ = user_items
+
+    def user_ratings(self, u):
+        return self.data[self.indptr[u]:self.indptr[u + 1]]
+
+    def item_users(self, i):
+        '''users interacted with item i, a view on CSC indices'''
+        return self.col_indices[self.col_indptr[i]:self.col_indptr[i + 1]]
+
+    def item_ratings(self, i):
+        return self.data[self.col_order[self.col_indptr[i]:self.col_indptr[i + 1]]]
+
+    def __contains__(self, key):
+        u, i = key
+        if u < 0 or u >= self.user_num:
+            return False
+        row = self.user_items(u)
+        pos = np.searchsorted(row, i)
+
+        return pos < len(row) and row[pos] == i
+
+    def keys(self):
+        '''sorted int64 key u * item_num + i of every entry, built once'''
+        if self._keys is None:
+            # items of all users laid out in one sorted key space
+            self._keys = self.row_ids().astype(np.int64) * self.item_num + self.indices
+        return self._keys
+
+    def contains(self, users, items):
+        '''vectorized membership test of aligned (users, items) pairs'''
+        users = np.asarray(users, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+        keys = self.keys()
+        query = users * self.item_num + items
+        pos = np.searchsorted(keys, query)
+        pos[pos == len(keys)] = 0
+
+        return keys[pos] == query if len(keys) else np.zeros(len(query), dtype=bool)
+
+    def sample_negatives(self, users, rng=None):
+        '''
+        draw one item per entry of users that this user never interacted with; all items are drawn in one call, 
+        draws hitting the user's CSR row are rejected and only those are drawn again
+        users: int array, may repeat users;
+        rng: np.random.Generator, None for a fresh one.
+        '''
+        rng = np.random.default_rng() if rng is None else rng
+        users = np.asarray(users, dtype=np.int64)
+        if len(users) and (self.user_degree()[np.unique(users)] >= self.item_num).any():
+            raise ValueError('Some users interacted with every item, no negative item left to sample')
+
+        items = rng.integers(self.item_num, size=len(users), dtype=np.int64)
+        reject = np.flatnonzero(self.contains(users, items))
+        while len(reject):
+            items[reject] = rng.integers(self.item_num, size=len(reject), dtype=np.int64)
+            reject = reject[self.contains(users[reject], items[reject])]
+
+        return items
+
+    def to_csr(self, binary=False):
+        '''scipy CSR matrix sharing arrays with this store, binary or without ratings gives 1.0 as value'''
+        if binary or self.data is None:
+            data = np.ones(self.nnz, dtype=np.float32)
+        else:
+            data = self.data
+
+        return sp.csr_matrix((data, self.indices, self.indptr), shape=self.shape, copy=False)
+
+    def to_csc(self, binary=False):
+        if binary or self.data is None:
+            data = np.ones(self.nnz, dtype=np.float32)
+        else:
+            data = self.data[self.col_order]
+
+        return sp.csc_matrix((data, self.col_indices, self.col_indptr), shape=self.shape, copy=False)
+
+    def to_dense(self, binary=False, dtype=np.float64):
+        mat = np.zeros(self.shape, dtype=dtype)
+        values = 1 if binary or self.data is None else self.data
+        mat[self.row_ids(), self.indices] = values
+
+        return mat
@@ -1,9 +1,27 @@
+import sys
 import heapq
 import numpy as np
 from six import iteritems
 from collections import defaultdict
 
-from util.similarities import cosine, jaccard, pearson
+from util.interactions import InteractionMatrix, broadcast_pairs
+from util.similarities import cosine, jaccard, pearson, blocked_similarity
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+def peak_memory():
+    '''
+    peak resident memory in MB of this process or its largest finished worker process, 
+    None where the platform does not report it
+    '''
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # bytes on macOS, kilobytes elsewhere
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
 
 class SymmetricAlgo(object):
     def __init__(self, user_num, item_num, **kwargs):
@@ -15,10 +33,17 @@ class SymmetricAlgo(object):
         self.item_num = item_num
 
     def fit(self, train_set):
+        self.train_mat = InteractionMatrix.from_frame(train_set, self.user_num, self.item_num)
+        mat = self.train_mat
+
+        # (x, r) lists are what the similarity kernels expect, fill them straight from CSR/CSC arrays
         self.ur, self.ir = defaultdict(list), defaultdict(list)
-        for _, row in train_set.iterrows():
-            self.ur[row['user']].append((row['item'], row['rating']))
-            self.ir[row['item']].append((row['user'], row['rating']))
+        ratings = mat.data.tolist()
+        for u, i, r in zip(mat.row_ids().tolist(), mat.indices.tolist(), ratings):
+            self.ur[u].append((i, r))
+        for i, u, pos in zip(np.repeat(np.arange(mat.item_num), mat.item_degree()).tolist(), 
+                             mat.col_indices.tolist(), mat.col_order.tolist()):
+            self.ir[i].append((u, ratings[pos]))
 
         ub = self.sim_options['user_based']
         self.n_x = self.user_num if ub else self.item_num
@@ -35,37 +60,59 @@ class SymmetricAlgo(object):
         else:
             return i_stuff, u_stuff
 
-    def compute_similarities(self):
+    def compute_similarities(self, k=None):
+        '''
+        similarity matrix of xs, pruned to the k strongest neighbors of every x if k is given, row block by row block;
+        sim_options block_size computes it that many rows at a time and spills finished blocks
+        to memory-mapped files in sim_options spill_dir, so pair products never exist for all xs at once;
+        sim_options n_jobs splits the rows over that many worker processes
+        '''
         construction_func = {'cosine': cosine,
                              'pearson': pearson,
                              'jaccard': jaccard}
+        # (n_x, n_y) rating matrix, rows are users if user based, else items
         if self.sim_options['user_based']:
-            n_x, yr, xr = self.user_num, self.ir, self.ur
+            mat = self.train_mat.to_csr()
         else: 
-            n_x, yr, xr = self.item_num, self.ur, self.ir
+            mat = self.train_mat.to_csc().T
 
         min_support = self.sim_options.get('min_support', 1)
-        args = [n_x, yr, xr, min_support]
+        block_size = self.sim_options.get('block_size', None)
+        n_jobs = self.sim_options.get('n_jobs', 1)
 
         name = self.sim_options.get('name', 'cosine').lower()
-        
-        try:
-            print('Computing the {0} similarity matrix...'.format(name))
-            sim = construction_func[name](*args)
-            print('Done computing similarity matrix.')
-            return sim
-        except KeyError:
+        if name not in construction_func:
             raise NameError(f'Wrong sim name {name}. Allowed values are ' + ', '.join(construction_func.keys()) + '.')
 
+        print('Computing the {0} similarity matrix...'.format(name))
+        if block_size or k is not None:
+            # pruned rows are cut to k block by block, so the full matrix is never built; blocks of a k-pruned 
+            # build without block_size stay in memory as they hold O(n·k) entries only
+            sim = blocked_similarity(name, mat, min_support, block_size or 1024, k, 
+                                     self.sim_options.get('spill_dir', None), n_jobs, spill=bool(block_size))
+        else:
+            sim = construction_func[name](mat, min_support, n_jobs)
+        peak = peak_memory()
+        print('Done computing similarity matrix' + ('.' if peak is None else f', peak memory {peak:.1f} MB.'))
+
+        return sim
+
 class KNNWithMeans(SymmetricAlgo):
-    def __init__(self, user_num, item_num, k=40, min_k=1, sim_options={}, verbose=True, **kwargs):
+    def __init__(self, user_num, item_num, k=40, min_k=1, sim_options={}, verbose=True, max_neighbors=None, **kwargs):
+        '''
+        max_neighbors: keep only the max_neighbors strongest neighbors of every x after the similarity build,
+                       None keeps all; neighbors of x rating y beyond them are then treated as dissimilar
+        '''
         SymmetricAlgo.__init__(self, user_num, item_num, sim_options=sim_options, **kwargs)
         self.k = k
         self.min_k = min_k
+        if max_neighbors is not None and max_neighbors < k:
+            raise ValueError('Invalid max_neighbors value, expect: None or no less than k')
+        self.max_neighbors = max_neighbors
 
     def fit(self, train_set):
         SymmetricAlgo.fit(self, train_set)
-        self.sim = self.compute_similarities()
+        self.sim = self.compute_similarities(self.max_neighbors)
 
         self.means = np.zeros(self.n_x)
         for x, ratings in iteritems(self.xr):
@@ -73,13 +120,26 @@ class KNNWithMeans(SymmetricAlgo):
 
         return self
 
+    def sims(self, xs, nbs):
+        '''dense (len(xs), len(nbs)) block of the sparse similarity matrix, 0 where pairs have no similarity'''
+        xs, nbs = np.asarray(xs, dtype=np.int64), np.asarray(nbs, dtype=np.int64)
+        rows, inverse = np.unique(xs, return_inverse=True)
+
+        return self.sim[rows][:, nbs].toarray()[inverse.ravel()]
+
     def predict(self, u, i):
         if u >= self.user_num or i >= self.item_num:
             raise ValueError('User and/or item is unkown.')
 
         x, y = self.switch(u, i)
 
-        neighbors = [(x2, self.sim[x, x2], r) for (x2, r) in self.yr[y]]
+        # raters of y looked up in the sorted neighbor ids of x
+        ids = self.sim.indices[self.sim.indptr[x]:self.sim.indptr[x + 1]]
+        weights = self.sim.data[self.sim.indptr[x]:self.sim.indptr[x + 1]]
+        nbs = np.array([x2 for (x2, _) in self.yr[y]], dtype=np.int64)
+        pos = np.minimum(np.searchsorted(ids, nbs), max(len(ids) - 1, 0))
+        sims = np.where(ids[pos] == nbs, weights[pos], 0) if len(ids) else np.zeros(len(nbs))
+        neighbors = [(x2, sim, r) for (x2, r), sim in zip(self.yr[y], sims.tolist())]
         k_neighbors = heapq.nlargest(self.k, neighbors, key=lambda t: t[1])
 
         est = self.means[x]
@@ -101,4 +161,89 @@ class KNNWithMeans(SymmetricAlgo):
             pass  # return mean
 
         details = {'actual_k': actual_k}
-        return est, details
\ No newline at end of file
+        return est, details
+
+    def predict_many(self, u, items):
+        '''
+        predict of user u for every item of items at once, gathering the raters of y from CSR arrays;
+        returns the estimate array and details with the actual_k array, as predict gives per item
+        '''
+        items = np.asarray(items, dtype=np.int64)
+        if u >= self.user_num or (items.size and items.max() >= self.item_num):
+            raise ValueError('User and/or item is unkown.')
+
+        mat = self.train_mat
+        if self.sim_options['user_based']:
+            # raters of every item padded to the largest rater count, position valid marks real ones
+            counts = mat.item_degree()[items]
+            width = int(counts.max()) if len(items) else 0
+            valid = np.arange(width) < counts[:, None]
+            pos = np.minimum(mat.col_indptr[items][:, None] + np.arange(width), max(mat.nnz - 1, 0))
+            nbs, rs = mat.col_indices[pos].astype(np.int64), mat.data[mat.col_order[pos]]
+            sims = self.sims([u], nbs.ravel()).reshape(nbs.shape)
+            means = self.means[u]
+        else:
+            # every item shares the rated items of u as neighbors
+            nbs, rs = mat.user_items(u).astype(np.int64), mat.user_ratings(u)
+            valid = np.ones((len(items), len(nbs)), dtype=bool)
+            sims = self.sims(items, nbs)
+            nbs, rs = np.broadcast_to(nbs, sims.shape), np.broadcast_to(rs, sims.shape)
+            means = self.means[items]
+        offset, actual_k = self._offsets(sims, rs, nbs, valid)
+
+        return means + offset, {'actual_k': actual_k}
+
+    def _offsets(self, sims, rs, nbs, valid):
+        '''
+        mean-centred weighted average of the k most similar neighbors as predict adds to the mean of x,
+        and actual_k, of every row of (n, m) neighbor similarities, ratings and ids; valid marks real neighbors
+        '''
+        # float32 weights of a pruned index are summed in float64 as predict sums python floats
+        sims = np.where(valid, np.asarray(sims, dtype=np.float64), -np.inf)
+        # k largest similarities per row, ties on the k-th taken in neighbor order as heapq.nlargest does
+        if sims.shape[1] > self.k:
+            kth = -np.partition(-sims, self.k - 1, axis=1)[:, self.k - 1:self.k]
+            above, tie = sims > kth, sims == kth
+            chosen = above | (tie & (np.cumsum(tie, axis=1) <= self.k - above.sum(axis=1, keepdims=True)))
+        else:
+            chosen = valid
+        positive = chosen & (sims > 0)
+
+        weights = np.where(positive, sims, 0)
+        sum_sim = weights.sum(axis=1)
+        sum_ratings = (weights * (rs - self.means[nbs])).sum(axis=1)
+        actual_k = positive.sum(axis=1)
+        sum_ratings[actual_k < self.min_k] = 0
+        offset = np.zeros(len(sims))
+        ok = sum_sim != 0
+        offset[ok] = sum_ratings[ok] / sum_sim[ok]
+
+        return offset, actual_k
+
+    def score_batch(self, users, items):
+        '''
+        predict estimate of every (user, item) pair at once, see broadcast_pairs for accepted shapes;
+        pairs sharing y (item if user based, else user) are scored together against y's raters
+        '''
+        users, items = broadcast_pairs(users, items)
+        if (users.size and users.max() >= self.user_num) or (items.size and items.max() >= self.item_num):
+            raise ValueError('User and/or item is unkown.')
+
+        xs, ys = self.switch(users.ravel(), items.ravel())
+        est = self.means[xs].astype(np.float64)
+        order = np.argsort(ys, kind='stable')
+        bounds = np.flatnonzero(np.diff(ys[order])) + 1
+        for pos in np.split(order, bounds) if len(order) else []:
+            y = ys[pos[0]]
+            if self.sim_options['user_based']:
+                nbs, rs = self.train_mat.item_users(y), self.train_mat.item_ratings(y)
+            else:
+                nbs, rs = self.train_mat.user_items(y), self.train_mat.user_ratings(y)
+            if not len(nbs):
+                continue
+            nbs = nbs.astype(np.int64)
+            sims = self.sims(xs[pos], nbs)
+            est[pos] += self._offsets(sims, np.broadcast_to(rs, sims.shape), np.broadcast_to(nbs, sims.shape), 
+                                      np.ones(sims.shape, dtype=bool))[0]
+
+        return est.reshape(users.shape)
@@ -2,6 +2,14 @@ cimport numpy as np
 import numpy as np
 from collections import defaultdict
 
+from util.interactions import broadcast_pairs
+
+def _check_codes(users, items, user_num, item_num):
+    if users.size and users.max() >= user_num:
+        raise ValueError('Invalid user code')
+    if items.size and items.max() >= item_num:
+        raise ValueError('Invalid item code')
+
 class RSVD(object):
     def __init__(self, user_num, item_num, n_factors=96, n_epochs=20, version=2, init_mean=0, init_std_dev=.1, 
                  lr=.001, reg=.02, reg2=.05, random_state=None, verbose=True):
@@ -77,6 +85,25 @@ class RSVD(object):
 
         return est
 
+    def score_batch(self, users, items):
+        '''predict of every (user, item) pair at once, see broadcast_pairs for accepted shapes'''
+        users, items = broadcast_pairs(users, items)
+        _check_codes(users, items, self.user_num, self.item_num)
+        est = np.einsum('...f,...f->...', self.ui[users], self.vj[items])
+        if self.version == 2:
+            est += self.ci[users] + self.dj[items]
+
+        return est
+
+    def score_users(self, users):
+        '''(len(users), item_num) predict of users against every item'''
+        users = np.asarray(users, dtype=np.int64)
+        est = self.ui[users] @ self.vj.T
+        if self.version == 2:
+            est += self.ci[users][:, None] + self.dj[None, :]
+
+        return est
+
 
 class SVD(object):
     def __init__(self, user_num, item_num, n_factors=100, n_epochs=20, biased=True, init_mean=0, init_std_dev=.1, 
@@ -166,6 +193,25 @@ class SVD(object):
 
         return est
 
+    def score_batch(self, users, items):
+        '''predict of every (user, item) pair at once, see broadcast_pairs for accepted shapes'''
+        users, items = broadcast_pairs(users, items)
+        _check_codes(users, items, self.user_num, self.item_num)
+        est = np.einsum('...f,...f->...', self.qi[items], self.pu[users])
+        if self.biased:
+            est += self.global_mean + self.bu[users] + self.bi[items]
+
+        return est
+
+    def score_users(self, users):
+        '''(len(users), item_num) predict of users against every item'''
+        users = np.asarray(users, dtype=np.int64)
+        est = self.pu[users] @ self.qi.T
+        if self.biased:
+            est += self.global_mean + self.bu[users][:, None] + self.bi[None, :]
+
+        return est
+
 class SVDpp(object):
     def __init__(self, user_num, item_num, n_factors=20, n_epochs=20, init_mean=0, init_std_dev=.1,
                  lr_all=.007, reg_all=.02, lr_bu=None, lr_bi=None, lr_pu=None, lr_qi=None, lr_yj=None, 
@@ -284,4 +330,19 @@ class SVDpp(object):
             u_impl_feedback = (sum(self.yj[j] for (j, _) in self.ur[u]) / np.sqrt(Iu))
         est += np.dot(self.qi[i], self.pu[u] + u_impl_feedback)
 
-        return est
\ No newline at end of file
+        return est
+
+    def score_batch(self, users, items):
+        '''predict of every (user, item) pair at once, see broadcast_pairs for accepted shapes'''
+        users, items = broadcast_pairs(users, items)
+        _check_codes(users, items, self.user_num, self.item_num)
+        # p_u plus implicit feedback, once per distinct user
+        uniq, inv = np.unique(users, return_inverse=True)
+        pu_impl = self.pu[uniq].copy()
+        for k, u in enumerate(uniq):
+            Iu = len(self.ur[u])
+            if Iu:
+                pu_impl[k] += sum(self.yj[j] for (j, _) in self.ur[u]) / np.sqrt(Iu)
+        est = np.einsum('...f,...f->...', self.qi[items], pu_impl[inv.reshape(users.shape)])
+
+        return est + self.global_mean + self.bu[users] + self.bi[items]
@@ -11,87 +11,144 @@ import numpy as np
 import torch
 
 # pytorch KPI calculating methods
+class ErrorAccumulator(object):
+    '''
+    running error sums of (prediction, label) batches, kept on the device of the batches 
+    so a training loop pays one host copy when reading the result instead of one per batch
+    log_loss: whether to also sum the log loss of predictions taken as logits, labels > 0 positive
+    '''
+    def __init__(self, log_loss=False):
+        self.log_loss = log_loss
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.se, self.ae, self.ll = 0., 0., 0.
+
+    def update(self, prediction, label):
+        with torch.no_grad():
+            prediction, label = prediction.detach().double().view(-1), label.double().view(-1)
+            error = prediction - label
+            self.se = self.se + error.pow(2).sum()
+            self.ae = self.ae + error.abs().sum()
+            if self.log_loss:
+                self.ll = self.ll + torch.nn.functional.binary_cross_entropy_with_logits(
+                    prediction, (label > 0).double(), reduction='sum')
+        self.count += len(error)
+
+    def _mean(self, total):
+        return float(total) / self.count if self.count else np.nan
+
+    def rmse(self):
+        return np.sqrt(self._mean(self.se))
+
+    def mae(self):
+        return self._mean(self.ae)
+
+    def logloss(self):
+        if not self.log_loss:
+            raise ValueError('Invalid log_loss value, expect: True to accumulate log loss')
+        return self._mean(self.ll)
+
 # NFM train metric
 def metrics_nfm(model, dataloader):
     # device = torch.device('cpu')
-    RMSE = np.array([], dtype=np.float32)
-    for features, feature_values, label in dataloader:
-        if torch.cuda.is_available():
-            features = features.cuda()
-            feature_values = feature_values.cuda()
-            label = label.cuda()
-        else:
-            features = features.cpu()
-            feature_values = feature_values.cpu()
-            label = label.cpu()
-
-        prediction = model(features, feature_values)
-        prediction = prediction.clamp(min=-1.0, max=1.0)
-        SE = (prediction - label).pow(2)
-        RMSE = np.append(RMSE, SE.detach().cpu().numpy())
-
-    return np.sqrt(RMSE.mean())
-
-def _hit(gt_item, pred_items):
-    if gt_item in pred_items:
-        return 1
-    return 0
-
-def _ndcg(gt_item, pred_items):
-    if gt_item in pred_items:
-        index = pred_items.index(gt_item)
-        return np.reciprocal(np.log2(index+2))
-    return 0
-
-def _bpr_topk(model, test_loader, top_k):
-    HR, NDCG = [], []
-    for user, item_i, item_j in test_loader:
-        if torch.cuda.is_available():
-            user = user.cuda()
-            item_i = item_i.cuda()
-            item_j = item_j.cuda() # not useful when testing
-        else:
-            user = user.cpu()
-            item_i = item_i.cpu()
-            item_j = item_j.cpu()
-
-        prediction_i, _ = model(user, item_i, item_j)
-        _, indices = torch.topk(prediction_i, top_k)
-        recommends = torch.take(item_i, indices).cpu().numpy().tolist()
-        gt_item = item_i[0].item()
-        
-        HR.append(_hit(gt_item, recommends))
-        NDCG.append(_ndcg(gt_item, recommends))
+    acc = ErrorAccumulator()
+    with torch.no_grad():
+        for features, feature_values, label in dataloader:
+            if torch.cuda.is_available():
+                features = features.cuda()
+                feature_values = feature_values.cuda()
+                label = label.cuda()
+            else:
+                features = features.cpu()
+                feature_values = feature_values.cpu()
+                label = label.cpu()
 
-    return np.mean(HR), np.mean(NDCG)
+            prediction = model(features, feature_values)
+            prediction = prediction.clamp(min=-1.0, max=1.0)
+            acc.update(prediction, label)
 
-def _ncf_topk(model, test_loader, top_k):
-    HR, NDCG = [], []
-    for user, item, _ in test_loader: # _ is label
-        if torch.cuda.is_available():
-            user = user.cuda()
-            item = item.cuda()
-        else:
-            user = user.cpu()
-            item = item.cpu()
+    return acc.rmse()
 
-        predictions = model(user, item)
-        _, indices = torch.topk(predictions, top_k)
-        recommends = torch.take(item, indices).cpu().numpy().tolist()
+def _user_blocks(users, block_size):
+    '''block id and position of every row, a block is a run of rows of one user with at most block_size rows'''
+    n = len(users)
+    run_start = np.flatnonzero(np.r_[True, users[1:] != users[:-1]]) if n else np.zeros(0, dtype=np.int64)
+    pos = np.arange(n) - np.repeat(run_start, np.diff(np.r_[run_start, n]))
+    block = np.cumsum(pos % block_size == 0) - 1
 
-        gt_item = item[0].item()
-        HR.append(_hit(gt_item, recommends))
-        NDCG.append(_ndcg(gt_item, recommends))
+    return block, pos % block_size
 
-    return np.mean(HR), np.mean(NDCG)
+def _block_topk(score, pairs, truth_keys, item_num, block_size, top_k, device, chunk_size=1 << 13):
+    '''
+    HR and NDCG of every user block, an item of the block is relevant if truth_keys holds it for the user
+    score: callable mapping user and item tensors to a score tensor;
+    pairs: (n, 2) array of user-item rows, rows of a user next to each other as load_mat gives;
+    truth_keys: sorted int64 keys user * item_num + item of ground-truth pairs;
+    chunk_size: rows of one forward pass, MLP layers slow down on CPU once activations outgrow cache.
+    '''
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    if len(pairs) == 0:
+        return np.nan, np.nan
+    block, pos = _user_blocks(pairs[:, 0], block_size)
+    block_users = torch.from_numpy(pairs[pos == 0, 0]).to(device)
+    keys = torch.from_numpy(np.asarray(truth_keys, dtype=np.int64)).to(device)
+    pairs = torch.from_numpy(pairs).to(device)
+    with torch.no_grad():
+        # rows of several users per forward pass, the flat scores are laid out as one row per block afterwards
+        scores = torch.cat([score(pairs[s:s + chunk_size, 0], pairs[s:s + chunk_size, 1]) 
+                            for s in range(0, len(pairs), chunk_size)])
+        shape = (int(block[-1]) + 1, int(pos.max()) + 1)
+        index = torch.from_numpy(block * shape[1] + pos).to(device)
+        score_mat = torch.full((shape[0] * shape[1], ), -np.inf, device=device)
+        score_mat[index] = scores.float()
+        score_mat = score_mat.view(shape)
+        item_mat = torch.full((shape[0] * shape[1], ), -1, dtype=torch.long, device=device)
+        item_mat[index] = pairs[:, 1]
+        item_mat = item_mat.view(shape)
+
+        _, indices = torch.topk(score_mat, min(top_k, shape[1]), dim=1)
+        top = item_mat.gather(1, indices)
+
+        # relevance mask looked up in the sorted truth keys on the device, -1 marks padding of short blocks
+        query = block_users[:, None] * item_num + top
+        found_pos = torch.searchsorted(keys, query).clamp(max=max(len(keys) - 1, 0))
+        hit = (top >= 0) & (keys[found_pos] == query) if len(keys) else torch.zeros_like(top, dtype=torch.bool)
+        hit = hit.float()
+        found = hit.max(dim=1).values
+        # only the first hit of the top-k list is discounted
+        first = hit * (hit.cumsum(dim=1) == 1).float()
+        discount = torch.log2(torch.arange(2, hit.shape[1] + 2, device=device, dtype=torch.float))
+        ndcg = (first / discount).sum(dim=1)
+
+    return found.double().mean().item(), ndcg.double().mean().item()
 
-def metric_eval(model, test_loader, top_k, algo='bpr'):
+def metric_eval(model, test_loader, top_k, algo='bpr', truth=None):
+    '''
+    HR and NDCG@top_k of ranking the candidates of each user in test_loader; rows of a user are scored 
+    together with other users in a few large forward passes
+    truth: InteractionMatrix of ground-truth items, None takes the first row of every block of 
+           test_loader.batch_size rows as its ground truth, as load_mat lays out the test rows
+    '''
+    device = next(model.parameters()).device
+    block_size = test_loader.batch_size
     if algo == 'bpr':
-        HR, NDCG = _bpr_topk(model, test_loader, top_k)
+        score, pairs = lambda user, item: model(user, item, item)[0], test_loader.dataset.features
     elif algo == 'ncf':
-        HR, NDCG = _ncf_topk(model, test_loader, top_k)
+        score, pairs = model, test_loader.dataset.features_ps
+    else:
+        raise ValueError('Invalid algo value, expect: bpr, ncf')
+
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    if truth is None:
+        item_num = int(pairs[:, 1].max(initial=-1)) + 1
+        _, pos = _user_blocks(pairs[:, 0], block_size)
+        truth_keys = np.unique(pairs[pos == 0, 0] * item_num + pairs[pos == 0, 1])
+    else:
+        item_num, truth_keys = truth.item_num, truth.keys()
 
-    return HR, NDCG
+    return _block_topk(score, pairs, truth_keys, item_num, block_size, top_k, device)
 ############ these metric only work in train process ########################
 
 # some algorithm just use numpy-based, so the KPI calculating methods are different from pytorch
@@ -175,7 +232,7 @@ def dcg_at_k(r, k):
     Returns:
         Discounted cumulative gain
     '''
-    r = np.asfarray(r)[:k] != 0
+    r = np.asarray(r, dtype=np.float64)[:k] != 0
     if r.size:
         return np.sum(np.subtract(np.power(2, r), 1) / np.log2(np.arange(2, r.size + 2)))
     return 0.
@@ -194,3 +251,59 @@ def ndcg_at_k(r, k):
         return 0.
     return dcg_at_k(r, k) / idcg
 
+
+def metric_sums(rel, truth_len):
+    '''
+    Args:
+        rel: (n_users, k) relevance matrix in rank order (bool/uint8/int, non-zero is a hit)
+        truth_len: (n_users,) ground-truth item count of every user
+    Returns:
+        dict of per-user metric sums, hits, ground-truth total and user count, sums of user shards
+        add up to the sums of all users
+    '''
+    rel = np.asarray(rel)
+    truth_len = np.asarray(truth_len, dtype=np.float64)
+    assert rel.ndim == 2 and len(rel) == len(truth_len)
+    k = rel.shape[1]
+    assert k >= 1
+    hit = rel != 0
+    rank = np.arange(1, k + 1)
+
+    n_hit = hit.sum(axis=1)
+    recall = np.divide(n_hit, truth_len, out=np.zeros(len(rel)), where=truth_len != 0)
+    # precision at every hit position, summed and divided by the row length as average_precision does
+    ap = (np.cumsum(hit, axis=1) / rank * hit).sum(axis=1) / k
+    discount = 1. / np.log2(rank + 1)
+    # ideal ranking puts all hits of the row first
+    idcg = np.concatenate([[0.], np.cumsum(discount)])[n_hit]
+    ndcg = np.divide(hit @ discount, idcg, out=np.zeros(len(rel)), where=idcg != 0)
+    # every position holding 1 counts as mrr_at_k does
+    mrr = ((rel == 1) / rank).sum(axis=1)
+
+    return {'precision': n_hit.sum() / k, 'recall': recall.sum(), 'map': ap.sum(), 'ndcg': ndcg.sum(), 
+            'mrr': mrr.sum(), 'hit': n_hit.sum(), 'truth': truth_len.sum(), 'users': len(rel)}
+
+def merge_metric_sums(sums):
+    '''
+    Args:
+        sums: metric_sums of user shards
+    Returns:
+        dict of precision, recall, map, ndcg, hr and mrr over all users of the shards
+    '''
+    total = {key: sum(s[key] for s in sums) for key in sums[0]}
+    assert total['users'] > 0
+    res = {key: total[key] / total['users'] for key in ['precision', 'recall', 'map', 'ndcg', 'mrr']}
+    res['hr'] = total['hit'] / total['truth']
+
+    return res
+
+def rank_metrics(rel, truth_len):
+    '''
+    Args:
+        rel: (n_users, k) relevance matrix in rank order (bool/uint8/int, non-zero is a hit)
+        truth_len: (n_users,) ground-truth item count of every user
+    Returns:
+        dict of precision, recall, map, ndcg, hr and mrr at k, averaged over users exactly as
+        precision_at_k, recall_at_k, map_at_k, ndcg_at_k, hr_at_k and mrr_at_k do on the rows
+    '''
+    return merge_metric_sums([metric_sums(rel, truth_len)])
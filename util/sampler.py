@@ -0,0 +1,247 @@
+'''
+@Author: Yu Di
+@Date: 2019-12-05 10:12:45
+@LastEditors: Yudi
+@LastEditTime: 2019-12-05 15:40:18
+@Company: Cardinal Operation
+@Email: yudi@shanshu.ai
+@Description: negative sampling, per-epoch training negatives (optionally prefetched) and evaluation candidates
+'''
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from util.interactions import InteractionMatrix
+
+class EpochSampler(object):
+    '''
+    dataset: training dataset with draw_ng(rng) and ng_sample(rng, sample);
+    epochs: number of epochs to sample for;
+    seed: int, sequence of ints or None, epoch N always uses the N-th child of SeedSequence(seed),
+          so a run samples the same negatives with or without prefetch;
+    prefetch: number of epochs drawn ahead by a background thread, 0 samples synchronously.
+
+    use it as a context manager, or call close(), so the thread stops when training ends or fails.
+    '''
+    def __init__(self, dataset, epochs, seed=None, prefetch=0):
+        self.dataset = dataset
+        self.epochs = epochs
+        self.prefetch = prefetch
+        self.seeds = np.random.SeedSequence(seed).spawn(epochs)
+        self.epoch = 0
+
+        if prefetch > 0:
+            # bounded, the worker holds at most prefetch finished epochs besides the one training
+            self._queue = queue.Queue(maxsize=prefetch)
+            self._stop = threading.Event()
+            self._worker = threading.Thread(target=self._produce, daemon=True)
+            self._worker.start()
+
+    def _produce(self):
+        for epoch in range(self.epochs):
+            try:
+                item = self.dataset.draw_ng(np.random.default_rng(self.seeds[epoch]))
+            except Exception as e:
+                item = e
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=.1)
+                    break
+                except queue.Full:
+                    continue
+            if self._stop.is_set() or isinstance(item, Exception):
+                return
+
+    def ng_sample(self, epoch):
+        '''fill dataset with the negatives of epoch, epochs are consumed in order'''
+        if epoch != self.epoch or epoch >= self.epochs:
+            raise ValueError(f'Invalid epoch value, expect: {self.epoch}')
+        self.epoch += 1
+
+        if self.prefetch > 0:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            self.dataset.ng_sample(sample=item)
+        else:
+            self.dataset.ng_sample(np.random.default_rng(self.seeds[epoch]))
+
+    def close(self):
+        '''stop the background worker, e.g. when training ends early; closing twice is harmless'''
+        if self.prefetch > 0:
+            self._stop.set()
+            self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _take_rows(indptr, rows):
+    '''CSR entry positions of rows, concatenated in the order of rows'''
+    counts = indptr[rows + 1] - indptr[rows]
+    starts = np.repeat(indptr[rows] - (np.cumsum(counts) - counts), counts)
+
+    return starts + np.arange(counts.sum())
+
+def _slice_rows(mat, rows):
+    '''(indptr, indices) of rows of an InteractionMatrix, rebased so the shard can travel to a worker alone'''
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(mat.indptr[rows + 1] - mat.indptr[rows], out=indptr[1:])
+
+    return indptr, mat.indices[_take_rows(mat.indptr, rows)]
+
+def _isin_sorted(query, keys):
+    '''membership of query in sorted keys, fast when query is sorted too'''
+    if len(keys) == 0:
+        return np.zeros(len(query), dtype=bool)
+    pos = np.searchsorted(keys, query)
+    pos[pos == len(keys)] = 0
+
+    return keys[pos] == query
+
+def _unique_sorted(keys):
+    '''sorted distinct keys by plain sort, np.unique may pick a much slower hash path for int64'''
+    keys = np.sort(keys)
+
+    return keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(keys) else keys
+
+def _candidate_shard(t_indptr, t_items, e_indptr, e_items, item_num, pool, num, seed):
+    '''candidate rows of one user shard, users are local row numbers 0..n-1 here'''
+    rng = np.random.default_rng(seed)
+    n = len(t_indptr) - 1
+    # sorted keys u * item_num + i, repeated ground truth counts once as with sets
+    t_keys = _unique_sorted(np.repeat(np.arange(n), np.diff(t_indptr)) * item_num + t_items)
+    t_users, t_items = t_keys // item_num, t_keys % item_num
+    t_count = np.bincount(t_users, minlength=n)
+    e_users = np.repeat(np.arange(n), np.diff(e_indptr))
+    # items never drawn as negatives: ground truth and exclude rows
+    blocked = _unique_sorted(np.concatenate([t_keys, e_users * item_num + e_items]))
+    in_pool = np.zeros(item_num, dtype=bool)
+    in_pool[pool] = True
+    avail = len(pool) - np.bincount(blocked[in_pool[blocked % item_num]] // item_num, minlength=n)
+
+    cands = np.full((n, num), -1, dtype=np.int32)
+
+    # ground truth, a random num of them for users having more
+    order = np.lexsort((rng.random(len(t_items)), t_users))
+    rank = np.arange(len(order)) - (np.cumsum(t_count) - t_count)[t_users]
+    keep = rank < num
+    cands[t_users[keep], rank[keep]] = t_items[order][keep]
+    filled = np.minimum(t_count, num)
+    need = np.minimum(num - filled, avail)
+
+    # negatives: draw from pool, drop blocked items and repeats, the earliest distinct draws of a user win
+    acc_keys = np.zeros(0, dtype=np.int64)
+    acc_u, acc_i = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    remaining = need.copy()
+    active = np.flatnonzero(remaining > 0)
+    while len(active):
+        free = avail[active] - (need[active] - remaining[active])
+        size = np.ceil(remaining[active] * len(pool) / free * 1.1).astype(np.int64) + 8
+        draws = np.repeat(active, size) * item_num + pool[rng.integers(len(pool), size=size.sum())]
+        # sorted distinct keys, so membership tests below are sorted lookups
+        keys, first = np.unique(draws, return_index=True)
+        ok = ~_isin_sorted(keys, blocked) & ~_isin_sorted(keys, acc_keys)
+        # draws are grouped by user, so the draw position orders users first and draws of a user second
+        new = keys[ok][np.argsort(first[ok])]
+        du = new // item_num
+        got = np.bincount(du, minlength=n)
+        rank = np.arange(len(new)) - (np.cumsum(got) - got)[du]
+        new = new[rank < remaining[du]]
+
+        acc_keys = np.sort(np.concatenate([acc_keys, new]))
+        acc_u, acc_i = np.concatenate([acc_u, new // item_num]), np.concatenate([acc_i, new % item_num])
+        remaining = need - np.bincount(acc_u, minlength=n)
+        active = np.flatnonzero(remaining > 0)
+
+    # column of every accepted negative: after the user's ground truth and earlier negatives
+    order = np.argsort(acc_u, kind='stable')
+    acc_u, acc_i = acc_u[order], acc_i[order]
+    got = np.bincount(acc_u, minlength=n)
+    rank = np.arange(len(acc_u)) - (np.cumsum(got) - got)[acc_u]
+    cands[acc_u, filled[acc_u] + rank] = acc_i
+
+    # shuffle inside rows so ground truth carries no position, -1 padding is moved back to the end
+    cands = rng.permuted(cands, axis=1)
+    padded = np.flatnonzero((cands < 0).any(axis=1))
+    if len(padded):
+        cands[padded] = np.take_along_axis(cands[padded], np.argsort(cands[padded] < 0, axis=1, kind='stable'), 
+                                           axis=1)
+
+    return cands
+
+def _run_shards(truth, exclude, users, pool, num, seed, n_jobs, shard_size):
+    '''candidate rows of users, shard s always uses the s-th child of SeedSequence(seed)'''
+    exclude = InteractionMatrix([], [], truth.user_num, truth.item_num) if exclude is None else exclude
+
+    shards = [users[s:s + shard_size] for s in range(0, len(users), shard_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(shards))
+    args = []
+    for rows, shard_seed in zip(shards, seeds):
+        args.append((*_slice_rows(truth, rows), *_slice_rows(exclude, rows), truth.item_num, pool, num, shard_seed))
+
+    if n_jobs > 1 and len(shards) > 1:
+        with ProcessPoolExecutor(n_jobs) as executor:
+            res = list(executor.map(_candidate_shard, *zip(*args)))
+    else:
+        res = [_candidate_shard(*arg) for arg in args]
+
+    return np.concatenate(res) if res else np.zeros((0, num), dtype=np.int32)
+
+def _item_pool(item_pool, item_num):
+    return np.arange(item_num) if item_pool is None else np.unique(np.asarray(item_pool, dtype=np.int64))
+
+def eval_candidates(truth, exclude=None, item_pool=None, num=1000, seed=None, n_jobs=1, shard_size=2048):
+    '''
+    candidate items ranked for each user: ground truth plus uniformly sampled negatives up to num
+    truth: InteractionMatrix of ground-truth items, a random num of them are kept for users having more;
+    exclude: InteractionMatrix of items never sampled as negatives (e.g. training items), ground truth never is;
+    item_pool: items negatives are drawn from, all items if None;
+    seed: int or None, shard s always uses the s-th child of SeedSequence(seed), so the result
+          does not depend on n_jobs;
+    n_jobs: worker processes the user shards are spread over.
+
+    returns (users, candidates): users having ground truth, and (len(users), num) int32 candidates in 
+    random order, rows of users running out of negatives are padded with -1 at the end
+    '''
+    users = np.flatnonzero(truth.user_degree() > 0)
+    pool = _item_pool(item_pool, truth.item_num)
+
+    return users, _run_shards(truth, exclude, users, pool, num, seed, n_jobs, shard_size)
+
+def user_negatives(mat, num=999, item_pool=None, seed=None, n_jobs=1, shard_size=2048):
+    '''
+    num distinct items of item_pool every user of mat never interacted with, drawn uniformly without replacement
+    as random.sample does, but by batched rejection against the CSR rows instead of per-user item sets
+    mat: InteractionMatrix of interacted items;
+    item_pool, seed, n_jobs: as for eval_candidates.
+
+    returns (mat.user_num, num) int32 array, row u holds the negatives of user u in random order,
+    rows of users having less than num negatives are padded with -1 at the end instead of failing
+    '''
+    pool = _item_pool(item_pool, mat.item_num)
+    empty = InteractionMatrix([], [], mat.user_num, mat.item_num)
+
+    return _run_shards(empty, mat, np.arange(mat.user_num), pool, num, seed, n_jobs, shard_size)
+
+def candidate_lists(users, cands):
+    '''{user: candidate item list} view of eval_candidates output, -1 padding dropped'''
+    return {u: row[row >= 0].tolist() for u, row in zip(users.tolist(), cands)}
+
+def candidate_matrix(mat):
+    '''(users, candidates) of an InteractionMatrix holding candidate rows such as load_mat test pairs, 
+    the inverse of candidate_lists; repeated items count once, rows are padded with -1'''
+    keys = _unique_sorted(mat.row_ids().astype(np.int64) * mat.item_num + mat.indices)
+    key_users, key_items = keys // mat.item_num, keys % mat.item_num
+    counts = np.bincount(key_users, minlength=mat.user_num)
+    users = np.flatnonzero(counts)
+
+    cands = np.full((len(users), counts.max() if len(users) else 0), -1, dtype=np.int32)
+    rank = np.arange(len(keys)) - (np.cumsum(counts) - counts)[key_users]
+    cands[np.searchsorted(users, key_users), rank] = key_items
+
+    return users, cands
@@ -1,141 +1,254 @@
-cimport numpy as np  # noqa
-import numpy as np
-from collections import defaultdict
-
-from six.moves import range
-from six import iteritems
-
-def jaccard(n_x, yr, xr, min_support):
-    cdef np.ndarray[np.int_t, ndim=2] freq
-    cdef np.ndarray[np.double_t, ndim=2] sim
-
-    cdef int xi, xj, yi
-    cdef double ri, rj
-    cdef int min_sprt = min_support
-
-    freq = np.zeros((n_x, n_x), np.int)
-    sim = np.zeros((n_x, n_x), np.double)
+import tempfile
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 
-    u_is = defaultdict(list)
-    for x, x_ratings in iteritems(xr):
-        for yi, ri in x_ratings:
-            u_is[x].append(yi)
-
-    for y, y_ratings in iteritems(yr):
-        for xi, ri in y_ratings:
-            for xj, rj in y_ratings:
-                freq[xi, xj] += 1
-
-    for xi in range(n_x):
-        sim[xi, xi] = 1
-        for xj in range(xi + 1, n_x):
-            if freq[xi, xj] < min_sprt:
-                sim[xi, xj] = 0
-            else:
-                denum = len(set(u_is[xi]) | set(u_is[xj]))
-                sim[xi, xj] = len(set(u_is[xi]) & set(u_is[xj])) / denum
-
-            sim[xj, xi] = sim[xi, xj]
+import numpy as np
+import scipy.sparse as sp
+
+# every measure takes the (n_x, n_y) rating matrix of x and returns a symmetric (n_x, n_x) CSR matrix,
+# the diagonal is 1, pairs sharing less than min_support ys are 0 and left out of the structure.
+# sums run over common ys only: X·Xᵀ style products of the ratings R and their stored-entry pattern B
+# give them all, e.g. (R∘R)·Bᵀ at (xi, xj) is the sum of r_xi,y ^ 2 over ys xj rated too.
+# the kernels below score the pairs of xs in rows lo to hi, so blocked_similarity runs them block by block.
+# with n_jobs > 1 row blocks run in forked worker processes, which read the rating matrix of the running
+# call from _TASK in inherited memory instead of receiving pickled copies.
+# prune_neighbors cuts such a matrix down to the k strongest neighbors of every x.
+
+_TASK = None
+
+def _pattern(mat):
+    '''binary matrix of the stored entries of mat, duplicated entries keep one 1 each'''
+    return sp.csr_matrix((np.ones(len(mat.data)), mat.indices, mat.indptr), shape=mat.shape)
+
+def _squared(mat):
+    '''mat with every stored entry squared on its own, duplicated entries are not summed first'''
+    return sp.csr_matrix((mat.data ** 2, mat.indices, mat.indptr), shape=mat.shape)
+
+def _values_at(prod, rows, cols):
+    '''values of sparse product prod at (rows, cols), 0 where the product stored nothing'''
+    prod = prod.tocsr()
+    prod.sort_indices()
+    n = np.int64(prod.shape[1])
+    keys = np.repeat(np.arange(prod.shape[0], dtype=np.int64), np.diff(prod.indptr)) * n + prod.indices
+    query = rows * n + cols
+    if not len(keys):
+        return np.zeros(len(query))
+    pos = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+
+    return np.where(keys[pos] == query, prod.data[pos], 0)
+
+def _sides(left, right, lo, hi, rows, cols):
+    '''values of left·rightᵀ at (rows, cols) and (cols, rows) for rows in [lo, hi), one product if that is every x'''
+    if lo == 0 and hi == left.shape[0]:
+        prod = left @ right.T
+        return _values_at(prod, rows, cols), _values_at(prod, cols, rows)
+
+    return _values_at(left[lo:hi] @ right.T, rows - lo, cols), _values_at(right[lo:hi] @ left.T, rows - lo, cols)
+
+def _support(pattern, lo, hi, min_support, upper):
+    '''
+    pairs (xi, xj) with xi in [lo, hi) and their number of common ys, pairs below min_support dropped;
+    upper keeps xi < xj only, else every xi != xj
+    '''
+    freq = (pattern[lo:hi] @ pattern.T).tocsr()
+    rows = np.repeat(np.arange(lo, hi, dtype=np.int64), np.diff(freq.indptr))
+    cols = freq.indices.astype(np.int64)
+    keep = ((rows < cols) if upper else (rows != cols)) & (freq.data >= max(min_support, 1))
+
+    return rows[keep], cols[keep], freq.data[keep]
+
+def _assemble(lo, hi, n_x, rows, cols, values):
+    '''(hi - lo, n_x) CSR of rows lo to hi with values at (rows, cols) plus a unit diagonal'''
+    values = np.asarray(values, dtype=np.float64)
+    nonzero = values != 0
+    rows, cols, values = rows[nonzero], cols[nonzero], values[nonzero]
+    diag = np.arange(lo, hi, dtype=np.int64)
+    sim = sp.csr_matrix((np.concatenate([values, np.ones(hi - lo)]),
+                         (np.concatenate([rows, diag]) - lo, np.concatenate([cols, diag]))),
+                        shape=(hi - lo, n_x))
+    sim.sort_indices()
 
     return sim
 
-def cosine(n_x, yr, xr, min_support):
-    # sum (r_xy * r_x'y) for common ys
-    cdef np.ndarray[np.double_t, ndim=2] prods
-    # number of common ys
-    cdef np.ndarray[np.int_t, ndim=2] freq
-    # sum (r_xy ^ 2) for common ys
-    cdef np.ndarray[np.double_t, ndim=2] sqi
-    # sum (r_x'y ^ 2) for common ys
-    cdef np.ndarray[np.double_t, ndim=2] sqj
-    # the similarity matrix
-    cdef np.ndarray[np.double_t, ndim=2] sim
-
-    cdef int xi, xj
-    cdef double ri, rj
-    cdef int min_sprt = min_support
-
-    prods = np.zeros((n_x, n_x), np.double)
-    freq = np.zeros((n_x, n_x), np.int)
-    sqi = np.zeros((n_x, n_x), np.double)
-    sqj = np.zeros((n_x, n_x), np.double)
-    sim = np.zeros((n_x, n_x), np.double)
-
-    for y, y_ratings in iteritems(yr):
-        for xi, ri in y_ratings:
-            for xj, rj in y_ratings:
-                freq[xi, xj] += 1
-                prods[xi, xj] += ri * rj
-                sqi[xi, xj] += ri**2
-                sqj[xi, xj] += rj**2
-
-    for xi in range(n_x):
-        sim[xi, xi] = 1
-        for xj in range(xi + 1, n_x):
-            if freq[xi, xj] < min_sprt:
-                sim[xi, xj] = 0
-            else:
-                denum = np.sqrt(sqi[xi, xj] * sqj[xi, xj])
-                sim[xi, xj] = prods[xi, xj] / denum
-
-            sim[xj, xi] = sim[xi, xj]
+def _symmetric(n_x, rows, cols, values):
+    '''(n_x, n_x) CSR of values at (rows, cols) and (cols, rows) plus a unit diagonal'''
+    return _assemble(0, n_x, n_x, np.concatenate([rows, cols]), np.concatenate([cols, rows]), 
+                     np.concatenate([values, values]))
+
+def _jaccard(mat, pattern, lo, hi, rows, cols, freq):
+    distinct = pattern.copy()
+    distinct.sum_duplicates()
+    distinct.data[:] = 1
+    if distinct.nnz < pattern.nnz:
+        inter = _values_at(distinct[lo:hi] @ distinct.T, rows - lo, cols)
+    else:
+        inter = freq
+    degree = np.diff(distinct.indptr)
+    union = degree[rows] + degree[cols] - inter
+
+    return inter / union
+
+def _cosine(mat, pattern, lo, hi, rows, cols, freq):
+    prods = _values_at(mat[lo:hi] @ mat.T, rows - lo, cols)
+    sqi, sqj = _sides(_squared(mat), pattern, lo, hi, rows, cols)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(sqi * sqj > 0, prods / np.sqrt(sqi * sqj), 0)
+
+def _pearson(mat, pattern, lo, hi, rows, cols, n):
+    prods = _values_at(mat[lo:hi] @ mat.T, rows - lo, cols)
+    sqi, sqj = _sides(_squared(mat), pattern, lo, hi, rows, cols)
+    si, sj = _sides(mat, pattern, lo, hi, rows, cols)
+
+    num = n * prods - si * sj
+    with np.errstate(invalid='ignore'):
+        denum = np.sqrt((n * sqi - si ** 2) * (n * sqj - sj ** 2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denum != 0, num / denum, 0)
+
+_KERNELS = {'jaccard': _jaccard, 'cosine': _cosine, 'pearson': _pearson}
+
+def _score_block(lo, hi):
+    '''upper triangle (rows, cols, values) of rows lo to hi, or their CSR block pruned to k if not upper'''
+    kernel, mat, pattern, min_support, upper, k = _TASK
+    rows, cols, freq = _support(pattern, lo, hi, min_support, upper)
+    values = kernel(mat, pattern, lo, hi, rows, cols, freq)
+    if upper:
+        return rows, cols, values
+    block = _assemble(lo, hi, mat.shape[0], rows, cols, values)
+
+    return block if k is None else prune_neighbors(block, k, lo)
+
+def _map_blocks(task, bounds, n_jobs):
+    '''results of _score_block over bounds in order, computed in n_jobs forked processes if more than 1'''
+    global _TASK
+    _TASK = task
+    try:
+        if n_jobs > 1 and len(bounds) > 1 and 'fork' in mp.get_all_start_methods():
+            with ProcessPoolExecutor(n_jobs, mp_context=mp.get_context('fork')) as executor:
+                yield from executor.map(_score_block, *zip(*bounds))
+        else:
+            for b in bounds:
+                yield _score_block(*b)
+    finally:
+        _TASK = None
+
+def _whole(kernel, mat, min_support, n_jobs=1):
+    '''the full similarity matrix from the xi < xj pairs, mirrored'''
+    mat = sp.csr_matrix(mat, dtype=np.float64)
+    pattern, n_x = _pattern(mat), mat.shape[0]
+    if n_jobs <= 1:
+        rows, cols, freq = _support(pattern, 0, n_x, min_support, upper=True)
+        return _symmetric(n_x, rows, cols, kernel(mat, pattern, 0, n_x, rows, cols, freq))
+
+    # row i has n_x - i - 1 candidate pairs, 4 blocks per worker of about equal pair count balance the load
+    n_blocks = min(4 * n_jobs, n_x)
+    cuts = np.searchsorted(np.cumsum(np.arange(n_x, 0, -1)), np.linspace(0, n_x * (n_x + 1) / 2, n_blocks + 1)[1:-1])
+    edges = np.unique(np.concatenate([[0], cuts, [n_x]])).tolist()
+    parts = list(_map_blocks((kernel, mat, pattern, min_support, True, None), 
+                             list(zip(edges[:-1], edges[1:])), n_jobs))
+
+    return _symmetric(n_x, *[np.concatenate([part[j] for part in parts]) for j in range(3)])
+
+def jaccard(mat, min_support=1, n_jobs=1):
+    '''share of common ys among the ys rated by either x, on distinct ys'''
+    return _whole(_jaccard, mat, min_support, n_jobs)
+
+def cosine(mat, min_support=1, n_jobs=1):
+    '''sum r_xi,y * r_xj,y / sqrt(sum r_xi,y ^ 2 * sum r_xj,y ^ 2) over common ys'''
+    return _whole(_cosine, mat, min_support, n_jobs)
+
+def pearson(mat, min_support=1, n_jobs=1):
+    '''pearson correlation of the ratings of xi and xj over common ys, 0 where either is constant'''
+    return _whole(_pearson, mat, min_support, n_jobs)
+
+def blocked_similarity(name, mat, min_support=1, block_size=1024, k=None, spill_dir=None, n_jobs=1, spill=True):
+    '''
+    similarity matrix of measure name computed block_size rows at a time, so only one block of pair
+    products is in memory per worker process (n_jobs of them); every block is pruned to its k strongest
+    neighbors per row if k is given and spilled to an unlinked temporary file in spill_dir
+    (None for the system default), or kept in memory if spill is False.
+
+    returns CSR as the measure gives, or as prune_neighbors gives if k is set, 
+    with data and indices memory-mapped from the spill files if spilled
+    '''
+    kernel = _KERNELS[name]
+    if block_size < 1:
+        raise ValueError('Invalid block_size value, expect: positive integer')
+    mat = sp.csr_matrix(mat, dtype=np.float64)
+    pattern, n_x = _pattern(mat), mat.shape[0]
+    bounds = [(lo, min(lo + block_size, n_x)) for lo in range(0, n_x, block_size)]
+
+    if spill:
+        data_file = tempfile.TemporaryFile(dir=spill_dir)
+        indices_file = tempfile.TemporaryFile(dir=spill_dir)
+    data_parts, indices_parts = [], []
+    indptr = np.zeros(n_x + 1, dtype=np.int64)
+    dtype = np.float64 if k is None else np.float32
+    blocks = _map_blocks((kernel, mat, pattern, min_support, False, k), bounds, n_jobs)
+    for (lo, hi), block in zip(bounds, blocks):
+        if spill:
+            block.data.astype(dtype).tofile(data_file)
+            block.indices.astype(np.int32).tofile(indices_file)
+        else:
+            data_parts.append(block.data.astype(dtype))
+            indices_parts.append(block.indices.astype(np.int32))
+        indptr[lo + 1:hi + 1] = indptr[lo] + block.indptr[1:]
+
+    if spill:
+        # the maps hold their own handles, the files vanish once the matrix is released
+        with data_file, indices_file:
+            data_file.flush()
+            indices_file.flush()
+            # every row stores its diagonal, so the files are never empty
+            data = np.memmap(data_file, dtype=dtype, mode='r', shape=(indptr[-1],))
+            indices = np.memmap(indices_file, dtype=np.int32, mode='r', shape=(indptr[-1],))
+    else:
+        data = np.concatenate(data_parts) if data_parts else np.zeros(0, dtype=dtype)
+        indices = np.concatenate(indices_parts) if indices_parts else np.zeros(0, dtype=np.int32)
+    sim = sp.csr_matrix((data, indices, indptr), shape=(n_x, n_x), copy=False)
+    sim.has_sorted_indices = True
 
     return sim
 
-def pearson(n_x, yr, xr, min_support):
-    # number of common ys
-    cdef np.ndarray[np.int_t, ndim=2] freq
-    # sum (r_xy * r_x'y) for common ys
-    cdef np.ndarray[np.double_t, ndim=2] prods
-    # sum (rxy ^ 2) for common ys
-    cdef np.ndarray[np.double_t, ndim=2] sqi
-    # sum (rx'y ^ 2) for common ys
-    cdef np.ndarray[np.double_t, ndim=2] sqj
-    # sum (rxy) for common ys
-    cdef np.ndarray[np.double_t, ndim=2] si
-    # sum (rx'y) for common ys
-    cdef np.ndarray[np.double_t, ndim=2] sj
-    # the similarity matrix
-    cdef np.ndarray[np.double_t, ndim=2] sim
-
-    cdef int xi, xj
-    cdef double ri, rj
-    cdef int min_sprt = min_support
-
-    freq = np.zeros((n_x, n_x), np.int)
-    prods = np.zeros((n_x, n_x), np.double)
-    sqi = np.zeros((n_x, n_x), np.double)
-    sqj = np.zeros((n_x, n_x), np.double)
-    si = np.zeros((n_x, n_x), np.double)
-    sj = np.zeros((n_x, n_x), np.double)
-    sim = np.zeros((n_x, n_x), np.double)
-
-    for y, y_ratings in iteritems(yr):
-        for xi, ri in y_ratings:
-            for xj, rj in y_ratings:
-                prods[xi, xj] += ri * rj
-                freq[xi, xj] += 1
-                sqi[xi, xj] += ri**2
-                sqj[xi, xj] += rj**2
-                si[xi, xj] += ri
-                sj[xi, xj] += rj
-
-    for xi in range(n_x):
-        sim[xi, xi] = 1
-        for xj in range(xi + 1, n_x):
-
-            if freq[xi, xj] < min_sprt:
-                sim[xi, xj] = 0
-            else:
-                n = freq[xi, xj]
-                num = n * prods[xi, xj] - si[xi, xj] * sj[xi, xj]
-                denum = np.sqrt((n * sqi[xi, xj] - si[xi, xj]**2) *
-                                (n * sqj[xi, xj] - sj[xi, xj]**2))
-                if denum == 0:
-                    sim[xi, xj] = 0
-                else:
-                    sim[xi, xj] = num / denum
-
-            sim[xj, xi] = sim[xi, xj]
-
-    return sim
\ No newline at end of file
+def prune_neighbors(sim, k, lo=0, chunk_size=1 << 20):
+    '''
+    neighbor index keeping the k largest entries of every row of a CSR similarity matrix besides the diagonal,
+    which stays if stored, ties go to the smaller id; lo is the x of the first row if sim is a block of rows.
+    rows holding more than k neighbors are selected with argpartition, padded into chunks of about
+    chunk_size entries; returns CSR with int32 ids in ascending order and float32 weights
+    '''
+    if k < 1:
+        raise ValueError('Invalid k value, expect: positive integer')
+    sim = sp.csr_matrix(sim)
+    sim.sum_duplicates()
+    n_x, counts = sim.shape[0], np.diff(sim.indptr)
+    rows = np.repeat(np.arange(n_x, dtype=np.int64), counts)
+    diag = sim.indices == rows + lo
+    keep = np.ones(sim.nnz, dtype=bool)
+
+    # rows with more than k neighbors besides the diagonal by ascending length, chunked so that their padded copy 
+    # holds about chunk_size entries; the last row of a chunk is the longest and sets its padded width
+    big = np.flatnonzero(counts - np.bincount(rows[diag], minlength=n_x) > k)
+    big = big[np.argsort(counts[big], kind='stable')]
+    start = 0
+    while start < len(big):
+        width = counts[big[start:]]
+        stop = start + max(1, int(np.searchsorted((np.arange(len(width)) + 1) * width, chunk_size, side='right')))
+        part, start = big[start:stop], stop
+        m = int(counts[part].max())
+        valid = np.arange(m) < counts[part][:, None]
+        pos = np.where(valid, sim.indptr[part][:, None] + np.arange(m), 0)
+        weights = np.where(valid & ~diag[pos], sim.data[pos], -np.inf)
+        # k-th largest weight per row, entries above it stay and ties on it are taken in id order
+        kth = np.take_along_axis(weights, np.argpartition(-weights, k - 1, axis=1)[:, k - 1:k], axis=1)
+        above, tie = weights > kth, weights == kth
+        chosen = above | (tie & (np.cumsum(tie, axis=1) <= k - above.sum(axis=1, keepdims=True)))
+        keep[pos[valid]] = (chosen | diag[pos])[valid]
+
+    new_counts = np.bincount(rows[keep], minlength=n_x)
+    index_dtype = np.int32 if new_counts.sum() < np.iinfo(np.int32).max else np.int64
+    indptr = np.zeros(n_x + 1, dtype=index_dtype)
+    np.cumsum(new_counts, out=indptr[1:])
+
+    return sp.csr_matrix((sim.data[keep].astype(np.float32), sim.indices[keep].astype(np.int32), indptr), 
+                         shape=sim.shape)
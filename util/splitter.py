@@ -0,0 +1,127 @@
+'''
+@Author: Yu Di
+@Date: 2019-12-04 10:21:37
+@LastEditors: Yudi
+@LastEditTime: 2019-12-04 16:03:12
+@Company: Cardinal Operation
+@Email: yudi@shanshu.ai
+@Description: vectorized train/validation/test split, all splits are positional index arrays
+'''
+import numpy as np
+
+def _rng(seed):
+    return seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+
+def _time_order(timestamp, rng):
+    '''row positions sorted by timestamp, ties in random order as shuffle + stable sort did'''
+    perm = rng.permutation(len(timestamp))
+
+    return perm[np.argsort(timestamp[perm], kind='stable')]
+
+def _user_offsets(user):
+    '''user codes, and start/count of every present user in the user-sorted layout'''
+    if user.dtype.kind in 'iu' and len(user) and user.min() >= 0 and user.max() < 2 * len(user):
+        codes = user
+    else:
+        _, codes = np.unique(user, return_inverse=True)
+    counts = np.bincount(codes)
+    starts = np.cumsum(counts) - counts
+    present = counts > 0
+
+    return codes, starts[present], counts[present]
+
+def _fraction_split(order, train_size):
+    split_idx = int(np.ceil(len(order) * train_size))
+
+    return order[:split_idx], order[split_idx:]
+
+def _leave_one_out(user, timestamp, by_time, rng):
+    '''
+    hold one row out of every user, the latest one if by_time else a random one;
+    returns (rest, held_out), rest keeps time order if by_time else the original order
+    '''
+    codes, starts, counts = _user_offsets(user)
+    if by_time:
+        # user major, time minor, random among identical timestamps
+        rest = _time_order(timestamp, rng)
+        order = rest[np.argsort(codes[rest], kind='stable')]
+        held_out = order[starts + counts - 1]
+    else:
+        # one uniform draw per user instead of a groupby sample callback
+        order = np.argsort(codes, kind='stable')
+        held_out = order[starts + (rng.random(len(counts)) * counts).astype(np.int64)]
+        rest = np.arange(len(codes))
+
+    mask = np.ones(len(codes), dtype=bool)
+    mask[held_out] = False
+
+    return rest[mask[rest]], held_out
+
+def test_split_index(df, data_split='fo', by_time=0, test_size=.2, seed=None):
+    '''
+    df: DataFrame with user (and timestamp if by_time) columns;
+    data_split: fo, split a test_size fraction; loo, leave one interaction of each user out;
+    by_time: 1, latest interactions go to test; 0, random ones;
+    seed: int, None or np.random.Generator.
+
+    returns (train_idx, test_idx), positions of df rows
+    '''
+    rng = _rng(seed)
+    timestamp = df['timestamp'].values if by_time else None
+    if data_split == 'fo':
+        order = _time_order(timestamp, rng) if by_time else rng.permutation(len(df))
+        return _fraction_split(order, 1 - test_size)
+    elif data_split == 'loo':
+        return _leave_one_out(df['user'].values, timestamp, by_time, rng)
+    else:
+        raise ValueError('Invalid data_split value, expect: loo, fo')
+
+def validation_split_index(train, val_method='cv', fold_num=5, val_size=.1, seed=None):
+    '''
+    train: DataFrame split further, cv folds follow its current row order;
+    val_method: cv, fold_num contiguous folds; loo/tloo, random/latest interaction of each user;
+                tfo, latest val_size fraction.
+
+    returns list of (train_idx, val_idx), positions of train rows
+    '''
+    rng = _rng(seed)
+    n = len(train)
+    if val_method == 'cv':
+        # same folds as KFold(shuffle=False): the first n % fold_num folds get one more row
+        folds = []
+        for val_idx in np.array_split(np.arange(n), fold_num):
+            mask = np.ones(n, dtype=bool)
+            mask[val_idx] = False
+            folds.append((np.flatnonzero(mask), val_idx))
+        return folds
+    elif val_method == 'loo':
+        return [_leave_one_out(train['user'].values, None, 0, rng)]
+    elif val_method == 'tloo':
+        return [_leave_one_out(train['user'].values, train['timestamp'].values, 1, rng)]
+    elif val_method == 'tfo':
+        return [_fraction_split(_time_order(train['timestamp'].values, rng), 1 - val_size)]
+    else:
+        raise ValueError('Invalid val_method value, expect: cv, loo, tloo, tfo')
+
+def split_test(df, data_split='fo', by_time=0, test_size=.2, seed=None):
+    '''DataFrame version of test_split_index, returns (train, test) with fresh index'''
+    train_idx, test_idx = test_split_index(df, data_split, by_time, test_size, seed)
+
+    return df.iloc[train_idx].reset_index(drop=True), df.iloc[test_idx].reset_index(drop=True)
+
+def split_validation(train, val_method='cv', fold_num=5, val_size=.1, seed=None):
+    '''DataFrame version of validation_split_index, returns (train_list, val_list)'''
+    train_list, val_list = [], []
+    for train_idx, val_idx in validation_split_index(train, val_method, fold_num, val_size, seed):
+        train_list.append(train.iloc[train_idx].reset_index(drop=True))
+        val_list.append(train.iloc[val_idx].reset_index(drop=True))
+
+    return train_list, val_list
+
+def take_split(df, train_idx, test_idx, folds):
+    '''DataFrames of a split given as index arrays, returns (train, test, train_list, val_list)'''
+    train, test = df.iloc[train_idx].reset_index(drop=True), df.iloc[test_idx].reset_index(drop=True)
+    train_list = [train.iloc[fold_train].reset_index(drop=True) for fold_train, _ in folds]
+    val_list = [train.iloc[fold_val].reset_index(drop=True) for _, fold_val in folds]
+
+    return train, test, train_list, val_list